@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Фасад asyncio над модулем commands.
+
+Сообщения из потока коннектора переносятся в цикл событий (call_soon_threadsafe).
+Команды по заявкам возвращают не CmdResult, а дожидаются отчета <order> по transactionid
+из CmdResult.id; потоки сделок, стакана и заявок читаются через async for.
+
+Пример::
+
+    client = AsyncClient()
+    client.initialize('logs', 2)
+    await client.connect(login, password, 'host:3900')
+    order = await client.new_order('TQBR', 'SBER', client_id, 'B', 1, 250.1, bymarket=False)
+    async for packet in client.stream(TradePacket):
+        ...
+"""
+import asyncio, logging
+try:
+    import commands
+    from structures import ClientOrderPacket, ServerStatus
+except ImportError:
+    from . import commands
+    from .structures import ClientOrderPacket, ServerStatus
+
+log = logging.getLogger("aio")
+
+# Промежуточные статусы заявки: на них будущее не завершается
+pending_statuses = frozenset(['forwarding', 'wait', 'none', 'inactive'])
+# Статусы, после которых заявка больше не изменится
+final_statuses = frozenset(['matched', 'cancelled', 'denied', 'rejected', 'expired', 'removed', 'refused',
+                            'failed', 'disabled', 'sl_executed', 'tp_executed'])
+_closed = object()
+
+
+class Stream(object):
+    """
+    Асинхронный итератор пакетов одного типа.
+    При переполнении очереди отбрасываются самые старые пакеты.
+    """
+
+    def __init__(self, client, cls, maxsize):
+        self.client = client
+        self.cls = cls
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, packet):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(packet)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        packet = await self.queue.get()
+        if packet is _closed:
+            raise StopAsyncIteration
+        return packet
+
+    def close(self):
+        """
+        Отписаться; итерация завершится после уже полученных пакетов.
+        """
+        if self in self.client._streams:
+            self.client._streams.remove(self)
+            if self.queue.full():
+                self.queue.get_nowait()
+            self.queue.put_nowait(_closed)
+
+
+class AsyncClient(object):
+    """
+    Клиент коннектора для asyncio.
+    """
+
+    def __init__(self, handler=None, loop=None):
+        """
+        :param handler:
+            Функция для всех сообщений, вызывается в цикле событий.
+        :param loop:
+            Цикл событий (по умолчанию текущий).
+        """
+        self.handler = handler
+        self.loop = loop
+        self._streams = []
+        # transactionid -> (будущее, статусы завершения)
+        self._orders = {}
+        self._status_waiters = []
+
+    def initialize(self, logdir, loglevel):
+        """
+        Инициализировать коннектор, направив сообщения в цикл событий.
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        commands.initialize(logdir, loglevel, self._on_message)
+
+    def uninitialize(self):
+        commands.uninitialize()
+        for stream in list(self._streams):
+            stream.close()
+        for future, statuses in self._orders.values():
+            future.cancel()
+        self._orders.clear()
+
+    def _on_message(self, obj):
+        # Поток коннектора (или dispatcher) -> цикл событий
+        self.loop.call_soon_threadsafe(self._dispatch, obj)
+
+    def _dispatch(self, obj):
+        if isinstance(obj, ClientOrderPacket) and self._orders:
+            for order in obj.items:
+                waiter = self._orders.get(order.id)
+                if waiter is not None and (order.status in waiter[1] if waiter[1] is not None
+                                           else order.status not in pending_statuses):
+                    del self._orders[order.id]
+                    if not waiter[0].done():
+                        waiter[0].set_result(order)
+        elif isinstance(obj, ServerStatus) and self._status_waiters:
+            waiters, self._status_waiters = self._status_waiters, []
+            for future in waiters:
+                if not future.done():
+                    future.set_result(obj)
+        for stream in self._streams:
+            if isinstance(obj, stream.cls):
+                stream.put(obj)
+        if self.handler is not None:
+            try:
+                self.handler(obj)
+            except Exception:
+                log.exception(u"Message handler failed")
+
+    def stream(self, cls, maxsize=10000):
+        """
+        Подписаться на пакеты заданного типа (TradePacket, QuotePacket, ClientOrderPacket...).
+
+        :param cls:
+            Класс пакета.
+        :param maxsize:
+            Размер очереди, пакетов.
+        :return:
+            Stream для async for; close() - отписка.
+        """
+        stream = Stream(self, cls, maxsize)
+        self._streams.append(stream)
+        return stream
+
+    async def _order(self, result, statuses, timeout, transaction_id=None):
+        # Дождаться отчета по transactionid. Регистрация - до возврата в цикл,
+        # поэтому отчет, пришедший сразу после ответа на команду, не теряется.
+        if not result.success:
+            raise commands.TransaqException(result.text)
+        if transaction_id is None:
+            transaction_id = result.id
+        future = self.loop.create_future()
+        self._orders[transaction_id] = (future, frozenset(statuses) if statuses is not None else None)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._orders.pop(transaction_id, None)
+
+    async def connect(self, login, password, server, min_delay=100, timeout=60):
+        """
+        Подключиться и дождаться server_status.
+
+        :return:
+            ServerStatus.
+        """
+        future = self.loop.create_future()
+        self._status_waiters.append(future)
+        commands.connect(login, password, server, min_delay)
+        status = await asyncio.wait_for(future, timeout)
+        if status.connected == 'error':
+            raise commands.TransaqException(status.text)
+        return status
+
+    async def new_order(self, *args, **kwargs):
+        """
+        Новая заявка (параметры как у commands.new_order).
+
+        :param statuses:
+            Статусы, которых ждать; по умолчанию первый непромежуточный.
+        :param timeout:
+            Сколько ждать отчета, секунд.
+        :return:
+            Order из отчета.
+        """
+        statuses, timeout = kwargs.pop('statuses', None), kwargs.pop('timeout', None)
+        return await self._order(commands.new_order(*args, **kwargs), statuses, timeout)
+
+    async def new_stoploss(self, *args, **kwargs):
+        statuses, timeout = kwargs.pop('statuses', None), kwargs.pop('timeout', None)
+        return await self._order(commands.new_stoploss(*args, **kwargs), statuses, timeout)
+
+    async def new_takeprofit(self, *args, **kwargs):
+        statuses, timeout = kwargs.pop('statuses', None), kwargs.pop('timeout', None)
+        return await self._order(commands.new_takeprofit(*args, **kwargs), statuses, timeout)
+
+    async def move_order(self, id, price, quantity=0, moveflag=0, statuses=None, timeout=None):
+        """
+        Передвинуть заявку и дождаться отчета по новой (transactionid из ответа).
+        """
+        return await self._order(commands.move_order(id, price, quantity, moveflag), statuses, timeout)
+
+    async def cancel_order(self, id, timeout=None):
+        """
+        Снять заявку и дождаться ее окончательного статуса.
+        """
+        return await self._order(commands.cancel_order(id), final_statuses, timeout, id)
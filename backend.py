@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Реализации коннектора, с которыми работает модуль commands.
+
+Бэкенд - объект с методами библиотеки txmlconnector:
+Initialize(logdir, loglevel), SetCallback(callback), SendCommand(cmd),
+UnInitialize() и FreeMemory(ptr).
+
+* DllBackend - настоящая dll (только Windows).
+* FakeBackend - замена на чистом питоне: отвечает на команды корректным <result>
+  и передает в коллбэк заданные (или записанные) сообщения с нужной скоростью.
+  Позволяет запускать и замерять весь путь команд и разбора сообщений на любой машине.
+
+Бэкенд выбирается commands.set_backend() или переменной окружения TRANSAQ_BACKEND=fake.
+"""
+import ctypes, threading, logging, time, re, itertools
+
+log = logging.getLogger("backend")
+
+
+class DllBackend(object):
+    """
+    Коннектор из txmlconnector.dll.
+    """
+
+    def __init__(self, dll_path):
+        """
+        :param dll_path:
+            Путь к .dll файлу.
+        """
+        self.dll = ctypes.WinDLL(dll_path)
+        # Сигнатуры объявляются один раз. Ответы - указатели на память коннектора
+        # (NULL - успех для Initialize/UnInitialize), их освобождает FreeMemory
+        self.dll.Initialize.restype = ctypes.c_void_p
+        self.dll.UnInitialize.restype = ctypes.c_void_p
+        self.dll.SendCommand.argtypes = [ctypes.c_char_p]
+        self.dll.SendCommand.restype = ctypes.c_void_p
+        self.dll.FreeMemory.argtypes = [ctypes.c_void_p]
+        self.dll.FreeMemory.restype = ctypes.c_bool
+        self.dll.SetCallback.restype = ctypes.c_bool
+        self.Initialize = self.dll.Initialize
+        self.SetCallback = self.dll.SetCallback
+        self.SendCommand = self.dll.SendCommand
+        self.UnInitialize = self.dll.UnInitialize
+        self.FreeMemory = self.dll.FreeMemory
+
+
+class FakeBackend(object):
+    """
+    Коннектор-заглушка в том же процессе.
+    На любую команду отвечает <result success="true"/>, на connect/disconnect
+    дополнительно присылает server_status, на заявки - выдает transactionid.
+    Ответы на конкретные команды переопределяются через results или наследованием (метод on_<id>).
+    """
+    _id_re = re.compile(br'<command[^>]*?\bid="([^"]+)"')
+
+    def __init__(self, messages=(), rate=None, results=None, autostart=True):
+        """
+        :param messages:
+            Сообщения (байты или строки) для коллбэка, например прочитанные из записи.
+        :param rate:
+            Скорость выдачи, сообщений в секунду (None - без пауз).
+        :param results:
+            Словарь {id команды: ответ}, ответ - байты/строка или функция(команда) -> ответ.
+        :param autostart:
+            Начать выдачу messages после команды connect.
+        """
+        self.messages = messages
+        self.rate = rate
+        self.results = results or {}
+        self.autostart = autostart
+        self.callback = None
+        # Полученные команды (байты) в порядке поступления
+        self.commands = []
+        # Сколько сообщений передано в коллбэк
+        self.pushed = 0
+        self._transaction = 0
+        self._lock = threading.Lock()
+        self._feeder = None
+        self._running = False
+
+    def Initialize(self, logdir, loglevel):
+        return 0
+
+    def SetCallback(self, callback):
+        self.callback = callback
+        return True
+
+    def UnInitialize(self):
+        self.stop()
+        self.callback = None
+        return 0
+
+    def FreeMemory(self, ptr):
+        # Ответы и сообщения - объекты питона, освобождать нечего
+        return True
+
+    def SendCommand(self, cmd):
+        """
+        Ответить на команду как коннектор.
+
+        :param cmd:
+            XML команды (байты).
+        :return:
+            XML ответа (байты).
+        """
+        if not isinstance(cmd, bytes):
+            cmd = cmd.encode('utf8')
+        with self._lock:
+            self.commands.append(cmd)
+        match = self._id_re.search(cmd)
+        command_id = match.group(1).decode('ascii') if match else ''
+        result = self.results.get(command_id)
+        if result is None:
+            handler = getattr(self, 'on_' + command_id, None)
+            result = handler(cmd) if handler is not None else b'<result success="true"/>'
+        elif callable(result):
+            result = result(cmd)
+        return result.encode('utf8') if not isinstance(result, bytes) else result
+
+    def next_transaction(self):
+        with self._lock:
+            self._transaction += 1
+            return self._transaction
+
+    def _order_result(self, cmd):
+        return b'<result success="true" transactionid="%d"/>' % self.next_transaction()
+
+    on_neworder = on_newstoporder = on_newcondorder = _order_result
+
+    def on_connect(self, cmd):
+        # Статус, как и у коннектора, приходит асинхронно - из потока выдачи
+        messages = self.messages if self.autostart else ()
+        self.play(itertools.chain([b'<server_status connected="true"/>'], messages), self.rate)
+        return b'<result success="true"/>'
+
+    def on_disconnect(self, cmd):
+        self.stop()
+        self.push(b'<server_status connected="false"/>')
+        return b'<result success="true"/>'
+
+    def on_get_connector_version(self, cmd):
+        return b'<connector_version>fake</connector_version>'
+
+    def push(self, msg):
+        """
+        Передать сообщение в коллбэк синхронно.
+        """
+        if self.callback is None:
+            return False
+        if not isinstance(msg, bytes):
+            msg = msg.encode('utf8')
+        self.pushed += 1
+        return self.callback(msg)
+
+    def play(self, messages, rate=None):
+        """
+        Выдавать сообщения в коллбэк из отдельного потока (как поток коннектора).
+
+        :param messages:
+            Итерируемое сообщений.
+        :param rate:
+            Сообщений в секунду, None - без пауз.
+        """
+        self.stop()
+        self._running = True
+        self._feeder = threading.Thread(target=self._play, args=(messages, rate), name="txml-fake-feeder")
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def _play(self, messages, rate):
+        interval = 1.0 / rate if rate else 0
+        deadline = time.time()
+        for msg in messages:
+            if not self._running:
+                break
+            if interval:
+                deadline += interval
+                delay = deadline - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                self.push(msg)
+            except Exception:
+                log.exception(u"Callback failed")
+
+    def wait(self, timeout=None):
+        """
+        Дождаться окончания выдачи сообщений.
+        """
+        if self._feeder is not None:
+            self._feeder.join(timeout)
+
+    def stop(self):
+        self._running = False
+        if self._feeder is not None and self._feeder is not threading.current_thread():
+            self._feeder.join()
+        self._feeder = None
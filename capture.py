@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Запись и воспроизведение сырого потока входящих сообщений коннектора.
+
+Файл записи - последовательность блоков (тип, длина, данные), только дописывается:
+
+* H - заголовок сессии записи: время по часам и монотонное время открытия;
+* C - сжатый zlib кусок записей, каждая запись - монотонное время приема (нс), длина, байты сообщения.
+
+Файлы ротируются в полночь: <prefix>.YYYY-MM-DD.cap. Недописанный при сбое последний блок
+отрезается при открытии файла, так что новая сессия того же дня пишется за последним целым блоком.
+Записи сессии служат эталонным набором для замеров и регрессии разбора,
+а также позволяют повторно прогнать обработчик (например, выгрузку в ATSD) после сбоя.
+"""
+import os, time, struct, zlib, datetime, threading, logging
+
+log = logging.getLogger("capture")
+
+_block = struct.Struct('<cI')
+_session = struct.Struct('<dQ')
+_record = struct.Struct('<QI')
+
+
+def _complete_length(path):
+    # Длина файла до конца последнего целого блока (по заголовкам, без распаковки)
+    size = os.path.getsize(path)
+    pos = 0
+    with open(path, 'rb') as f:
+        while pos + _block.size <= size:
+            f.seek(pos)
+            kind, length = _block.unpack(f.read(_block.size))
+            if pos + _block.size + length > size:
+                break
+            pos += _block.size + length
+    return pos
+
+
+class Recorder(object):
+    """
+    Запись сырых сообщений в сжатые по кускам файлы с суточной ротацией.
+    """
+
+    def __init__(self, directory, prefix='transaq', chunk_size=256 * 1024, level=6):
+        """
+        :param directory:
+            Каталог для файлов записи.
+        :param prefix:
+            Префикс имени файлов.
+        :param chunk_size:
+            Размер несжатого куска, байт. Больше - лучше сжатие, но больше теряется при сбое.
+        :param level:
+            Уровень сжатия zlib.
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+        self.level = level
+        self.path = None
+        # Статистика
+        self.records = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._file = None
+        self._chunk = []
+        self._chunk_len = 0
+        self._rollover = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _open(self, now):
+        self._close_file()
+        day = datetime.date.fromtimestamp(now)
+        midnight = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time())
+        self._rollover = time.mktime(midnight.timetuple())
+        self.path = os.path.join(self.directory, '%s.%s.cap' % (self.prefix, day.isoformat()))
+        if os.path.exists(self.path):
+            length = _complete_length(self.path)
+            if length < os.path.getsize(self.path):
+                log.warning(u"Truncated incomplete block at the end of %s" % self.path)
+                with open(self.path, 'r+b') as f:
+                    f.truncate(length)
+        self._file = open(self.path, 'ab')
+        header = _session.pack(now, time.monotonic_ns())
+        self._file.write(_block.pack(b'H', len(header)) + header)
+
+    def record(self, msg, timestamp=None):
+        """
+        Дописать сообщение.
+
+        :param msg:
+            Сырые байты сообщения.
+        :param timestamp:
+            Монотонное время приема, нс (по умолчанию - сейчас).
+        """
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        with self._lock:
+            now = time.time()
+            if now >= self._rollover:
+                self._open(now)
+            self._chunk.append(_record.pack(timestamp, len(msg)))
+            self._chunk.append(msg)
+            self._chunk_len += _record.size + len(msg)
+            self.records += 1
+            self.bytes_in += len(msg)
+            if self._chunk_len >= self.chunk_size:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        if not self._chunk:
+            return
+        data = zlib.compress(b''.join(self._chunk), self.level)
+        self._file.write(_block.pack(b'C', len(data)))
+        self._file.write(data)
+        self.bytes_out += len(data) + _block.size
+        self._chunk = []
+        self._chunk_len = 0
+
+    def flush(self):
+        """
+        Сжать и записать накопленный кусок.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._write_chunk()
+                self._file.flush()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._write_chunk()
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close_file()
+
+    def stats(self):
+        return {'records': self.records, 'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out, 'path': self.path}
+
+
+def read_capture(path):
+    """
+    Прочитать файл записи. Недописанный при сбое хвост пропускается,
+    на поврежденном куске чтение останавливается.
+
+    :param path:
+        Путь к файлу.
+    :return:
+        Генератор пар (монотонное время приема в нс, байты сообщения).
+    """
+    with open(path, 'rb') as f:
+        while True:
+            head = f.read(_block.size)
+            if len(head) < _block.size:
+                break
+            kind, length = _block.unpack(head)
+            payload = f.read(length)
+            if len(payload) < length:
+                log.warning(u"Truncated block in %s" % path)
+                break
+            if kind != b'C':
+                continue
+            try:
+                data = zlib.decompress(payload)
+            except zlib.error as e:
+                log.warning(u"Damaged block in %s: %s" % (path, e))
+                break
+            pos, end = 0, len(data)
+            while pos < end:
+                timestamp, size = _record.unpack_from(data, pos)
+                pos += _record.size
+                yield timestamp, data[pos:pos + size]
+                pos += size
+
+
+def capture_files(directory, prefix='transaq'):
+    """
+    Файлы записи в каталоге по порядку дней.
+    """
+    names = sorted(n for n in os.listdir(directory) if n.startswith(prefix + '.') and n.endswith('.cap'))
+    return [os.path.join(directory, n) for n in names]
+
+
+def replay(paths, handler, speed=None):
+    """
+    Прогнать записанные сообщения через обработчик.
+    Ошибка обработчика на сообщении записывается в лог и не прерывает воспроизведение.
+
+    :param paths:
+        Файл записи или список файлов.
+    :param handler:
+        Функция от сырых байт сообщения, например commands.handle_message.
+    :param speed:
+        None - как можно быстрее, 1.0 - с исходными паузами, 2.0 - вдвое быстрее и т.д.
+    :return:
+        Количество сообщений.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    count = 0
+    first = start = None
+    for path in paths:
+        for timestamp, msg in read_capture(path):
+            if speed:
+                if first is None or timestamp < first:
+                    # Начало или записи другой загрузки системы - отсчет заново
+                    first, start = timestamp, time.monotonic()
+                delay = start + (timestamp - first) / 1e9 / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                handler(msg)
+            except Exception:
+                log.exception(u"Replay handler failed")
+            count += 1
+    return count
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Генератор специализированных парсеров из объявлений полей eulxml.
+
+Для класса XmlObject по его полям (IntegerField, FloatField, StringField,
+DateTimeField, NodeListField...) генерируется python-функция, которая за один
+проход по атрибутам и дочерним тегам элемента заполняет запись со слотами.
+Запись - наследник исходного класса, так что isinstance() и имена атрибутов
+сохраняются, а объявления классов в structures остаются единственным источником правды.
+Компактная запись (compact_record_class) наследует Record вместо исходного класса:
+у нее нет __dict__ и ссылки на элемент, isinstance() с исходным классом не выполняется.
+
+Напрямую компилируются XPath вида '@attr', 'tag' и 'text()', остальные
+(например 'opmask/@usecredit') вычисляются штатным механизмом eulxml.
+Для 'tag', как и в eulxml, берется первый элемент с тегом, значение - string() элемента
+(пустой элемент - '', у FloatField это NaN).
+"""
+from eulxml.xmlmap.core import _FieldDescriptor, XmlObject
+from eulxml.xmlmap.fields import StringMapper, IntegerMapper, FloatMapper, NodeMapper, \
+    NullMapper, NodeListManager, SingleNodeManager
+import inspect, re
+
+# Скомпилированные классы записей: исходный класс -> класс записи
+_records = {}
+# Компактные классы записей: исходный класс -> класс записи
+_compact = {}
+_attr_re = re.compile(r'^@([A-Za-z_][\w.-]*)$')
+_tag_re = re.compile(r'^[A-Za-z_][\w.-]*$')
+
+
+def _int(text):
+    # Семантика IntegerMapper для элементов: int(number(.)), иначе None.
+    if text is None:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return int(float(text))
+        except ValueError:
+            return None
+
+
+def _float(text):
+    # Семантика FloatMapper для элементов: float(number(.)), пустое - NaN.
+    if text is None:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return float('nan')
+
+
+def _string(elem):
+    # string(.) для элемента: текст вместе с вложенными элементами, пустой элемент - ''
+    if len(elem):
+        return ''.join(elem.itertext())
+    return elem.text or ''
+
+
+def _attr_int(text):
+    # Семантика IntegerMapper для атрибутов: int(строки), иначе None.
+    if text is None:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
+def _attr_float(text):
+    if text is None:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _fields(cls):
+    # Поля класса с учетом переопределений (StopOrder.time = None и т.п.),
+    # синонимы (id = trade_no = ...) группируются по объекту поля.
+    groups = []
+    index = {}
+    for name in sorted(cls._fields, key=lambda n: cls._fields[n].creation_counter):
+        for klass in cls.__mro__:
+            if name in klass.__dict__:
+                attr = klass.__dict__[name]
+                break
+        else:
+            continue
+        if not isinstance(attr, _FieldDescriptor):
+            continue
+        field = attr.field
+        if id(field) in index:
+            groups[index[id(field)]][0].append(name)
+        else:
+            index[id(field)] = len(groups)
+            groups.append(([name], field))
+    return groups
+
+
+def _is_plain_string(mapper):
+    # StringMapper с normalize=True переопределяет XPATH в экземпляре
+    return type(mapper) is StringMapper and 'XPATH' not in mapper.__dict__
+
+
+class _Builder(object):
+    """
+    Сборщик исходника функции-парсера для одного класса.
+    """
+
+    def __init__(self, cls, compact=False):
+        self.cls = cls
+        self.compact = compact
+        self.namespace = {'_int': _int, '_float': _float, '_string': _string,
+                          '_attr_int': _attr_int, '_attr_float': _attr_float}
+        self.defaults = []
+        self.attrs = []
+        self.children = []
+        self.other = []
+
+    def ref(self, obj):
+        # Положить объект в пространство имен функции и вернуть его имя
+        name = '_o%d' % len(self.namespace)
+        self.namespace[name] = obj
+        return name
+
+    def add(self, names, field):
+        target = ' = '.join('r.%s' % n for n in names)
+        mapper = field.mapper
+        xpath = field.xpath
+        is_list = isinstance(field.manager, NodeListManager)
+        if is_list:
+            self.defaults.append('%s = []' % target)
+        else:
+            default = mapper.to_python(None) if not isinstance(mapper, NullMapper) else None
+            self.defaults.append('%s = %s' % (target, default if default in (None, False) else self.ref(default)))
+
+        attr = _attr_re.match(xpath)
+        single = isinstance(field.manager, SingleNodeManager) and not field.manager.instantiate_on_get
+        if attr and single:
+            if _is_plain_string(mapper):
+                value = 'v'
+            elif type(mapper) is IntegerMapper:
+                value = '_attr_int(v)'
+            elif type(mapper) is FloatMapper:
+                value = '_attr_float(v)'
+            else:
+                value = '%s.to_python(v)' % self.ref(mapper)
+            self.attrs.append((attr.group(1), target, value))
+        elif xpath == 'text()' and single and _is_plain_string(mapper):
+            self.other.append('%s = elem.text' % target)
+        elif _tag_re.match(xpath) and (single or (is_list and isinstance(mapper, NodeMapper))):
+            first = names[0]
+            if is_list:
+                parser = self.ref(compile_parser(mapper.node_class, self.compact))
+                code = 'r.%s.append(%s(c))' % (first, parser)
+            elif isinstance(mapper, NodeMapper):
+                code = '%s = %s(c)' % (target, self.ref(compile_parser(mapper.node_class, self.compact)))
+            elif isinstance(mapper, NullMapper):
+                code = '%s = c' % target
+            elif _is_plain_string(mapper):
+                code = '%s = s' % target
+            elif type(mapper) is IntegerMapper:
+                code = '%s = _int(s)' % target
+            elif type(mapper) is FloatMapper:
+                code = '%s = _float(s)' % target
+            else:
+                code = '%s = %s.to_python(s)' % (target, self.ref(mapper))
+            # s - строковое значение элемента (string(.)), вычисляется один раз на ветку
+            uses_text = not is_list and not isinstance(mapper, (NodeMapper, NullMapper))
+            self.children.append((xpath, code, is_list, uses_text))
+        else:
+            # Сложный XPath - штатное вычисление eulxml
+            self.other.append('%s = %s.get_for_node(elem, _ctx)' % (target, self.ref(field)))
+
+    def source(self, name):
+        lines = ['def %s(elem):' % name,
+                 '    r = _new(_Record)']
+        if not self.compact:
+            lines += ['    r.node = elem',
+                      '    r.context = _ctx']
+        lines += ['    ' + line for line in self.defaults]
+        for attr, target, value in self.attrs:
+            lines.append('    v = elem.get(%r)' % attr)
+            lines.append('    if v is not None:')
+            lines.append('        %s = %s' % (target, value))
+        if self.children:
+            # Несколько полей на один тег (time и time_millis) - в одной ветке.
+            # Одиночное поле берется из первого элемента с тегом, как XPath в eulxml
+            branches = []
+            singles, lists, texts = {}, {}, set()
+            for tag, code, is_list, uses_text in self.children:
+                if tag not in singles:
+                    singles[tag], lists[tag] = [], []
+                    branches.append(tag)
+                (lists if is_list else singles)[tag].append(code)
+                if uses_text:
+                    texts.add(tag)
+            for i, tag in enumerate(branches):
+                if singles[tag]:
+                    lines.append('    f%d = True' % i)
+            lines.append('    for c in elem:')
+            lines.append('        t = c.tag')
+            keyword = 'if'
+            for i, tag in enumerate(branches):
+                lines.append('        %s t == %r:' % (keyword, tag))
+                if singles[tag]:
+                    lines.append('            if f%d:' % i)
+                    lines.append('                f%d = False' % i)
+                    if tag in texts:
+                        lines.append('                s = _string(c)')
+                    lines += ['                ' + code for code in singles[tag]]
+                lines += ['            ' + code for code in lists[tag]]
+                keyword = 'elif'
+        lines += ['    ' + line for line in self.other]
+        lines.append('    return r')
+        return '\n'.join(lines) + '\n'
+
+
+def _record_repr(self):
+    fields = ["%s=%s" % (name, getattr(self, name)) for name in self._names
+              if getattr(self, name)]
+    return "%s(%s)" % (self.__class__.__name__, ', '.join(fields))
+
+
+class Record(object):
+    """
+    Слотовая база компактных записей: без __dict__, значения полей только в слотах.
+    """
+    __slots__ = ()
+    _names = ()
+    __repr__ = _record_repr
+
+
+def generate_source(cls, compact=False):
+    """
+    Сгенерировать исходник парсера для класса (для отладки и просмотра).
+
+    :param cls:
+        Класс XmlObject.
+    :param compact:
+        True для компактной записи (без node и context).
+    :return:
+        Текст функции и пространство имен, в котором ее нужно исполнить.
+    """
+    builder = _Builder(cls, compact)
+    for names, field in _fields(cls):
+        builder.add(names, field)
+    return builder.source('parse_%s' % cls.__name__), builder.namespace
+
+
+def _compile(record, cls, compact):
+    # Сгенерировать парсер и прикрепить его к классу записи
+    source, namespace = generate_source(cls, compact)
+    namespace.update({'_new': record.__new__, '_Record': record, '_ctx': {'namespaces': {}}})
+    exec(compile(source, '<parser %s>' % cls.__name__, 'exec'), namespace)
+    parser = namespace['parse_%s' % cls.__name__]
+    record.from_element = classmethod(lambda c, elem: parser(elem))
+    record._parser = staticmethod(parser)
+    return record
+
+
+def _methods(cls):
+    # Методы и свойства классов структуры (Entity.__eq__ и т.п.) без XmlObject
+    attrs = {}
+    for klass in reversed(cls.__mro__[:cls.__mro__.index(XmlObject)]):
+        for name, attr in klass.__dict__.items():
+            if inspect.isfunction(attr) or isinstance(attr, property) or name == 'ROOT_NAME':
+                attrs[name] = attr
+    return attrs
+
+
+def record_class(cls):
+    """
+    Получить (сгенерировав при первом обращении) класс записи для класса XmlObject.
+    Класс записи наследует исходный, хранит значения полей в слотах
+    и собирается методом from_element(elem) за один проход.
+    Слоты ускоряют доступ к полям, но память не экономят: __dict__ наследуется от XmlObject
+    (запись без __dict__ - compact_record_class).
+
+    :param cls:
+        Класс XmlObject.
+    :return:
+        Класс записи.
+    """
+    record = _records.get(cls)
+    if record is not None:
+        return record
+    names = [n for group, field in _fields(cls) for n in group]
+    record = type(cls)(cls.__name__, (cls,), {
+        '__slots__': ('node', 'context') + tuple(names),
+        '__module__': cls.__module__,
+        '__repr__': _record_repr,
+        '_names': tuple(names),
+    })
+    # Регистрируем до генерации, чтобы вложенные ссылки на себя не зациклились
+    _records[cls] = _records[record] = record
+    return _compile(record, cls, False)
+
+
+def compact_record_class(cls):
+    """
+    Получить (сгенерировав при первом обращении) компактный класс записи для класса XmlObject.
+    Запись наследует Record: поля только в слотах, без __dict__ и ссылки на lxml элемент,
+    методы и свойства структуры (кроме методов XmlObject) переносятся.
+    Для массовых данных (сделки alltrades), где isinstance() с исходным классом не нужен.
+
+    :param cls:
+        Класс XmlObject.
+    :return:
+        Класс записи.
+    """
+    record = _compact.get(cls)
+    if record is not None:
+        return record
+    names = tuple(n for group, field in _fields(cls) for n in group)
+    attrs = _methods(cls)
+    attrs.update({'__slots__': names, '__module__': cls.__module__, '__repr__': _record_repr, '_names': names})
+    record = type(cls.__name__, (Record,), attrs)
+    _compact[cls] = _compact[record] = record
+    return _compile(record, cls, True)
+
+
+def compile_parser(cls, compact=False):
+    """
+    Получить функцию elem -> запись для класса XmlObject.
+
+    :param cls:
+        Класс XmlObject.
+    :param compact:
+        True для компактной записи (см. compact_record_class).
+    :return:
+        Функция-парсер.
+    """
+    record = compact_record_class(cls) if compact else record_class(cls)
+    parser = record.__dict__.get('_parser')
+    if parser is not None:
+        return parser.__func__
+    # Класс еще генерируется (ссылка на себя) - связываем при вызове
+    return lambda elem: record._parser(elem)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Колоночный разбор пакетов сделок, стакана и свечек в структурные массивы NumPy.
+Объекты на каждый элемент пакета не создаются, время сразу переводится
+в миллисекунды от эпохи (int64, UTC), что позволяет считать VWAP, объемы
+и OHLC векторными операциями по всему пакету.
+
+.. note::
+    Требует numpy, который не входит в обязательные зависимости коннектора.
+"""
+import numpy as np
+try:
+    from structures import MyXmlObject, parseString
+except ImportError:
+    from .structures import MyXmlObject, parseString
+
+# Сделки с рынка (alltrades)
+trade_dtype = np.dtype([
+    ('secid', np.int32),
+    ('tradeno', np.int64),
+    ('time', np.int64),
+    ('price', np.float64),
+    ('quantity', np.int64),
+    ('buysell', np.int8),
+    ('openinterest', np.int64),
+])
+
+# Обновления стакана (quotes)
+quote_dtype = np.dtype([
+    ('secid', np.int32),
+    ('price', np.float64),
+    ('yield', np.int64),
+    ('buy', np.int64),
+    ('sell', np.int64),
+])
+
+# Свечки (candles)
+candle_dtype = np.dtype([
+    ('date', np.int64),
+    ('open', np.float64),
+    ('high', np.float64),
+    ('low', np.float64),
+    ('close', np.float64),
+    ('volume', np.int64),
+    ('oi', np.int64),
+])
+
+# Код направления сделки: покупка 1, продажа -1
+BUY, SELL = 1, -1
+_epoch_stub = '01.01.1970 00:00:00'
+
+
+def _root(source):
+    # Корневой элемент из текста, lxml элемента или распарсенного пакета.
+    if isinstance(source, MyXmlObject):
+        return source.node
+    if isinstance(source, (str, bytes)):
+        return parseString(source)
+    return source
+
+
+def _collect(items, tags, attrs=()):
+    # Тексты полей по колонкам за один проход, пропуски - None.
+    n = len(items)
+    cols = dict((name, [None] * n) for name in tuple(tags) + tuple(attrs))
+    for i, item in enumerate(items):
+        for attr in attrs:
+            cols[attr][i] = item.get(attr)
+        for child in item:
+            col = cols.get(child.tag)
+            if col is not None:
+                col[i] = child.text
+    return cols
+
+
+def _numbers(texts, dtype, default):
+    # Колонка чисел из текстов, пропуски заменяются значением по умолчанию.
+    if not texts:
+        return np.zeros(0, dtype)
+    return np.array([t if t else default for t in texts]).astype(dtype)
+
+
+def to_epoch_millis(texts):
+    """
+    Векторный перевод времени Транзака ("%d.%m.%Y %H:%M:%S[.%f]", UTC)
+    в миллисекунды от эпохи.
+
+    :param texts:
+        Список строк времени.
+    :return:
+        Массив int64.
+    """
+    n = len(texts)
+    if not n:
+        return np.zeros(0, np.int64)
+    raw = np.array([t if t else _epoch_stub for t in texts], dtype='S23')
+    digits = raw.view(np.uint8).reshape(n, 23).astype(np.int64) - 48
+
+    def num(start, stop):
+        result = np.zeros(n, np.int64)
+        for i in range(start, stop):
+            result = result * 10 + digits[:, i]
+        return result
+
+    day, month, year = num(0, 2), num(3, 5), num(6, 10)
+    # Дробная часть может отсутствовать (нулевые байты дополнения)
+    fraction = np.where((digits[:, 20:23] >= 0) & (digits[:, 20:23] <= 9), digits[:, 20:23], 0)
+    millis = fraction[:, 0] * 100 + fraction[:, 1] * 10 + fraction[:, 2]
+    months = (year - 1970) * 12 + month - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + day - 1
+    seconds = num(11, 13) * 3600 + num(14, 16) * 60 + num(17, 19)
+    return days * 86400000 + seconds * 1000 + millis
+
+
+def _fill(dtype, n, columns):
+    result = np.empty(n, dtype)
+    for name, values in columns.items():
+        result[name] = values
+    return result
+
+
+def _as_columns(array, columns):
+    return dict((name, array[name]) for name in array.dtype.names) if columns else array
+
+
+def decode_trades(source, columns=False):
+    """
+    Разобрать пакет alltrades в структурный массив trade_dtype.
+
+    :param source:
+        Текст XML, lxml элемент или TradePacket.
+    :param columns:
+        Вернуть словарь {поле: массив} вместо структурного массива.
+    :return:
+        Массив сделок.
+    """
+    items = _root(source).findall('trade')
+    cols = _collect(items, ('tradeno', 'time', 'price', 'quantity', 'buysell', 'openinterest'), ('secid',))
+    side = np.array([BUY if t == 'B' else SELL if t == 'S' else 0 for t in cols['buysell']], np.int8)
+    result = _fill(trade_dtype, len(items), {
+        'secid': _numbers(cols['secid'], np.int32, '0'),
+        'tradeno': _numbers(cols['tradeno'], np.int64, '0'),
+        'time': to_epoch_millis(cols['time']),
+        'price': _numbers(cols['price'], np.float64, 'nan'),
+        'quantity': _numbers(cols['quantity'], np.int64, '0'),
+        'buysell': side,
+        'openinterest': _numbers(cols['openinterest'], np.int64, '0'),
+    })
+    return _as_columns(result, columns)
+
+
+def decode_quotes(source, columns=False):
+    """
+    Разобрать пакет quotes в структурный массив quote_dtype.
+    Отсутствующие buy/sell равны 0, -1 означает удаление уровня стакана.
+
+    :param source:
+        Текст XML, lxml элемент или QuotePacket.
+    :param columns:
+        Вернуть словарь {поле: массив} вместо структурного массива.
+    :return:
+        Массив обновлений стакана.
+    """
+    items = _root(source).findall('quote')
+    cols = _collect(items, ('price', 'yield', 'buy', 'sell'), ('secid',))
+    result = _fill(quote_dtype, len(items), {
+        'secid': _numbers(cols['secid'], np.int32, '0'),
+        'price': _numbers(cols['price'], np.float64, 'nan'),
+        'yield': _numbers(cols['yield'], np.int64, '0'),
+        'buy': _numbers(cols['buy'], np.int64, '0'),
+        'sell': _numbers(cols['sell'], np.int64, '0'),
+    })
+    return _as_columns(result, columns)
+
+
+def decode_candles(source, columns=False):
+    """
+    Разобрать пакет candles (ответ gethistorydata) в структурный массив candle_dtype.
+
+    :param source:
+        Текст XML, lxml элемент или HistoryCandlePacket.
+    :param columns:
+        Вернуть словарь {поле: массив} вместо структурного массива.
+    :return:
+        Массив свечек.
+    """
+    items = _root(source).findall('candle')
+    cols = _collect(items, (), ('date', 'open', 'high', 'low', 'close', 'volume', 'oi'))
+    result = _fill(candle_dtype, len(items), {
+        'date': to_epoch_millis(cols['date']),
+        'open': _numbers(cols['open'], np.float64, 'nan'),
+        'high': _numbers(cols['high'], np.float64, 'nan'),
+        'low': _numbers(cols['low'], np.float64, 'nan'),
+        'close': _numbers(cols['close'], np.float64, 'nan'),
+        'volume': _numbers(cols['volume'], np.int64, '0'),
+        'oi': _numbers(cols['oi'], np.int64, '0'),
+    })
+    return _as_columns(result, columns)
@@ -10,17 +10,33 @@
     Результат исполнения приходит позже в зарегистрированный командой *initialize()* хэндлер.
     Синхронные вспомогательные команды помечены отдельно.
 """
-import ctypes, logging
+import ctypes, logging, threading
 import platform, os, sys
+from collections import deque
+from concurrent.futures import Future
 import lxml.etree as et
 try:
     from structures import *
+    from dispatch import Dispatcher
+    from pipeline import Pipeline, trade_tuples
+    from backend import DllBackend, FakeBackend
+    from capture import Recorder, replay
+    from serialize import shaped
+    from scheduler import CommandScheduler
 except ImportError:
     from .structures import *
+    from .dispatch import Dispatcher
+    from .pipeline import Pipeline, trade_tuples
+    from .backend import DllBackend, FakeBackend
+    from .capture import Recorder, replay
+    from .serialize import shaped
+    from .scheduler import CommandScheduler
 
 log = logging.getLogger("commands")
 
-callback_func = ctypes.WINFUNCTYPE(ctypes.c_bool, ctypes.c_char_p)
+# stdcall есть только на Windows, для FakeBackend годится и cdecl.
+# Сообщение приходит указателем: его нужно скопировать и освободить через FreeMemory
+callback_func = getattr(ctypes, 'WINFUNCTYPE', ctypes.CFUNCTYPE)(ctypes.c_bool, ctypes.c_void_p)
 global_handler = None
 path = ""
 if __file__ is not None:
@@ -28,9 +44,39 @@ if __file__ is not None:
     if path != "":
         path += os.sep
 
-txml_dll = ctypes.WinDLL(path + ("txmlconnector64.dll" if platform.machine() == 'AMD64' else 'txmlconnector.dll'))
+
+def _default_backend():
+    # Настоящая dll на Windows, иначе (или при TRANSAQ_BACKEND=fake) - заглушка
+    if os.environ.get('TRANSAQ_BACKEND') == 'fake' or not hasattr(ctypes, 'WinDLL'):
+        return FakeBackend()
+    return DllBackend(path + ("txmlconnector64.dll" if platform.machine() == 'AMD64' else 'txmlconnector.dll'))
+
+
+# Текущий бэкенд коннектора (см. set_backend)
+txml_dll = _default_backend()
 connected = False
 encoding = sys.stdout.encoding
+# Корневые теги сообщений, нужных обработчику (None - все), см. set_interests()
+interested_tags = None
+# Отложенные неразобранные сообщения (сырые байты) или None, если они отбрасываются
+deferred = None
+# Количество отброшенных/отложенных сообщений
+dropped = 0
+# Сообщения, которые разбираются всегда: их обрабатывает сам callback
+_always_tags = frozenset([Error.ROOT_NAME, ServerStatus.ROOT_NAME])
+# Рабочие потоки разбора сообщений, если включены (см. start_dispatcher)
+dispatcher = None
+# Процессы разбора пакетов сделок и стакана, если включены (см. start_pipeline)
+pipeline = None
+# Запись сырого входящего потока, если включена (см. start_recording)
+recorder = None
+# Счетчики буферов коннектора: получено и освобождено через FreeMemory.
+# Сообщения приходят из потока коннектора и из потоков, отправляющих команды, поэтому под блокировкой
+native_received = 0
+native_freed = 0
+_native_lock = threading.Lock()
+# Планировщик команд, если включен (см. start_scheduler)
+scheduler = None
 
 
 def reload_dll(dll_path):
@@ -38,20 +84,291 @@ def reload_dll(dll_path):
     Функция, загружающая dll с иным путем, чем site-packages. Нужно использовать, если возникают проблемы с правами доступа
     :param dll_path: Путь к .dll файлу
     """
-    global  txml_dll
-    txml_dll = ctypes.WinDLL(dll_path)
+    set_backend(DllBackend(dll_path))
+
+
+def set_backend(backend):
+    """
+    Заменить реализацию коннектора, например на backend.FakeBackend.
+    Вызывать до initialize().
+
+    :param backend:
+        Объект с методами Initialize, SetCallback, SendCommand, UnInitialize, FreeMemory.
+    :return:
+        Установленный бэкенд.
+    """
+    global txml_dll
+    txml_dll = backend
+    return backend
+
+
+def set_interests(types=None, defer=0):
+    """
+    Задать типы сообщений, нужные обработчику. Корневой тег остальных
+    определяется по сырым байтам, и они не разбираются вовсе.
+    Ошибки и статус соединения разбираются всегда.
+
+    :param types:
+        Классы структур (или имена корневых тегов). None - все сообщения.
+    :param defer:
+        Если больше нуля, ненужные сообщения не отбрасываются, а складываются
+        в очередь deferred (не более defer последних); разобрать их - drain_deferred().
+    """
+    global interested_tags, deferred
+    if types is None:
+        interested_tags = None
+    else:
+        interested_tags = frozenset(t if isinstance(t, str) else t.ROOT_NAME for t in types) | _always_tags
+    deferred = deque(maxlen=defer) if defer > 0 else None
+
+
+def _skip(msg):
+    # Отсеять неинтересное сообщение до парсинга.
+    global dropped
+    if interested_tags is None or root_tag(msg) in interested_tags:
+        return False
+    dropped += 1
+    if deferred is not None:
+        deferred.append(msg)
+    return True
+
+
+def drain_deferred():
+    """
+    Разобрать отложенные сообщения (см. set_interests) и передать их обработчику
+    в порядке поступления. Синхронная вспомогательная команда.
+
+    :return:
+        Количество обработанных сообщений.
+    """
+    queue = deferred
+    count = 0
+    while queue:
+        try:
+            msg = queue.popleft()
+        except IndexError:
+            break
+        _deliver(msg)
+        count += 1
+    return count
+
+
+def start_dispatcher(workers=1, capacity=65536):
+    """
+    Перенести разбор и обработку сообщений из потока коннектора в рабочие потоки.
+    Коллбэк лишь кладет сырые байты в кольцевой буфер; при его переполнении сообщения отбрасываются.
+    С несколькими потоками порядок обработки сообщений не гарантируется.
+
+    :param workers:
+        Количество рабочих потоков.
+    :param capacity:
+        Размер буфера, сообщений.
+    :return:
+        Dispatcher, его stats() - глубина очереди, максимум, отброшенные.
+    """
+    global dispatcher
+    stop_dispatcher()
+    dispatcher = Dispatcher(handle_message, workers, capacity)
+    dispatcher.start()
+    return dispatcher
+
+
+def stop_dispatcher():
+    """
+    Остановить рабочие потоки, дообработав накопленное, и вернуть обработку в коллбэк.
+    """
+    global dispatcher
+    if dispatcher is not None:
+        dispatcher.stop()
+        dispatcher = None
+
+
+def start_pipeline(worker_fn=trade_tuples, workers=None, result_handler=None):
+    """
+    Разбирать пакеты alltrades, quotes и quotations в пуле процессов.
+    Пакеты режутся по secid, бумага всегда обрабатывается одним процессом,
+    поэтому порядок по инструменту сохраняется. Остальные сообщения идут
+    обычным путем (в коллбэке или через dispatcher).
+
+    :param worker_fn:
+        Функция уровня модуля, вызываемая в процессе для распарсенного пакета.
+        Может сама отправлять данные дальше и возвращать None.
+    :param workers:
+        Количество процессов, по умолчанию число ядер.
+    :param result_handler:
+        Функция для результатов worker_fn в основном процессе,
+        по умолчанию результаты передаются глобальному обработчику (см. initialize).
+    :return:
+        Pipeline, его stats() - сколько частей отправлено каждому процессу.
+    """
+    global pipeline
+    stop_pipeline()
+    pipeline = Pipeline(worker_fn, workers, result_handler or _handle_result, _handle_local)
+    pipeline.start()
+    return pipeline
+
+
+def stop_pipeline():
+    """
+    Остановить процессы разбора, дообработав отправленное.
+    """
+    global pipeline
+    if pipeline is not None:
+        pipeline.stop()
+        pipeline = None
+
+
+def start_recording(directory, prefix='transaq'):
+    """
+    Записывать все входящие сообщения (до фильтрации и разбора) в сжатые файлы
+    с монотонным временем приема и суточной ротацией.
+
+    :param directory:
+        Каталог записи.
+    :param prefix:
+        Префикс имени файлов.
+    :return:
+        Recorder.
+    """
+    global recorder
+    stop_recording()
+    recorder = Recorder(directory, prefix)
+    return recorder
+
+
+def stop_recording():
+    """
+    Дописать накопленное и закрыть файл записи.
+    """
+    global recorder
+    if recorder is not None:
+        recorder.close()
+        recorder = None
+
+
+def start_scheduler(min_delay=100):
+    """
+    Запустить поток отправки команд с приоритетами (см. модуль scheduler).
+    Команды ставятся в очередь через schedule(); интервал обновляется в connect() по rqdelay.
+
+    :param min_delay:
+        Интервал между запросами к серверу, мс.
+    :return:
+        CommandScheduler, его stats() - задержки в очередях.
+    """
+    global scheduler
+    stop_scheduler()
+    scheduler = CommandScheduler(min_delay / 1000.0)
+    scheduler.start()
+    return scheduler
+
+
+def stop_scheduler():
+    """
+    Отправить команды из очереди и остановить поток планировщика.
+    """
+    global scheduler
+    if scheduler is not None:
+        scheduler.stop()
+        scheduler = None
+
+
+def schedule(func, *args, **kwargs):
+    """
+    Отправить команду через планировщик: заявки - сразу, подписки и запросы - не чаще rqdelay,
+    одинаковые запросы в очереди склеиваются. Без планировщика команда выполняется сразу.
+
+    :param func:
+        Функция этого модуля, например get_news_text.
+    :return:
+        concurrent.futures.Future с результатом команды.
+    """
+    if scheduler is not None:
+        return scheduler.submit(func, *args, **kwargs)
+    kwargs.pop('lane', None)
+    kwargs.pop('coalesce', None)
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def native_stats():
+    """
+    Статистика нативной памяти коннектора: сколько буферов получено,
+    освобождено и не освобождено (утечка, если растет).
+    """
+    with _native_lock:
+        return {'received': native_received, 'freed': native_freed,
+                'outstanding': native_received - native_freed}
+
+
+def replay_capture(paths, speed=None):
+    """
+    Прогнать запись через разбор и зарегистрированный в initialize() обработчик (синхронная).
+
+    :param paths:
+        Файл записи или список файлов (см. capture.capture_files).
+    :param speed:
+        None - как можно быстрее, 1.0 - с исходными паузами.
+    :return:
+        Количество сообщений.
+    """
+    return replay(paths, handle_message, speed)
+
+
+def _handle_result(result):
+    if global_handler:
+        global_handler(result)
+
+
+def _handle_local(msg):
+    if dispatcher is not None:
+        return dispatcher.put(msg)
+    return handle_message(msg)
 
 
 @callback_func
-def callback(msg):
+def callback(ptr):
     """
     Функция, вызываемая коннектором при входящих сообщениях.
 
+    :param ptr:
+        Указатель на входящее сообщение Транзака.
+    :return:
+        True если все обработал.
+    """
+    msg = __get_message(ptr)
+    if recorder is not None:
+        recorder.record(msg)
+    if pipeline is not None:
+        if not _skip(msg):
+            pipeline.put(msg)
+        return True
+    if dispatcher is not None:
+        dispatcher.put(msg)
+        return True
+    return handle_message(msg)
+
+
+def handle_message(msg):
+    """
+    Разобрать сырое сообщение и передать его обработчику.
+
     :param msg:
-        Входящее сообщение Транзака.
+        Входящее сообщение Транзака (байты).
     :return:
         True если все обработал.
     """
+    if _skip(msg):
+        return True
+    return _deliver(msg)
+
+
+def _deliver(msg):
+    # Разобрать сообщение без фильтра интересов и передать обработчику.
     obj = parse(msg.decode('utf8'))
     if isinstance(obj, Error):
         log.error(u"Error: %s" % obj.text)
@@ -77,28 +394,25 @@ class TransaqException(Exception):
 
 
 def __get_message(ptr):
-    # Достать сообщение из нативной памяти.
+    # Скопировать сообщение из нативной памяти и освободить буфер.
+    global native_received, native_freed
     msg = ctypes.string_at(ptr)
-    # txml_dll.FreeMemory(ptr)
-    return str(msg, 'utf8')
-
-
-def __elem(tag, text):
-    # Создать элемент с заданным текстом.
-    elem = et.Element(tag)
-    elem.text = text
-    return elem
+    freed = txml_dll.FreeMemory(ptr)
+    with _native_lock:
+        native_received += 1
+        if freed:
+            native_freed += 1
+    return msg
 
 
 def __send_command(cmd):
-    # Отправить команду и проверить на ошибки.
-    txml_dll.SendCommand.restype = ctypes.c_char_p
+    # Отправить команду и проверить на ошибки. Тип ответа - по корневому тегу, разбор один.
     msg = __get_message(txml_dll.SendCommand(cmd))
-    err = Error.parse(msg)
-    if err.text:
-        raise TransaqException(err.text.encode(encoding))
-    else:
-        return CmdResult.parse(msg)
+    if root_tag(msg) == Error.ROOT_NAME:
+        err = Error.parse(msg)
+        if err.text:
+            raise TransaqException(err.text.encode(encoding))
+    return CmdResult.parse(msg)
 
 
 def initialize(logdir, loglevel, msg_handler):
@@ -114,7 +428,7 @@ def initialize(logdir, loglevel, msg_handler):
     if not os.path.exists(logdir):
         os.mkdir(logdir)
     err = txml_dll.Initialize(logdir, loglevel)
-    if err != 0:
+    if err:
         msg = __get_message(err)
         raise TransaqException(Error.parse(msg).text.encode(encoding))
     if not txml_dll.SetCallback(callback):
@@ -127,52 +441,139 @@ def uninitialize():
 
     :return:
     """
+    stop_scheduler()
     if connected:
         disconnect()
     err = txml_dll.UnInitialize()
-    if err != 0:
+    stop_pipeline()
+    stop_dispatcher()
+    stop_recording()
+    if err:
         msg = __get_message(err)
         raise TransaqException(Error.parse(msg).text.encode(encoding))
 
 
+## Шаблоны команд (см. serialize), по одному на форму команды
+
+@shaped
+def _simple_command(cmd):
+    # Команда без параметров
+    return '<command id="%s"/>' % cmd
+
+
+@shaped
+def _client_command(cmd):
+    # Команда с клиентом в атрибуте
+    return '<command id="%s" client="{@}"/>' % cmd
+
+
+@shaped
+def _transaction_command(cmd):
+    # Команда над заявкой по transactionid
+    return '<command id="%s">{transactionid}</command>' % cmd
+
+
+@shaped
+def _subscription(cmd, mode, nonempty):
+    # Пустой список lxml пишет как <mode/>
+    return '<command id="%s"><%s>{*}</%s></command>' % (cmd, mode, mode) if nonempty \
+        else '<command id="%s"><%s/></command>' % (cmd, mode)
+
+
+@shaped
+def _connect():
+    return ('<command id="connect">{login}{password}{host}{port}{rqdelay}'
+            '<milliseconds>true</milliseconds><utc_time>true</utc_time><language>en</language></command>')
+
+
+@shaped
+def _new_order(bymarket, usecredit):
+    return ('<command id="neworder"><security>{board}{seccode}</security>{client}{buysell}{quantity}'
+            + ('<bymarket/>' if bymarket else '{price}') + ('<usecredit/>' if usecredit else '') + '</command>')
+
+
+@shaped
+def _new_stoporder(kind, linked, valid, bymarket, usecredit, correction):
+    # kind - stoploss или takeprofit
+    return ('<command id="newstoporder"><security>{board}{seccode}</security>{client}{buysell}'
+            + ('{linkedorderno}' if linked else '') + ('{validfor}' if valid else '')
+            + '<%s>{quantity}{activationprice}' % kind
+            + ('<bymarket/>' if bymarket else '{orderprice}') + ('<usecredit/>' if usecredit else '')
+            + ('{correction}' if correction else '') + '</%s></command>' % kind)
+
+
+@shaped
+def _security(key):
+    # Элемент security: key - board или market
+    return '<security>{%s}{seccode}</security>' % key
+
+
+@shaped
+def _secid():
+    return '{secid}'
+
+
+@shaped
+def _history():
+    return '<command id="gethistorydata"><security>{board}{seccode}</security>{period}{count}{reset}</command>'
+
+
+@shaped
+def _move_order():
+    return '<command id="moveorder">{transactionid}{price}{quantity}{moveflag}</command>'
+
+
+@shaped
+def _sec_info():
+    return '<command id="get_securities_info"><security>{market}{seccode}</security></command>'
+
+
+@shaped
+def _news_body():
+    return '<command id="get_news_body" news_id="{@}"/>'
+
+
+@shaped
+def _change_pass():
+    return '<command id="change_pass" oldpass="{@}" newpass="{@}"/>'
+
+
+@shaped
+def _limits_tplus(nonempty):
+    return '<command id="get_max_buy_sell_tplus" client="{@}">{*}</command>' if nonempty \
+        else '<command id="get_max_buy_sell_tplus" client="{@}"/>'
+
+
+@shaped
+def _united_portfolio_union():
+    return '<command id="get_united_portfolio" union="{@}"/>'
+
+
 def connect(login, password, server, min_delay=100):
     host, port = server.split(':')
-    root = et.Element("command", {"id": "connect"})
-    root.append(__elem("login", login))
-    root.append(__elem("password", password))
-    root.append(__elem("host", host))
-    root.append(__elem("port", port))
-    root.append(__elem("rqdelay", str(min_delay)))
-    root.append(__elem("milliseconds", "true"))
-    root.append(__elem("utc_time", "true"))
-    root.append(__elem("language", "en"))
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    if scheduler is not None:
+        scheduler.min_delay = min_delay / 1000.0
+    return __send_command(_connect().fill(login, password, host, port, str(min_delay)))
 
 
 def disconnect():
     global connected
-    root = et.Element("command", {"id": "disconnect"})
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_simple_command("disconnect").fill())
     # connected = False
 
 
 def server_status():
-    root = et.Element("command", {"id": "server_status"})
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_simple_command("server_status").fill())
 
 
 def get_instruments():
-    root = et.Element("command", {"id": "get_securities"})
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_simple_command("get_securities").fill())
 
 
 def __subscribe_helper_ids(secids, cmd, mode):
-    root = et.Element("command", {"id": cmd})
-    trades = et.Element(mode)
-    for id in secids:
-        trades.append(__elem("secid", str(id)))
-    root.append(trades)
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    secid = _secid()
+    items = b''.join(secid.fill(str(id)) for id in secids)
+    return __send_command(_subscription(cmd, mode, bool(items)).fill(*((items,) if items else ())))
 
 
 def subscribe_ids(secids):
@@ -183,16 +584,26 @@ def unsubscribe_ids(secids):
     return __subscribe_helper_ids(secids, "unsubscribe", "alltrades")
 
 
+def subscribe_quotations_ids(secids):
+    return __subscribe_helper_ids(secids, "subscribe", "quotations")
+
+
+def unsubscribe_quotations_ids(secids):
+    return __subscribe_helper_ids(secids, "unsubscribe", "quotations")
+
+
+def subscribe_bidasks_ids(secids):
+    return __subscribe_helper_ids(secids, "subscribe", "quotes")
+
+
+def unsubscribe_bidasks_ids(secids):
+    return __subscribe_helper_ids(secids, "unsubscribe", "quotes")
+
+
 def __subscribe_helper(board, tickers, cmd, mode):
-    root = et.Element("command", {"id": cmd})
-    trades = et.Element(mode)
-    for t in tickers:
-        sec = et.Element("security")
-        sec.append(__elem("board", board))
-        sec.append(__elem("seccode", t))
-        trades.append(sec)
-    root.append(trades)
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    security = _security("board")
+    items = b''.join(security.fill(board, t) for t in tickers)
+    return __send_command(_subscription(cmd, mode, bool(items)).fill(*((items,) if items else ())))
 
 
 def subscribe_ticks(board, tickers):
@@ -222,87 +633,47 @@ def unsubscribe_bidasks(board, tickers):
 def new_order(board, ticker, client, buysell, quantity, price=0,
               bymarket=True, usecredit=True):
     # Add hidden, unfilled, nosplit
-    root = et.Element("command", {"id": "neworder"})
-    sec = et.Element("security")
-    sec.append(__elem("board", board))
-    sec.append(__elem("seccode", ticker))
-    root.append(sec)
-    root.append(__elem("client", client))
-    root.append(__elem("buysell", buysell.upper()))
-    root.append(__elem("quantity", str(quantity)))
-    if not bymarket:
-        root.append(__elem("price", str(price)))
-    else:
-        root.append(et.Element("bymarket"))
-    if usecredit:
-        root.append(et.Element("usecredit"))
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    template = _new_order(bool(bymarket), bool(usecredit))
+    if bymarket:
+        return __send_command(template.fill(board, ticker, client, buysell.upper(), str(quantity)))
+    return __send_command(template.fill(board, ticker, client, buysell.upper(), str(quantity), str(price)))
 
 
 def new_stoploss(board, ticker, client, buysell, quantity, trigger_price, price=0,
                  bymarket=True, usecredit=True, linked_order=None, valid_for=None):
-    root = et.Element("command", {"id": "newstoporder"})
-    sec = et.Element("security")
-    sec.append(__elem("board", board))
-    sec.append(__elem("seccode", ticker))
-    root.append(sec)
-    root.append(__elem("client", client))
-    root.append(__elem("buysell", buysell.upper()))
+    values = [board, ticker, client, buysell.upper()]
     if linked_order:
-        root.append(__elem("linkedorderno", str(linked_order)))
+        values.append(str(linked_order))
     if valid_for:
-        root.append(__elem("validfor", valid_for.strftime(timeformat)))
-
-    sl = et.Element("stoploss")
-    sl.append(__elem("quantity", str(quantity)))
-    sl.append(__elem("activationprice", str(trigger_price)))
+        values.append(valid_for.strftime(timeformat))
+    values += [str(quantity), str(trigger_price)]
     if not bymarket:
-        sl.append(__elem("orderprice", str(price)))
-    else:
-        sl.append(et.Element("bymarket"))
-    if usecredit:
-        sl.append(et.Element("usecredit"))
-
-    root.append(sl)
-    return __send_command(et.tostring(root, encoding="utf-8"))
+        values.append(str(price))
+    template = _new_stoporder("stoploss", bool(linked_order), bool(valid_for), bool(bymarket), bool(usecredit), False)
+    return __send_command(template.fill(*values))
 
 
 def new_takeprofit(board, ticker, client, buysell, quantity, trigger_price,
                    correction=0, use_credit=True, linked_order=None, valid_for=None):
-    root = et.Element("command", {"id": "newstoporder"})
-    sec = et.Element("security")
-    sec.append(__elem("board", board))
-    sec.append(__elem("seccode", ticker))
-    root.append(sec)
-    root.append(__elem("client", client))
-    root.append(__elem("buysell", buysell.upper()))
+    values = [board, ticker, client, buysell.upper()]
     if linked_order:
-        root.append(__elem("linkedorderno", str(linked_order)))
+        values.append(str(linked_order))
     if valid_for:
-        root.append(__elem("validfor", valid_for.strftime(timeformat)))
-
-    tp = et.Element("takeprofit")
-    tp.append(__elem("quantity", str(quantity)))
-    tp.append(__elem("activationprice", str(trigger_price)))
-    tp.append(et.Element("bymarket"))
-    if use_credit:
-        tp.append(et.Element("usecredit"))
+        values.append(valid_for.strftime(timeformat))
+    values += [str(quantity), str(trigger_price)]
     if correction:
-        tp.append(__elem("correction", str(correction)))
-    root.append(tp)
-    return __send_command(et.tostring(root, encoding="utf-8"))
+        values.append(str(correction))
+    template = _new_stoporder("takeprofit", bool(linked_order), bool(valid_for), True, bool(use_credit),
+                              bool(correction))
+    return __send_command(template.fill(*values))
 
 
 def cancel_order(id):
-    root = et.Element("command", {"id": "cancelorder"})
-    root.append(__elem("transactionid", str(id)))
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_transaction_command("cancelorder").fill(str(id)))
 
 
 def cancel_stoploss(id):
-    root = et.Element("command", {"id": "cancelstoporder"})
-    root.append(__elem("transactionid", str(id)))
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_transaction_command("cancelstoporder").fill(str(id)))
 
 
 def cancel_takeprofit(id):
@@ -310,8 +681,7 @@ def cancel_takeprofit(id):
 
 
 def get_portfolio(client):
-    root = et.Element("command", {"id": "get_portfolio", "client": client})
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_client_command("get_portfolio").fill(client))
 
 
 def get_markets():
@@ -321,8 +691,7 @@ def get_markets():
     :return:
         Результат отправки команды.
     """
-    root = et.Element("command", {"id": "get_markets"})
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_simple_command("get_markets").fill())
 
 
 def get_history(board, seccode, period, count, reset=True):
@@ -343,15 +712,8 @@ def get_history(board, seccode, period, count, reset=True):
     :return:
         Результат отправки команды.
     """
-    root = et.Element("command", {"id": "gethistorydata"})
-    sec = et.Element("security")
-    sec.append(__elem("board", board))
-    sec.append(__elem("seccode", seccode))
-    root.append(sec)
-    root.append(__elem("period", str(period)))
-    root.append(__elem("count", str(count)))
-    root.append(__elem("reset", "true" if reset else "false"))
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    template = _history()
+    return __send_command(template.fill(board, seccode, str(period), str(count), "true" if reset else "false"))
 
 
 # TODO Доделать условные заявки
@@ -388,8 +750,7 @@ def get_forts_position(client):
     :return:
         Результат отправки команды.
     """
-    root = et.Element("command", {"id": "get_forts_position", "client": client})
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_client_command("get_forts_position").fill(client))
 
 
 def get_limits_forts(client):
@@ -401,8 +762,7 @@ def get_limits_forts(client):
     :return:
         Результат отправки команды.
     """
-    root = et.Element("command", {"id": "get_client_limits", "client": client})
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_client_command("get_client_limits").fill(client))
 
 
 def get_servtime_diff():
@@ -426,8 +786,7 @@ def change_pass(oldpass, newpass):
     :return:
         Результат команды.
     """
-    root = et.Element("command", {"id": "change_pass", "oldpass": oldpass, "newpass": newpass})
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_change_pass().fill(oldpass, newpass))
 
 
 def get_version():
@@ -437,8 +796,8 @@ def get_version():
     :return:
         Версия коннектора.
     """
-    root = et.Element("command", {"id": "get_connector_version"})
-    return ConnectorVersion.parse(__get_message(txml_dll.SendCommand(et.tostring(root, encoding="utf-8")))).version
+    cmd = _simple_command("get_connector_version").fill()
+    return ConnectorVersion.parse(__get_message(txml_dll.SendCommand(cmd))).version
 
 
 def get_sec_info(market, seccode):
@@ -452,16 +811,10 @@ def get_sec_info(market, seccode):
     :return:
         Результат отправки команды.
     """
-    root = et.Element("command", {"id": "get_securities_info"})
-    sec = et.Element("security")
-    sec.append(__elem("market", str(market)))
-    sec.append(__elem("seccode", seccode))
-    root.append(sec)
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_sec_info().fill(str(market), seccode))
 
 def get_news_text(id):
-    root = et.Element("command", {"id": "get_news_body", "news_id": str(id)})
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_news_body().fill(str(id)))
 
 def move_order(id, price, quantity=0, moveflag=0):
     """
@@ -480,12 +833,7 @@ def move_order(id, price, quantity=0, moveflag=0):
     :return:
         Результат отправки команды.
     """
-    root = et.Element("command", {"id": "moveorder"})
-    root.append(__elem("transactionid", str(id)))
-    root.append(__elem("price", str(price)))
-    root.append(__elem("quantity", str(quantity)))
-    root.append(__elem("moveflag", str(moveflag)))
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    return __send_command(_move_order().fill(str(id), str(price), str(quantity), str(moveflag)))
 
 
 def get_limits_tplus(client, securities):
@@ -499,13 +847,9 @@ def get_limits_tplus(client, securities):
     :return:
         Результат отправки команды.
     """
-    root = et.Element("command", {"id": "get_max_buy_sell_tplus", "client": client})
-    for (market, code) in securities:
-        sec = et.Element("security")
-        sec.append(__elem("market", str(market)))
-        sec.append(__elem("seccode", code))
-        root.append(sec)
-    return __send_command(et.tostring(root, encoding="utf-8"))
+    security = _security("market")
+    items = b''.join(security.fill(str(market), code) for (market, code) in securities)
+    return __send_command(_limits_tplus(bool(items)).fill(client, *((items,) if items else ())))
 
 
 def get_portfolio_mct(client):
@@ -531,12 +875,9 @@ def get_united_portfolio(client, union=None):
     :return:
         Результат отправки команды.
     """
-    params = {"id": "get_united_portfolio"}
     if client is not None:
-        params["client"] = client
+        return __send_command(_client_command("get_united_portfolio").fill(client))
     elif union is not None:
-        params["union"] = union
+        return __send_command(_united_portfolio_union().fill(union))
     else:
-        raise ValueError("please specify client OR union")
-    root = et.Element("command", params)
-    return __send_command(et.tostring(root, encoding="utf-8"))
\ No newline at end of file
+        raise ValueError("please specify client OR union")
\ No newline at end of file
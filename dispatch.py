@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Отвязка потока коллбэка коннектора от обработки сообщений.
+
+Коллбэк только кладет сырые байты сообщения в ограниченный кольцевой буфер
+и сразу возвращается, разбор и вызов обработчика выполняют рабочие потоки.
+Так медленные логи или сеть в обработчике не тормозят внутреннюю очередь DLL.
+"""
+import threading, logging
+
+log = logging.getLogger("dispatch")
+
+
+class RingBuffer(object):
+    """
+    Ограниченный кольцевой буфер с одним писателем (поток коллбэка) без блокировок на записи.
+    При переполнении новое сообщение отбрасывается, писатель никогда не ждет.
+    """
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        # Счетчики записанных/прочитанных сообщений, индекс слота - по модулю capacity
+        self._head = 0
+        self._tail = 0
+        self._read_lock = threading.Lock()
+        self._ready = threading.Semaphore(0)
+        # Статистика
+        self.dropped = 0
+        self.high_water = 0
+
+    def put(self, msg):
+        """
+        Положить сообщение (только из одного потока-писателя).
+
+        :param msg:
+            Сырые байты сообщения.
+        :return:
+            False если буфер полон и сообщение отброшено.
+        """
+        tail = self._tail
+        depth = tail - self._head
+        if depth >= self.capacity:
+            self.dropped += 1
+            return False
+        self._slots[tail % self.capacity] = msg
+        self._tail = tail + 1
+        if depth + 1 > self.high_water:
+            self.high_water = depth + 1
+        self._ready.release()
+        return True
+
+    def get(self, timeout=None):
+        """
+        Забрать самое старое сообщение.
+
+        :param timeout:
+            Сколько ждать сообщения, секунд (None - бесконечно).
+        :return:
+            Сообщение или None по таймауту.
+        """
+        if not self._ready.acquire(timeout=timeout):
+            return None
+        with self._read_lock:
+            index = self._head % self.capacity
+            msg = self._slots[index]
+            self._slots[index] = None
+            self._head += 1
+        return msg
+
+    @property
+    def depth(self):
+        return self._tail - self._head
+
+    @property
+    def received(self):
+        return self._tail
+
+    def stats(self):
+        """
+        Статистика буфера: глубина, максимум глубины, принято, отброшено.
+        """
+        return {'depth': self.depth, 'high_water': self.high_water,
+                'received': self.received, 'dropped': self.dropped,
+                'capacity': self.capacity}
+
+
+class Dispatcher(object):
+    """
+    Рабочие потоки, разбирающие сообщения из RingBuffer.
+    С одним потоком сохраняется порядок сообщений, с несколькими - нет.
+    """
+
+    def __init__(self, handler, workers=1, capacity=65536):
+        """
+        :param handler:
+            Функция обработки сырого сообщения (разбор и вызов обработчика).
+        :param workers:
+            Количество рабочих потоков.
+        :param capacity:
+            Размер кольцевого буфера, сообщений.
+        """
+        self.handler = handler
+        self.buffer = RingBuffer(capacity)
+        self.errors = 0
+        self._running = False
+        self._threads = []
+        self._workers = workers
+
+    def start(self):
+        self._running = True
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._run, name="txml-dispatch-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        """
+        Остановить потоки, предварительно дообработав буфер.
+        """
+        self._running = False
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def put(self, msg):
+        return self.buffer.put(msg)
+
+    def _run(self):
+        buffer = self.buffer
+        while self._running or buffer.depth > 0:
+            msg = buffer.get(timeout=0.5)
+            if msg is None:
+                continue
+            try:
+                self.handler(msg)
+            except Exception:
+                self.errors += 1
+                log.exception(u"Message handler failed")
+
+    def stats(self):
+        result = self.buffer.stats()
+        result['errors'] = self.errors
+        return result
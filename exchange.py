@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+"""
+Имитатор биржи за FakeBackend: нагрузочное тестирование потока заявок без брокера.
+
+Принимает команды neworder, newstoporder, cancelorder, cancelstoporder и moveorder
+в том виде, в каком их формирует commands, ведет стакан по каждой бумаге
+с приоритетом цена-время и присылает в коллбэк <orders>, <trades>, <alltrades> и <quotes>.
+Сообщения доставляются отдельным потоком после ответа на команду, как у настоящего коннектора.
+
+Упрощения: все заявки - клиентские (обе стороны сделки свои), стоп-заявки срабатывают
+по цене последней сделки и исполняются по рынку или по orderprice, коррекция тейк-профита не учитывается.
+"""
+import threading, datetime, bisect, itertools, logging
+from collections import deque
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+import lxml.etree as et
+try:
+    from backend import FakeBackend
+    from serialize import escape_text
+except ImportError:
+    from .backend import FakeBackend
+    from .serialize import escape_text
+
+log = logging.getLogger("exchange")
+
+
+def _now():
+    # Время в формате Транзака с миллисекундами, в UTC (connect включает utc_time)
+    now = datetime.datetime.utcnow()
+    return now.strftime('%d.%m.%Y %H:%M:%S.') + '%03d' % (now.microsecond // 1000)
+
+
+def _escaped(value):
+    # Текст из команды (клиент, борд, код) для вставки в XML
+    return escape_text('%s' % value).decode('utf-8')
+
+
+def _text(elem, path, default=None):
+    child = elem.find(path)
+    return child.text if child is not None and child.text is not None else default
+
+
+class SimOrder(object):
+    """
+    Заявка в имитаторе.
+    """
+    __slots__ = ('id', 'order_no', 'secid', 'board', 'seccode', 'client', 'buysell', 'price', 'price_text',
+                 'quantity', 'balance', 'bymarket', 'status', 'time', 'withdraw_time')
+
+    def xml(self):
+        return ('<order transactionid="%d"><orderno>%d</orderno><secid>%d</secid><board>%s</board>'
+                '<seccode>%s</seccode><client>%s</client><status>%s</status><buysell>%s</buysell>'
+                '<time>%s</time><price>%s</price><quantity>%d</quantity><balance>%d</balance>'
+                '<withdrawtime>%s</withdrawtime></order>') % (
+            self.id, self.order_no, self.secid, _escaped(self.board), _escaped(self.seccode),
+            _escaped(self.client), self.status, self.buysell, self.time, self.price_text, self.quantity,
+            self.balance, self.withdraw_time)
+
+
+class SimStopOrder(object):
+    """
+    Стоп-заявка (stoploss или takeprofit) в имитаторе.
+    """
+    __slots__ = ('id', 'secid', 'board', 'seccode', 'client', 'buysell', 'kind', 'activation_price',
+                 'activation_text', 'price_text', 'quantity', 'active_order_no', 'status')
+
+    def triggered(self, price):
+        # Стоп-лосс на продажу и тейк-профит на покупку - при падении цены, остальные - при росте
+        if (self.kind == 'stoploss') == (self.buysell == 'S'):
+            return price <= self.activation_price
+        return price >= self.activation_price
+
+    def xml(self):
+        execution = '<orderprice>%s</orderprice>' % self.price_text if self.price_text else '<bymarket/>'
+        return ('<stoporder transactionid="%d"><activeorderno>%d</activeorderno><secid>%d</secid>'
+                '<board>%s</board><seccode>%s</seccode><client>%s</client><buysell>%s</buysell>'
+                '<status>%s</status><%s><activationprice>%s</activationprice><quantity>%d</quantity>'
+                '%s</%s></stoporder>') % (
+            self.id, self.active_order_no, self.secid, _escaped(self.board), _escaped(self.seccode),
+            _escaped(self.client), self.buysell, self.status, self.kind, self.activation_text, self.quantity,
+            execution, self.kind)
+
+
+class OrderBook(object):
+    """
+    Стакан одной бумаги: уровни цен в порядке возрастания, на уровне - очередь заявок по времени.
+    """
+
+    def __init__(self, secid, board, seccode):
+        self.secid = secid
+        self.board = board
+        self.seccode = seccode
+        # Экранированные для XML борд и код
+        self.board_text = _escaped(board)
+        self.seccode_text = _escaped(seccode)
+        # buysell -> отсортированный список цен и {цена: deque заявок}
+        self.prices = {'B': [], 'S': []}
+        self.levels = {'B': {}, 'S': {}}
+        self.last_price = None
+        self.last_text = None
+        # Стоп-заявки, ожидающие активации
+        self.stops = []
+        # Уровни, изменившиеся с последней выдачи котировок: (buysell, цена) -> текст цены
+        self.changed = {}
+
+    def add(self, order):
+        prices = self.prices[order.buysell]
+        levels = self.levels[order.buysell]
+        level = levels.get(order.price)
+        if level is None:
+            level = levels[order.price] = deque()
+            bisect.insort(prices, order.price)
+        level.append(order)
+        self.changed[(order.buysell, order.price)] = order.price_text
+
+    def remove(self, order):
+        level = self.levels[order.buysell].get(order.price)
+        if level is None or order not in level:
+            return False
+        level.remove(order)
+        if not level:
+            self._drop_level(order.buysell, order.price)
+        self.changed[(order.buysell, order.price)] = order.price_text
+        return True
+
+    def _drop_level(self, buysell, price):
+        del self.levels[buysell][price]
+        prices = self.prices[buysell]
+        del prices[bisect.bisect_left(prices, price)]
+
+    def best(self, buysell):
+        # Лучшая цена стороны: максимальная для покупки, минимальная для продажи
+        prices = self.prices[buysell]
+        if not prices:
+            return None
+        return prices[-1] if buysell == 'B' else prices[0]
+
+    def volume(self, buysell, price):
+        level = self.levels[buysell].get(price)
+        return sum(o.balance for o in level) if level else 0
+
+    def quotes_xml(self):
+        # Изменившиеся уровни стакана; -1 - уровень исчез
+        items = []
+        for (buysell, price), text in self.changed.items():
+            volume = self.volume(buysell, price) or -1
+            items.append('<quote secid="%d"><board>%s</board><seccode>%s</seccode><price>%s</price>'
+                         '<%s>%d</%s></quote>' % (self.secid, self.board_text, self.seccode_text, text,
+                                                  'buy' if buysell == 'B' else 'sell', volume,
+                                                  'buy' if buysell == 'B' else 'sell'))
+        self.changed = {}
+        return items
+
+
+class Exchange(FakeBackend):
+    """
+    FakeBackend с биржевым стаканом и исполнением заявок.
+    """
+
+    def __init__(self, securities=None, messages=(), rate=None, results=None, autostart=True):
+        """
+        :param securities:
+            Словарь {(board, seccode): secid}; неизвестным бумагам secid назначается по порядку.
+        Остальные параметры - как у FakeBackend.
+        """
+        super(Exchange, self).__init__(messages, rate, results, autostart)
+        self.securities = dict(securities or {})
+        self.books = {}
+        self.orders = {}
+        self.stop_orders = {}
+        # Статистика
+        self.matched = 0
+        self._order_no = itertools.count(1)
+        self._trade_no = itertools.count(1)
+        self._secids = itertools.count(max(self.securities.values() or [0]) + 1)
+        self._book_lock = threading.RLock()
+        self._outbox = Queue()
+        self._sender = None
+
+    # Доставка сообщений в коллбэк
+
+    def SetCallback(self, callback):
+        result = super(Exchange, self).SetCallback(callback)
+        if self._sender is None:
+            self._sender = threading.Thread(target=self._send, name="txml-exchange")
+            self._sender.daemon = True
+            self._sender.start()
+        return result
+
+    def UnInitialize(self):
+        if self._sender is not None:
+            self._outbox.put(None)
+            self._sender.join()
+            self._sender = None
+        return super(Exchange, self).UnInitialize()
+
+    def _send(self):
+        while True:
+            msg = self._outbox.get()
+            try:
+                if msg is None:
+                    break
+                self.push(msg)
+            except Exception:
+                log.exception(u"Callback failed")
+            finally:
+                self._outbox.task_done()
+
+    def wait_idle(self):
+        """
+        Дождаться доставки всех сообщений имитатора.
+        """
+        self._outbox.join()
+
+    def _emit(self, tag, items):
+        if items:
+            self._outbox.put(('<%s>%s</%s>' % (tag, ''.join(items), tag)).encode('utf8'))
+
+    # Команды
+
+    def _result(self, transaction_id):
+        return b'<result success="true" transactionid="%d"/>' % transaction_id
+
+    def _denied(self, text):
+        return (u'<result success="false"><message>%s</message></result>' % text).encode('utf8')
+
+    def _book(self, board, seccode):
+        book = self.books.get((board, seccode))
+        if book is None:
+            secid = self.securities.get((board, seccode))
+            if secid is None:
+                secid = self.securities[(board, seccode)] = next(self._secids)
+            book = self.books[(board, seccode)] = OrderBook(secid, board, seccode)
+        return book
+
+    def on_neworder(self, cmd):
+        root = et.fromstring(cmd)
+        with self._book_lock:
+            book = self._book(_text(root, 'security/board'), _text(root, 'security/seccode'))
+            price = _text(root, 'price')
+            order = self._new_order(book, _text(root, 'client'), _text(root, 'buysell'),
+                                    int(_text(root, 'quantity')), price)
+            self._process(book, [order])
+        return self._result(order.id)
+
+    def _new_order(self, book, client, buysell, quantity, price_text):
+        order = SimOrder()
+        order.id = self.next_transaction()
+        order.order_no = next(self._order_no)
+        order.secid, order.board, order.seccode = book.secid, book.board, book.seccode
+        order.client = client
+        order.buysell = buysell
+        order.bymarket = price_text is None
+        order.price_text = price_text or '0'
+        order.price = float(price_text) if price_text else 0.0
+        order.quantity = order.balance = quantity
+        order.status = 'active'
+        order.time = _now()
+        order.withdraw_time = '0'
+        self.orders[order.id] = order
+        return order
+
+    def on_newstoporder(self, cmd):
+        root = et.fromstring(cmd)
+        with self._book_lock:
+            book = self._book(_text(root, 'security/board'), _text(root, 'security/seccode'))
+            stop = SimStopOrder()
+            stop.id = self.next_transaction()
+            stop.secid, stop.board, stop.seccode = book.secid, book.board, book.seccode
+            stop.client = _text(root, 'client')
+            stop.buysell = _text(root, 'buysell')
+            spec = root.find('stoploss')
+            if spec is None:
+                spec = root.find('takeprofit')
+            if spec is None:
+                return self._denied(u'stoploss or takeprofit expected')
+            stop.kind = spec.tag
+            stop.activation_text = _text(spec, 'activationprice')
+            stop.activation_price = float(stop.activation_text)
+            stop.price_text = _text(spec, 'orderprice')
+            stop.quantity = int(_text(spec, 'quantity'))
+            stop.active_order_no = 0
+            stop.status = 'watching'
+            self.stop_orders[stop.id] = stop
+            book.stops.append(stop)
+            self._emit('orders', [stop.xml()])
+        return self._result(stop.id)
+
+    def on_cancelorder(self, cmd):
+        transaction_id = int(_text(et.fromstring(cmd), 'transactionid'))
+        with self._book_lock:
+            order = self.orders.get(transaction_id)
+            if order is None or order.status != 'active':
+                return self._denied(u'order %d not active' % transaction_id)
+            book = self.books[(order.board, order.seccode)]
+            book.remove(order)
+            self._withdraw(order)
+            self._emit('orders', [order.xml()])
+            self._emit('quotes', book.quotes_xml())
+        return b'<result success="true"/>'
+
+    def on_cancelstoporder(self, cmd):
+        transaction_id = int(_text(et.fromstring(cmd), 'transactionid'))
+        with self._book_lock:
+            stop = self.stop_orders.get(transaction_id)
+            if stop is None or stop.status != 'watching':
+                return self._denied(u'stop order %d not active' % transaction_id)
+            self.books[(stop.board, stop.seccode)].stops.remove(stop)
+            stop.status = 'cancelled'
+            self._emit('orders', [stop.xml()])
+        return b'<result success="true"/>'
+
+    def on_moveorder(self, cmd):
+        # Как на FORTS: старая заявка снимается, новая получает новый transactionid и теряет приоритет
+        root = et.fromstring(cmd)
+        transaction_id = int(_text(root, 'transactionid'))
+        moveflag = int(_text(root, 'moveflag', '0'))
+        quantity = int(_text(root, 'quantity', '0'))
+        with self._book_lock:
+            order = self.orders.get(transaction_id)
+            if order is None or order.status != 'active' or order.bymarket:
+                return self._denied(u'order %d not active' % transaction_id)
+            book = self.books[(order.board, order.seccode)]
+            if moveflag == 2 and quantity != order.balance:
+                book.remove(order)
+                self._withdraw(order)
+                self._emit('orders', [order.xml()])
+                self._emit('quotes', book.quotes_xml())
+                return b'<result success="true"/>'
+            book.remove(order)
+            self._withdraw(order)
+            moved = self._new_order(book, order.client, order.buysell,
+                                    quantity if moveflag == 1 else order.balance, _text(root, 'price'))
+            self._process(book, [moved], [order.xml()])
+        return self._result(moved.id)
+
+    def _withdraw(self, order):
+        order.status = 'cancelled'
+        order.withdraw_time = _now()
+
+    # Исполнение
+
+    def _process(self, book, orders, order_items=None):
+        # Исполнить заявки (и сработавшие из-за них стопы) и выдать сообщения
+        order_items = order_items or []
+        trade_items, client_items = [], []
+        pending = deque(orders)
+        while pending:
+            order = pending.popleft()
+            touched = self._match(book, order, trade_items, client_items)
+            if order.balance and order.status == 'active':
+                if order.bymarket:
+                    # Неисполненный остаток рыночной заявки снимается
+                    self._withdraw(order)
+                else:
+                    book.add(order)
+            elif not order.balance:
+                order.status = 'matched'
+            order_items.extend(o.xml() for o in touched)
+            order_items.append(order.xml())
+            if touched:
+                pending.extend(self._trigger_stops(book, order_items))
+        self._emit('orders', order_items)
+        self._emit('trades', client_items)
+        self._emit('alltrades', trade_items)
+        self._emit('quotes', book.quotes_xml())
+
+    def _match(self, book, order, trade_items, client_items):
+        # Сведение заявки со встречной стороной по цене-времени, возвращает задетые встречные заявки
+        opposite = 'S' if order.buysell == 'B' else 'B'
+        levels = book.levels[opposite]
+        touched = []
+        while order.balance:
+            price = book.best(opposite)
+            if price is None:
+                break
+            if not order.bymarket and (price > order.price if order.buysell == 'B' else price < order.price):
+                break
+            level = levels[price]
+            resting = level[0]
+            quantity = min(order.balance, resting.balance)
+            order.balance -= quantity
+            resting.balance -= quantity
+            if not resting.balance:
+                resting.status = 'matched'
+                level.popleft()
+                if not level:
+                    book._drop_level(opposite, price)
+            book.changed[(opposite, price)] = resting.price_text
+            if resting not in touched:
+                touched.append(resting)
+            self._trade(book, order, resting, quantity, trade_items, client_items)
+        return touched
+
+    def _trade(self, book, order, resting, quantity, trade_items, client_items):
+        trade_no = next(self._trade_no)
+        time = _now()
+        price_text = resting.price_text
+        book.last_price, book.last_text = resting.price, price_text
+        self.matched += 1
+        trade_items.append('<trade secid="%d"><tradeno>%d</tradeno><board>%s</board><time>%s</time>'
+                           '<price>%s</price><quantity>%d</quantity><buysell>%s</buysell>'
+                           '<seccode>%s</seccode><period>N</period></trade>' % (
+                               book.secid, trade_no, book.board_text, time, price_text, quantity,
+                               order.buysell, book.seccode_text))
+        for side in (order, resting):
+            client_items.append('<trade><secid>%d</secid><tradeno>%d</tradeno><orderno>%d</orderno>'
+                                '<board>%s</board><seccode>%s</seccode><client>%s</client>'
+                                '<buysell>%s</buysell><time>%s</time><price>%s</price>'
+                                '<quantity>%d</quantity><value>%s</value></trade>' % (
+                                    book.secid, trade_no, side.order_no, book.board_text, book.seccode_text,
+                                    _escaped(side.client), side.buysell, time, price_text, quantity,
+                                    repr(resting.price * quantity)))
+
+    def _trigger_stops(self, book, order_items):
+        # Стопы, сработавшие по цене последней сделки, превращаются в заявки
+        if not book.stops or book.last_price is None:
+            return []
+        orders = []
+        for stop in [s for s in book.stops if s.triggered(book.last_price)]:
+            book.stops.remove(stop)
+            order = self._new_order(book, stop.client, stop.buysell, stop.quantity, stop.price_text)
+            stop.active_order_no = order.order_no
+            stop.status = 'sl_executed' if stop.kind == 'stoploss' else 'tp_executed'
+            order_items.append(stop.xml())
+            orders.append(order)
+        return orders
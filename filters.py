@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Отбор бумаг для подписки.
+
+Бумага задается полным именем board:seccode (пробелы в seccode заменяются точками).
+Все шаблоны fnmatch компилируются в одно регулярное выражение, списки include/exclude
+хранятся множествами, исключение по подстроке наименования - тоже одним выражением.
+Решение кэшируется по (board, seccode), так что повторный пакет securities
+при переподключении проверяется за время поиска в словаре.
+"""
+import re, os, fnmatch
+
+# Причины решения
+INCLUDE, EXCLUDE, NAME, PATTERN = 'include', 'exclude', 'name', 'pattern'
+_unknown = object()
+
+
+def full_name(board, seccode):
+    return board + ':' + seccode.replace(" ", ".")
+
+
+class SecurityFilter(object):
+    """
+    Скомпилированный фильтр бумаг.
+    Порядок проверок: include, exclude, подстроки наименования, шаблоны.
+    """
+
+    def __init__(self, patterns, include=(), exclude=(), exclude_names=()):
+        """
+        :param patterns:
+            Шаблоны fnmatch для полного имени (например "MCT:FUT*").
+        :param include:
+            Полные имена, подписываемые всегда.
+        :param exclude:
+            Полные имена, не подписываемые по шаблонам.
+        :param exclude_names:
+            Подстроки наименования бумаги, исключающие ее из подписки по шаблонам.
+        """
+        self.include = frozenset(include)
+        self.exclude = frozenset(exclude)
+        # Как fnmatch.fnmatch: имя и шаблон приводятся os.path.normcase
+        self._pattern_re = re.compile('|'.join('(?:%s)' % fnmatch.translate(os.path.normcase(p))
+                                               for p in patterns)) if patterns else None
+        self._name_re = re.compile('|'.join(re.escape(n) for n in exclude_names)) if exclude_names else None
+        # (board, seccode) -> причина или None
+        self._cache = {}
+        # Статистика
+        self.hits = 0
+        self.misses = 0
+        self.counts = dict.fromkeys((INCLUDE, EXCLUDE, NAME, PATTERN, None), 0)
+
+    def classify(self, board, seccode, name=''):
+        """
+        Причина решения по бумаге.
+
+        :return:
+            INCLUDE, EXCLUDE, NAME, PATTERN или None (не подходит).
+        """
+        key = (board, seccode)
+        try:
+            reason = self._cache[key]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            reason = self._cache[key] = self._decide(full_name(board, seccode), name)
+        self.counts[reason] += 1
+        return reason
+
+    def _decide(self, sec_full_name, name):
+        if sec_full_name in self.include:
+            return INCLUDE
+        if sec_full_name in self.exclude:
+            return EXCLUDE
+        if self._name_re is not None and self._name_re.search(name or ''):
+            return NAME
+        if self._pattern_re is not None and self._pattern_re.match(os.path.normcase(sec_full_name)):
+            return PATTERN
+        return None
+
+    def match(self, security, subscribed=()):
+        """
+        Подписывать ли бумагу: из include - всегда, по шаблону - если еще не подписана.
+
+        :param security:
+            Объект Security.
+        :param subscribed:
+            Уже подписанные secid.
+        """
+        board, seccode = security.board, security.seccode
+        reason = self._cache.get((board, seccode), _unknown)
+        if reason is _unknown:
+            # Наименование читается только при первой встрече бумаги
+            reason = self.classify(board, seccode, security.name)
+        else:
+            self.hits += 1
+            self.counts[reason] += 1
+        return reason == INCLUDE or (reason == PATTERN and security.secid not in subscribed)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def stats(self):
+        """
+        Статистика: попадания в кэш, промахи, количество решений по причинам.
+        """
+        result = {'cache_hits': self.hits, 'cache_misses': self.misses, 'cached': len(self._cache)}
+        for reason, count in self.counts.items():
+            result[reason or 'no_match'] = count
+        return result
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Журнал сделок: буферизованная дозапись строк или компактных двоичных записей.
+
+Ротация как у logging.handlers.TimedRotatingFileHandler(when='midnight'): запись всегда идет
+в msg_path, в полночь (местное время) файл переименовывается в msg_path.YYYY-MM-DD
+(дата закончившегося дня). Файл, оставшийся от прошлого дня, ротируется при первой записи.
+
+Текстовый формат - строки сделок ATSD (см. lines.TradeFormatter), по одной на строку.
+Двоичный формат - заголовок b'TQJ1' и записи:
+
+* S - бумага: secid, длина, "board seccode" в utf-8 (перед первой сделкой по ней в файле);
+* D - сделка с ценой-строкой: secid, номер, время в мс, сторона, количество,
+  цена целым числом и количество знаков после точки - строка восстанавливается без изменений;
+  целая цена режима фиксированной точки пишется так же, с количеством знаков бумаги;
+* T - сделка с ценой float, поля как у D без знаков.
+
+Целая цена по бумаге, для которой количество знаков не задано (TradeFormatter.register),
+не записывается ни в одном формате (ValueError).
+
+Данные сбрасываются в файл раз в flush_interval секунд и при flush(), fsync - при ротации и закрытии.
+Недописанный при сбое хвост файла (запись или строка) отрезается при открытии,
+так что после перезапуска новые записи идут сразу за последней целой.
+"""
+import os, time, struct, threading, logging
+try:
+    from lines import TradeFormatter
+except ImportError:
+    from .lines import TradeFormatter
+
+log = logging.getLogger("journal")
+
+MAGIC = b'TQJ1'
+_security = struct.Struct('<cIH')
+_decimal = struct.Struct('<cIQqcqqB')
+_float = struct.Struct('<cIQqcqd')
+_formats = {b'D': _decimal, b'T': _float}
+# Пустые значения полей в двоичной записи
+_null = -2 ** 63
+_no_side = b' '
+_sides = {'B': b'B', 'S': b'S'}
+
+
+def _next_midnight(t):
+    lt = time.localtime(t)
+    return time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+
+def _pack_trade(trade, formatter):
+    secid, trade_id, millis, board, seccode, buysell, quantity, price = trade
+    side = _sides.get(buysell, _no_side)
+    if millis is None:
+        millis = _null
+    if quantity is None:
+        quantity = _null
+    if isinstance(price, str):
+        whole, _, fraction = price.partition('.')
+        try:
+            return _decimal.pack(b'D', secid, trade_id, millis, side, quantity, int(whole + fraction), len(fraction))
+        except (ValueError, struct.error):
+            # Экспонента и прочие нестандартные записи - через float
+            try:
+                price = float(price)
+            except ValueError:
+                price = None
+    if price.__class__ is int:
+        return _decimal.pack(b'D', secid, trade_id, millis, side, quantity, price,
+                             len(formatter.price_text(secid, price).partition('.')[2]))
+    return _float.pack(b'T', secid, trade_id, millis, side, quantity, float('nan') if price is None else price)
+
+
+def _records(data):
+    # Записи двоичного журнала после заголовка: (тег, значения, позиция за записью).
+    # Разбор останавливается на недописанной или неизвестной записи.
+    pos, end = len(MAGIC), len(data)
+    while pos < end:
+        tag = data[pos:pos + 1]
+        if tag == b'S':
+            if pos + _security.size > end:
+                return
+            _, secid, size = _security.unpack_from(data, pos)
+            stop = pos + _security.size + size
+            if stop > end:
+                return
+            yield tag, (secid, data[pos + _security.size:stop]), stop
+        else:
+            record = _formats.get(tag)
+            if record is None or pos + record.size > end:
+                return
+            stop = pos + record.size
+            yield tag, record.unpack_from(data, pos), stop
+        pos = stop
+
+
+def _complete_length(path, binary):
+    # Длина файла без недописанного хвоста
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not binary:
+        return data.rfind(b'\n') + 1
+    if not data.startswith(MAGIC):
+        if MAGIC.startswith(data):
+            return 0
+        raise ValueError("%s is not a binary trade journal" % path)
+    stop = len(MAGIC)
+    for _, _, stop in _records(data):
+        pass
+    return stop
+
+
+def _decimal_text(value, scale):
+    # Целое и количество знаков -> строка цены
+    if not scale:
+        return str(value)
+    digits = str(abs(value)).rjust(scale + 1, '0')
+    return ('-' if value < 0 else '') + digits[:-scale] + '.' + digits[-scale:]
+
+
+class TradeJournal(object):
+    """
+    Журнал сделок с суточной ротацией.
+    """
+
+    def __init__(self, path, binary=False, buffer_size=1024 * 1024, flush_interval=1.0, formatter=None):
+        """
+        :param path:
+            Путь к файлу журнала (msg_path).
+        :param binary:
+            Двоичный формат вместо строк.
+        :param buffer_size:
+            Размер буфера файла, байт.
+        :param flush_interval:
+            Как часто сбрасывать буфер в файл, секунд.
+        :param formatter:
+            lines.TradeFormatter с зарегистрированными бумагами (количество знаков для целых цен).
+        """
+        self.path = path
+        self.binary = binary
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._file = None
+        # secid, уже описанные в текущем двоичном файле
+        self._described = set()
+        self._rollover = 0
+        self._flushed = 0
+        self._lock = threading.Lock()
+        self._formatter = formatter or TradeFormatter()
+        # Статистика
+        self.trades = 0
+        self.rotations = 0
+
+    def _open(self):
+        exists = os.path.exists(self.path)
+        # Время изменения - до обрезки хвоста, по нему файл прошлого дня ротируется
+        self._rollover = _next_midnight(os.stat(self.path).st_mtime if exists else time.time())
+        if exists:
+            self._truncate_tail()
+        self._file = open(self.path, 'ab', self.buffer_size)
+        self._described = set()
+        if self.binary and self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def _truncate_tail(self):
+        size = os.path.getsize(self.path)
+        length = _complete_length(self.path, self.binary)
+        if length < size:
+            log.warning(u"Truncated %d bytes of an incomplete record at the end of %s" % (size - length, self.path))
+            with open(self.path, 'r+b') as f:
+                f.truncate(length)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def _rotate(self):
+        # Имя - дата закончившегося дня, существующий файл с этим именем заменяется
+        suffix = time.strftime('%Y-%m-%d', time.localtime(self._rollover - 1))
+        self._close_file()
+        os.replace(self.path, self.path + '.' + suffix)
+        self.rotations += 1
+        self._open()
+
+    def write(self, trades, lines=None):
+        """
+        Дописать сделки.
+
+        :param trades:
+            Кортежи (secid, id, time_millis, board, seccode, buysell, quantity, price).
+        :param lines:
+            Уже готовые строки этих сделок в байтах (для текстового формата).
+        """
+        now = time.time()
+        with self._lock:
+            if self._file is None:
+                self._open()
+            if now >= self._rollover:
+                self._rotate()
+            if self.binary:
+                self._file.write(self._pack_many(trades))
+            else:
+                if lines is None:
+                    lines = [self._formatter.format(trade) for trade in trades]
+                self._file.write(b'\n'.join(lines) + b'\n')
+            self.trades += len(trades)
+            if now - self._flushed >= self.flush_interval:
+                self._file.flush()
+                self._flushed = now
+
+    def _pack_many(self, trades):
+        described = self._described
+        pack_decimal, sides = _decimal.pack, _sides
+        records = []
+        append = records.append
+        for trade in trades:
+            secid, trade_id, millis, board, seccode, buysell, quantity, price = trade
+            if secid not in described:
+                described.add(secid)
+                name = ('%s %s' % (board, seccode)).encode('utf-8')
+                append(_security.pack(b'S', secid, len(name)) + name)
+            # Обычная сделка с ценой строкой - без лишних проверок, остальное - в _pack_trade
+            try:
+                whole, _, fraction = price.partition('.')
+                append(pack_decimal(b'D', secid, trade_id, millis, sides[buysell], quantity,
+                                    int(whole + fraction), len(fraction)))
+            except (AttributeError, KeyError, ValueError, TypeError, struct.error):
+                append(_pack_trade(trade, self._formatter))
+        return b''.join(records)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._flushed = time.time()
+
+    def close(self):
+        with self._lock:
+            self._close_file()
+
+    def stats(self):
+        return {'trades': self.trades, 'rotations': self.rotations, 'binary': self.binary}
+
+
+def read_journal(path):
+    """
+    Прочитать двоичный журнал (файл читается целиком). Недописанная при сбое запись пропускается.
+
+    :return:
+        Генератор кортежей (secid, id, time_millis, board, seccode, buysell, quantity, price).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("%s is not a binary trade journal" % path)
+    names = {}
+    stop = len(MAGIC)
+    for tag, values, stop in _records(data):
+        if tag == b'S':
+            names[values[0]] = values[1].decode('utf-8').split(' ', 1)
+            continue
+        secid, trade_id, millis, side, quantity, price = values[1:7]
+        if tag == b'D':
+            price = _decimal_text(price, values[7])
+        elif price != price:
+            price = None
+        board, seccode = names[secid]
+        yield (secid, trade_id, None if millis == _null else millis, board, seccode,
+               None if side == _no_side else side.decode('ascii'),
+               None if quantity == _null else quantity, price)
+    if stop < len(data):
+        tag = data[stop:stop + 1]
+        if tag != b'S' and tag not in _formats:
+            raise ValueError("Bad record %r at %s in %s" % (tag, stop, path))
+        log.warning(u"Truncated record in %s" % path)
+
+
+def export_csv(path, out_path, exchange='transaq'):
+    """
+    Выгрузить двоичный журнал в строки сделок, как в текстовом журнале.
+
+    :return:
+        Количество сделок.
+    """
+    formatter = TradeFormatter(exchange)
+    count = 0
+    with open(out_path, 'wb') as out:
+        for trade in read_journal(path):
+            out.write(formatter.format(trade) + b'\n')
+            count += 1
+    return count
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Строки сделок для ATSD.
+
+Формат строки: trade_num,time_ms,microsecond,class,code,exchange,side,quantity,price,order.
+Постоянная часть (0,class,code,exchange) готовится один раз на secid при подписке,
+на каждую сделку в байты дописываются только ее поля. Номер сделки выводится целым
+без перевода во float, поэтому большие номера не округляются.
+Цена-строка из пакета (Trade.price) выводится как есть, целая цена режима фиксированной точки -
+текстом с количеством знаков бумаги (prices.format_ticks), заданным при регистрации.
+"""
+try:
+    from prices import format_ticks
+except ImportError:
+    from .prices import format_ticks
+
+# Сторона сделки -> байты
+_sides = {'B': b'B', 'S': b'S'}
+
+
+def trade_records(trades):
+    """
+    Компактные записи сделок для очереди вывода.
+
+    :param trades:
+        Сделки пакета alltrades (Trade или TradeRecord).
+    :return:
+        Список кортежей (secid, id, time_millis, board, seccode, buysell, quantity, price).
+    """
+    return [(t.secid, t.id, t.time_millis, t.board, t.seccode, t.buysell, t.quantity, t.price) for t in trades]
+
+
+class TradeFormatter(object):
+    """
+    Форматирование сделок с кэшем постоянной части строки по secid.
+    """
+
+    def __init__(self, exchange='transaq'):
+        """
+        :param exchange:
+            Значение поля exchange.
+        """
+        self.exchange = exchange
+        # secid -> b',0,class,code,exchange,'
+        self._static = {}
+        # secid -> количество знаков цены (для целых цен)
+        self.decimals = {}
+        # Статистика
+        self.misses = 0
+        self.slow = 0
+
+    def register(self, secid, board, seccode, decimals=None):
+        """
+        Подготовить постоянную часть строки для бумаги (при подписке или изменении бумаги).
+
+        :param decimals:
+            Количество знаков цены (Security.decimals), нужно для целых цен.
+        """
+        self._static[secid] = (',0,%s,%s,%s,' % (board, seccode.replace(" ", "."), self.exchange)).encode('utf-8')
+        if decimals is not None:
+            self.decimals[secid] = decimals
+
+    def clear(self):
+        """
+        Забыть зарегистрированные бумаги (secid в новой сессии могут измениться).
+        """
+        self._static.clear()
+        self.decimals.clear()
+
+    def price_text(self, secid, ticks):
+        """
+        Целая цена в текст с количеством знаков бумаги.
+
+        :raise ValueError:
+            Если количество знаков бумаги неизвестно.
+        """
+        decimals = self.decimals.get(secid)
+        if decimals is None:
+            raise ValueError("No decimals for secid %s, fixed-point price %d cannot be formatted" % (secid, ticks))
+        return format_ticks(ticks, decimals)
+
+    def format(self, trade):
+        """
+        :param trade:
+            Кортеж (secid, id, time_millis, board, seccode, buysell, quantity, price).
+        :return:
+            Строка в байтах, без перевода строки.
+        :raise ValueError:
+            Целая цена по бумаге без количества знаков.
+        """
+        secid, trade_id, millis, board, seccode, buysell, quantity, price = trade
+        static = self._static.get(secid)
+        if static is None:
+            self.misses += 1
+            self.register(secid, board, seccode)
+            static = self._static[secid]
+        if price.__class__ is int:
+            price = self.price_text(secid, price)
+        try:
+            # Строка из пакета, иначе - медленный путь
+            price_bytes = price.encode('ascii') if isinstance(price, str) else None
+            return b'%d,%d%s%s,%d,%s,' % (trade_id, millis, static, _sides[buysell], quantity, price_bytes)
+        except (TypeError, KeyError, AttributeError, UnicodeEncodeError):
+            # Пустые поля и нестроковая цена выводятся как прежде, через str
+            self.slow += 1
+            trade_id = '%d' % trade_id if isinstance(trade_id, int) else '%.0f' % trade_id
+            return ('%s,%s%s%s,%s,%s,' % (trade_id, millis, static.decode('utf-8'), buysell, quantity, price)).encode('utf-8')
+
+    def stats(self):
+        return {'securities': len(self._static), 'misses': self.misses, 'slow': self.slow}
@@ -1,9 +1,14 @@
 from commands import *
 from structures import *
 from configparser import ConfigParser
-from atsd_client._time_utilities import to_milliseconds
 import os, time, socket, logging, logging.config, datetime, csv, re
-import fnmatch
+from subscriptions import SubscriptionManager
+from filters import SecurityFilter, full_name
+from secmaster import SecurityMaster, SecurityRecord
+from sinks import UdpSink, TcpSink
+from output import OutputStage
+from lines import TradeFormatter, trade_records
+from journal import TradeJournal
 
 class Config:
 
@@ -28,18 +33,38 @@ class Config:
             self.include_securities = t_config["include_securities"].split(",")        
         if "exclude_securities" in t_config:
             self.exclude_securities = t_config["exclude_securities"].split(",")
+        # optional directory for raw inbound stream capture
+        self.capture_path = t_config.get("capture_path")
+        # optional file for the security master, enables subscribing right after connect
+        self.security_cache = t_config.get("security_cache")
 
         atsd_config = config_parser["ATSD"]
         self.atsd_host = atsd_config["host"]
         self.cmd_port = int(atsd_config["cmd_port"])
-        self.cmd_protocol = atsd_config["cmd_protocol"]  # only UDP is supported at the moment
+        self.cmd_protocol = atsd_config["cmd_protocol"]  # UDP or TCP
         self.trades_port = int(atsd_config["trades_port"])
-        self.trades_protocol = atsd_config["trades_protocol"] # only UDP is supported at the moment
+        self.trades_protocol = atsd_config["trades_protocol"] # UDP or TCP
         self.trade_cmd_path = atsd_config["cmd_path"]
         self.trade_msg_path = atsd_config["msg_path"]
+        # trade journal format: csv lines or compact binary records (see journal.export_csv)
+        self.msg_format = atsd_config.get("msg_format", "csv")
+        # max datagram payload, trade lines and commands are batched up to this size
+        self.udp_mtu = int(atsd_config.get("udp_mtu", 1400))
+        # trades queued for the output thread and what to do when the queue is full: block, drop_oldest or spill
+        self.output_queue_size = int(atsd_config.get("output_queue_size", 100000))
+        self.output_overflow = atsd_config.get("output_overflow", "block")
+        self.output_spill_path = atsd_config.get("output_spill_path")
 
 subscribed_ids = {}
+# (board, seccode) subscribed from the security master before the securities packet, secids may differ between sessions
+warm_subscribed = set()
+# desired subscriptions survive reconnects, only the diff is sent to the server
+subscriptions = SubscriptionManager()
 config = Config()
+# decode alltrades into slotted records, callback copies the fields trade lines need
+set_fast_trades()
+# walk securities as they are decoded instead of building the whole packet
+set_streaming_securities()
 connector_ready = False
 trade_cmd_file = None
 trade_msg_file = None
@@ -63,15 +88,22 @@ log.setLevel(logging.DEBUG)
 log.addHandler(file_handler)
 log.addHandler(stdout_handler)
 
-trade_msg_handler = logging.handlers.TimedRotatingFileHandler(config.trade_msg_path, encoding="UTF-8", when = 'midnight')
-trade_msg_handler.setFormatter(logging.Formatter(fmt='%(message)s'))
-trade_msg_log = logging.getLogger("trade_msg")
-trade_msg_log.propagate = False
-trade_msg_log.addHandler(trade_msg_handler)
-#trade_msg_log.info('trade_num,time,microsecond,class,code,exchange,side,quantity,price,order')
+#trade_num,time,microsecond,class,code,exchange,side,quantity,price,order
 
 log.info('logging to main: %s msg: %s cmd: %s' % (config.log_path + '/main.log', config.trade_msg_path, config.trade_cmd_path))
 
+def make_sink(protocol, port):
+    # long-lived sockets, lines are batched and flushed on size or timer
+    protocol = protocol.strip().upper()
+    if protocol == 'TCP':
+        return TcpSink((config.atsd_host, port))
+    if protocol == 'UDP':
+        return UdpSink((config.atsd_host, port), config.udp_mtu)
+    raise ValueError("Expected UDP or TCP protocol, found " + protocol)
+
+trades_sink = make_sink(config.trades_protocol, config.trades_port)
+cmd_sink = make_sink(config.cmd_protocol, config.cmd_port)
+
 msk_timezone = datetime.timezone(datetime.timedelta(hours=3))
 trade_start_time = datetime.time( 9,  0,  0, tzinfo=msk_timezone)
 trade_end_time   = datetime.time(23, 59,  0, tzinfo=msk_timezone)
@@ -82,26 +114,32 @@ def to_message_command(severity, stage, text):
 def to_news_command(news):
     return "message e:transaq t:type=transaq-news t:source=\"%s\" t:news_id=\"%s\" t:news_time=\"%s\" t:publisher=\"%s\" m:\"%s\"" % (config.t_login, news.id, news.time, news.source, news.title.strip().replace("\"", "'"))
 
-def process_trade(trade):
-    # trade_datetime = str(trade.time) + " " + subscribed_ids[trade.secid]
-    trade_datetime = str(trade.time) + " UTC"
-    trade_millis = int(to_milliseconds(trade_datetime))
-    scode = trade.seccode.replace(" ", ".")
-    #msg_cmd = "%.0f,%s,%s,%s,%s,%s,%s,%s" % (trade.id, trade.board, scode, str(trade.time), trade_millis, trade.quantity, trade.price, trade.buysell)
-    #trade_msg_log.info(msg_cmd)
-    exchange = "transaq"
-    net_cmd = "%.0f,%s,%s,%s,%s,%s,%s,%s,%s,%s" % (trade.id, trade_millis, 0, trade.board, scode, exchange, trade.buysell, trade.quantity, trade.price, "")
-    trade_msg_log.info(net_cmd)
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.sendto(bytes(net_cmd, encoding='utf-8'), (config.atsd_host, config.trades_port))
+# static part of trade lines is prepared once per subscribed secid
+trade_formatter = TradeFormatter("transaq")
+# buffered appends, rotated at midnight into msg_path.YYYY-MM-DD like the logging handler it replaces
+trade_journal = TradeJournal(config.trade_msg_path, config.msg_format.strip().lower() == 'binary',
+                             formatter=trade_formatter)
+
+def write_trades(trades):
+    # compact records queued by callback, time is UTC (utc_time=true on connect) epoch millis
+    lines = [trade_formatter.format(trade) for trade in trades]
+    trades_sink.send_many(lines)
+    # a journal failure must not cost ATSD the batch
+    try:
+        trade_journal.write(trades, lines)
+    except Exception:
+        log.exception('trade journal write failed')
+
+# file writes and ATSD sends run on the output thread, callback only queues trades
+output_stage = OutputStage(write_trades, config.output_queue_size, config.output_overflow.strip().lower(),
+                           config.output_spill_path or config.log_path)
 
 def send_command(command):
     log.info(command)
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.sendto(bytes(command, encoding='utf-8'), (config.atsd_host, config.cmd_port))
+    cmd_sink.send(command)
 
 def to_entity_command(security):
-    if not isinstance(security, Security):
+    if not isinstance(security, (Security, SecurityRecord)):
         raise TypeError("Expected Security type, found " + str(type(security)))
     scode = security.seccode.replace(" ", ".")
     entity_name = ("%s_[%s]" % (scode, security.board)).lower()
@@ -128,35 +166,58 @@ def to_entity_command(security):
 
     return command
 
-def is_currency_futures(security):
-    cpairs = ["MXNUSD", "AUDUSD", "CADUSD", "CHFUSD", "EURUSD", "GBPUSD", "JPYUSD"]
-    for cp in cpairs:
-        if cp in security.name:
-            return True
-    return False
+# currency futures are skipped by name
+currency_pairs = ["MXNUSD", "AUDUSD", "CADUSD", "CHFUSD", "EURUSD", "GBPUSD", "JPYUSD"]
+security_filter = SecurityFilter(config.subscribe_patterns, config.include_securities,
+                                 config.exclude_securities, currency_pairs)
+security_master = SecurityMaster(config.security_cache)
+
+def warm_start():
+    # subscribe to cached securities without waiting for the securities packet,
+    # by (board, seccode) since cached secids are only confirmed by the live packet
+    loaded = security_master.load()
+    for security in security_master:
+        if security_filter.match(security):
+            key = (security.board, security.seccode)
+            warm_subscribed.add(key)
+            subscriptions.want([key])
+            send_command(to_entity_command(security))
+    log.info('security master: %s securities loaded from %s, %s subscribed' % (loaded, config.security_cache, len(warm_subscribed)))
+
+def save_security_master():
+    try:
+        security_master.save()
+    except Exception:
+        log.exception('security master save failed')
 
 def callback(msg):
     if isinstance(msg, TradePacket):
-        for trade in msg.items:
-            process_trade(trade)
+        output_stage.put_many(trade_records(msg.items))
     elif isinstance(msg, SecurityPacket):
-        log.info('security packet: %s' % (len(msg.items)))
+        sec_count = 0
         for security in msg.items:
+            sec_count += 1
             # .replace(" ", "_")
-            sec_full_name = security.board + ':' + security.seccode.replace(" ", ".")
-            match_sec = sec_full_name in config.include_securities
-            gen = (sec for sec in config.subscribe_patterns if match_sec == False)
-            if match_sec == False and security.secid not in subscribed_ids.keys() and sec_full_name not in config.exclude_securities and not is_currency_futures(security):
-                for sc in gen:
-                    match_sec = match_sec or fnmatch.fnmatch(sec_full_name, sc)
+            sec_status = security_master.update(security)
+            known = security.secid in subscribed_ids
+            match_sec = security_filter.match(security, subscribed_ids)
             # log.info('security seccode: %s board: %s market: %s mat: %s' % (security.seccode, security.board, security.market, match_sec) )
-            if match_sec:
+            # entity is sent for new subscriptions and for changed securities only
+            warm = (security.board, security.seccode) in warm_subscribed
+            if (match_sec and not known) or (known and sec_status):
                 subscribed_ids[security.secid] = security.timezone
+                # by (board, seccode): secids may be rebound in the next session
+                subscriptions.want([(security.board, security.seccode)])
+                trade_formatter.register(security.secid, security.board, security.seccode, security.decimals)
+                if warm and not sec_status:
+                    # entity was sent by warm_start
+                    continue
                 ecmd = to_entity_command(security)
                 send_command(ecmd)
                 log.info("Enable subscription id: %s seccode: %s board: %s market: %s\n\t%s" % (str(security.secid), security.seccode, security.board, security.market, ecmd))
             elif security.market != 1 and security.market != 4 and security.market != 7 and security.market != 15 and security.market != 8:
-                log.debug('no-sub: id: %s market: %s board: %s seccode: %s sectype: %s name: %s currency: %s fname: %s' % (str(security.secid), security.market, security.board, security.seccode, security.sectype, security.name, str(security.currency), sec_full_name))    
+                log.debug('no-sub: id: %s market: %s board: %s seccode: %s sectype: %s name: %s currency: %s fname: %s' % (str(security.secid), security.market, security.board, security.seccode, security.sectype, security.name, str(security.currency), full_name(security.board, security.seccode)))    
+        log.info('security packet: %s filter: %s master: %s' % (sec_count, security_filter.stats(), security_master.stats()))
     elif isinstance(msg, ServerStatus):
         if msg.connected == "true":
             global connector_ready
@@ -171,11 +232,6 @@ def callback(msg):
     elif isinstance(msg, CandleKindPacket):
         for itm in msg.items:
             log.info('Candle id: %s name: %s period: %s' % (itm.id, itm.name, itm.period) )
-    elif isinstance(msg, SecInfoUpdate):
-        if False: log.debug('SecInfoUpdate secid: %s seccode: %s market: %s minprice: %s maxprice: %s' % (msg.secid, msg.seccode, msg.market, msg.minprice, msg.maxprice)) 
-    elif isinstance(msg, SecurityPitPacket):
-        for itm in msg.items:
-            if False: log.debug('SecurityPitPacket board: %s seccode: %s market: %s lotsize: %s minstep: %s' % (itm.board, itm.seccode, itm.market, itm.lotsize, itm.minstep)) 
     elif isinstance(msg, ClientAccount):
         log.info('ClientAccount id: %s active: %s type: %s currency: %s market: %s union: %s' % (msg.id, msg.active, msg.type, msg.currency, msg.market, msg.union) )
     elif isinstance(msg, CreditAbility):
@@ -183,8 +239,8 @@ def callback(msg):
     elif isinstance(msg, NewsHeader):
         log.info('NewsHeader id: %s time: %s source: %s title: %s' % (msg.id, msg.time, msg.source, msg.title) )
         send_command(to_news_command(msg))
-        # get news text
-        get_news_text(msg.id)
+        # get news text, queued behind orders and paced by rqdelay
+        schedule(get_news_text, msg.id)
     elif isinstance(msg, NewsBody):
         log.debug('NewsBody id: %s text: \n%s' % (msg.id, msg.text) )     
     elif isinstance(msg, MarketPacket):
@@ -199,9 +255,19 @@ def callback(msg):
     else:
         log.debug('msg received of type %s' % str(type(msg)))
 
+# message types handled by callback, the rest is dropped before parsing
+callback_interests = [TradePacket, SecurityPacket, ServerStatus, CandleKindPacket, ClientAccount,
+                      CreditAbility, NewsHeader, NewsBody, MarketPacket, BoardPacket, TextMessagePacket]
+
 def listen_trades():
     try:
         reload_dll(config.dll_path)
+        set_interests(callback_interests)
+        # parse and handle messages off the connector callback thread, one worker keeps order
+        message_dispatcher = start_dispatcher()
+        command_scheduler = start_scheduler()
+        if config.capture_path:
+            start_recording(config.capture_path)
         initialize(config.log_path, config.log_level, callback)
         connect(config.t_login, config.t_password, "%s:%s" % (config.t_host, config.t_port))
         max_connect_seconds = 60 * 5
@@ -215,6 +281,9 @@ def listen_trades():
         
         if connector_ready:
             send_command(to_message_command('INFO', 'connection', 'connection ready'))
+            # securities known from the master are subscribed before the securities packet is processed
+            added, removed = subscriptions.sync()
+            log.info('early subscriptions: +%s -%s' % (added, removed))
 
         log.info('connected %s. wait' % (str(connector_ready)))
         time.sleep(3)
@@ -228,7 +297,8 @@ def listen_trades():
                 if subscribed_ids[id] == 'UTC':
                     utc_count = utc_count + 1
 
-            subscribe_ids(subscribed_ids.keys())
+            added, removed = subscriptions.sync()
+            log.info('subscriptions synced: +%s -%s %s' % (added, removed, subscriptions.stats()))
             send_command(to_message_command('INFO', 'subscription', 'subscribed to %s securities. UTC: %s' % (len(subscribed_ids.keys()), utc_count)))
         else:
             log.error('skip subscribing to %s securities' % (len(subscribed_ids.keys())))
@@ -238,7 +308,17 @@ def listen_trades():
             log.debug('connector_ready: %s count: %s' % (str(connector_ready), conn_count))
             if conn_count % 10 == 0:
                 log.info('connector_ready: %s count: %s' % (str(connector_ready), conn_count))
+                log.info('output: %s formatter: %s journal: %s' % (output_stage.stats(), trade_formatter.stats(), trade_journal.stats()))
+                log.info('sinks: trades %s cmd %s' % (trades_sink.stats(), cmd_sink.stats()))
+                log.info('dispatcher: %s' % message_dispatcher.stats())
+                log.info('native buffers: %s' % native_stats())
+                log.info('scheduler: %s' % command_scheduler.stats())
             conn_count = conn_count + 1
+            # securities announced after the initial wait
+            if connector_ready:
+                subscriptions.sync()
+            save_security_master()
+            trade_journal.flush()
             time.sleep(5)
             if not connector_ready:
                 log.error('connector not ready')
@@ -249,17 +329,24 @@ def listen_trades():
         send_command(to_message_command('ERROR', 'connection', str(e)))
         return
     finally:
-        log.info('unsubscribing from %s securities' % (len(subscribed_ids.keys())))
-        for id in subscribed_ids.keys():
-            log.debug('unsubscribe from %s tz: %s' % (str(id), subscribed_ids[id]))
-        unsubscribe_ids(subscribed_ids)
-        subscribed_ids.clear()
+        # server drops subscriptions on disconnect, they are replayed by (board, seccode) on the next connect;
+        # secid-keyed state is rebuilt from the next securities packet
+        log.info('keeping %s securities for resubscription' % (len(subscriptions.desired['alltrades'])))
+        subscriptions.connection_lost()
         log.warning('disconnect')
         disconnect()
         uninitialize()
+        save_security_master()
+        output_stage.drain()
+        subscribed_ids.clear()
+        trade_formatter.clear()
+        trade_journal.flush()
+        trades_sink.flush()
+        cmd_sink.flush()
 
 if __name__ == '__main__':
     #send_command(to_message_command('INFO', 'init', 'starting'))
+    warm_start()
     while True:
         listen_trades()
         now_time = datetime.datetime.now(tz=msk_timezone).timetz()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронная стадия вывода: запись в файлы и отправка в ATSD вне потока обработки сообщений.
+
+Обработчик сообщений кладет записи (например, кортежи сделок) в ограниченную очередь
+и сразу возвращается, поток вывода передает их обработчику пачками.
+При переполнении очереди действует политика:
+
+- BLOCK - ждать места в очереди;
+- DROP_OLDEST - отбросить самые старые записи;
+- SPILL - дописывать новые записи в файл на диске, пока поток вывода не вычитает их обратно
+  (порядок записей сохраняется, записи должны сериализоваться pickle).
+
+Задержка (lag) - время от постановки записи в очередь до передачи ее обработчику.
+"""
+import time, pickle, tempfile, threading, logging
+from collections import deque
+
+log = logging.getLogger("output")
+
+BLOCK, DROP_OLDEST, SPILL = 'block', 'drop_oldest', 'spill'
+overflow_policies = (BLOCK, DROP_OLDEST, SPILL)
+
+
+class OutputStage(object):
+    """
+    Ограниченная очередь записей с потоком вывода.
+    """
+
+    def __init__(self, handler, maxsize=100000, overflow=BLOCK, spill_dir=None, batch_size=1000):
+        """
+        :param handler:
+            Функция, получающая список записей; вызывается в потоке вывода.
+        :param maxsize:
+            Максимум записей в памяти.
+        :param overflow:
+            Политика переполнения: BLOCK, DROP_OLDEST или SPILL.
+        :param spill_dir:
+            Каталог файла переполнения для SPILL (по умолчанию временный каталог).
+        :param batch_size:
+            Максимум записей в одном вызове handler.
+        """
+        if overflow not in overflow_policies:
+            raise ValueError("Unknown overflow policy %r" % overflow)
+        self.handler = handler
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.batch_size = batch_size
+        # Порции (время постановки, список записей)
+        self._queue = deque()
+        self.depth = 0
+        self._cond = threading.Condition()
+        self._busy = False
+        self._running = True
+        # Файл переполнения: запись в конец, чтение с _spill_read
+        self._spill = None
+        self._spill_read = 0
+        self._spill_size = 0
+        # Статистика
+        self.queued = 0
+        self.handled = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed = 0
+        self.blocked_time = 0.0
+        self.high_water = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.lag_count = 0
+        self._thread = threading.Thread(target=self._run, name="output")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, item):
+        self.put_many([item])
+
+    def put_many(self, items):
+        """
+        Поставить записи в очередь одной порцией.
+        """
+        if not items:
+            return
+        count = len(items)
+        with self._cond:
+            self.queued += count
+            chunk = (time.time(), items)
+            if self._spill is not None:
+                # Пока файл переполнения не вычитан, новые записи идут за ним
+                self._spill_write(chunk)
+            elif self.depth + count > self.maxsize and self.depth:
+                if self.overflow == BLOCK:
+                    started = time.time()
+                    while self.depth + count > self.maxsize and self.depth and self._running:
+                        self._cond.wait()
+                    self.blocked_time += time.time() - started
+                    self._append(chunk)
+                elif self.overflow == DROP_OLDEST:
+                    while self.depth + count > self.maxsize and self._queue:
+                        oldest = self._queue.popleft()[1]
+                        self.depth -= len(oldest)
+                        self.dropped += len(oldest)
+                    self._append(chunk)
+                else:
+                    self._spill_write(chunk)
+            else:
+                self._append(chunk)
+            self._cond.notify_all()
+
+    def _append(self, chunk):
+        self._queue.append(chunk)
+        self.depth += len(chunk[1])
+        if self.depth > self.high_water:
+            self.high_water = self.depth
+
+    def _spill_write(self, chunk):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(prefix='output-spill', dir=self.spill_dir)
+            self._spill_read = self._spill_size = 0
+        self._spill.seek(self._spill_size)
+        pickle.dump(chunk, self._spill, pickle.HIGHEST_PROTOCOL)
+        self._spill_size = self._spill.tell()
+        self.spilled += len(chunk[1])
+
+    def _spill_next(self):
+        # Следующая порция из файла переполнения, файл закрывается, когда вычитан
+        self._spill.seek(self._spill_read)
+        chunk = pickle.load(self._spill)
+        self._spill_read = self._spill.tell()
+        if self._spill_read >= self._spill_size:
+            self._spill.close()
+            self._spill = None
+        return chunk
+
+    def _take(self):
+        # Порции из памяти (они старше файла переполнения), затем из файла
+        chunks = []
+        count = 0
+        while self._queue and (not chunks or count + len(self._queue[0][1]) <= self.batch_size):
+            chunk = self._queue.popleft()
+            self.depth -= len(chunk[1])
+            count += len(chunk[1])
+            chunks.append(chunk)
+        if not chunks and self._spill is not None:
+            chunks.append(self._spill_next())
+        return chunks
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and self._spill is None and self._running:
+                    self._cond.wait()
+                chunks = self._take()
+                if not chunks:
+                    break
+                self._busy = True
+                self._cond.notify_all()
+            now = time.time()
+            items = chunks[0][1] if len(chunks) == 1 else [item for chunk in chunks for item in chunk[1]]
+            try:
+                self.handler(items)
+                ok = True
+            except Exception:
+                ok = False
+                log.exception(u"Output handler failed")
+            with self._cond:
+                self._busy = False
+                # Пачка учитывается один раз: в handled или в failed
+                if ok:
+                    self.handled += len(items)
+                else:
+                    self.failed += len(items)
+                for queued, _ in chunks:
+                    self.lag_total += now - queued
+                self.lag_count += len(chunks)
+                if now - chunks[0][0] > self.lag_max:
+                    self.lag_max = now - chunks[0][0]
+                self._cond.notify_all()
+
+    def drain(self, timeout=5):
+        """
+        Дождаться вывода всех записей.
+
+        :return:
+            True, если очередь опустела за timeout секунд.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._queue or self._spill is not None or self._busy:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._thread.is_alive():
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stop(self, timeout=5):
+        """
+        Вывести оставшееся и остановить поток.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self):
+        """
+        Статистика: глубина очереди, записи по судьбе, время ожидания писателя, задержка вывода (мс).
+        """
+        with self._cond:
+            return {'depth': self.depth, 'high_water': self.high_water, 'queued': self.queued,
+                    'handled': self.handled, 'dropped': self.dropped, 'failed': self.failed,
+                    'spilled': self.spilled, 'spill_bytes': self._spill_size - self._spill_read if self._spill else 0,
+                    'blocked_ms': self.blocked_time * 1000,
+                    'lag_avg_ms': self.lag_total * 1000 / self.lag_count if self.lag_count else 0.0,
+                    'lag_max_ms': self.lag_max * 1000}
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Многопроцессный конвейер разбора сообщений.
+
+Разбор XML в питоне упирается в GIL, поэтому пакеты сделок, стакана и котировок
+режутся по secid прямо в сырых байтах и раздаются пулу процессов:
+бумага всегда попадает в один и тот же процесс, так что порядок по инструменту сохраняется.
+Процессы разбирают фрагменты классами structures и либо сами отправляют результат
+дальше (в сокет, файл), либо возвращают компактный результат в основной процесс.
+"""
+import multiprocessing, threading, logging, re
+try:
+    from structures import parse, root_tag, set_compiled_parsers, TradePacket, QuotePacket, QuotationPacket
+except ImportError:
+    from .structures import parse, root_tag, set_compiled_parsers, TradePacket, QuotePacket, QuotationPacket
+
+log = logging.getLogger("pipeline")
+
+# Пакеты, которые можно резать по secid: корневой тег -> тег элемента
+partitioned = {
+    TradePacket.ROOT_NAME: 'trade',
+    QuotePacket.ROOT_NAME: 'quote',
+    QuotationPacket.ROOT_NAME: 'quotation',
+}
+# Начало любого элемента; secid - если есть в атрибутах
+_item_res = dict((root, re.compile(br'<' + item.encode() + br'\b(?:[^>]*?\bsecid="(\d+)")?'))
+                 for root, item in partitioned.items())
+
+
+def split_by_secid(msg, partitions, tag=None):
+    """
+    Разрезать сырой пакет на части по secid % partitions без построения дерева.
+
+    :param msg:
+        Сырые байты пакета.
+    :param partitions:
+        Количество частей.
+    :param tag:
+        Корневой тег, если уже известен.
+    :return:
+        Словарь {номер части: байты пакета с элементами этой части}, None если пакет не режется.
+        Элементы без secid собираются в пакет под ключом None.
+    """
+    tag = tag or root_tag(msg)
+    item_re = _item_res.get(tag)
+    if item_re is None:
+        return None
+    starts = [(m.start(), m.group(1) and int(m.group(1))) for m in item_re.finditer(msg)]
+    if not starts:
+        return {}
+    end = msg.rfind(b'</' + tag.encode())
+    parts = {}
+    for i, (start, secid) in enumerate(starts):
+        stop = starts[i + 1][0] if i + 1 < len(starts) else end
+        parts.setdefault(None if secid is None else secid % partitions, []).append(msg[start:stop])
+    head, tail = b'<' + tag.encode() + b'>', b'</' + tag.encode() + b'>'
+    return dict((k, head + b''.join(v) + tail) for k, v in parts.items())
+
+
+def trade_tuples(obj):
+    """
+    Рабочая функция по умолчанию: сделки пакета alltrades в кортежи
+    (secid, tradeno, time_millis, price, quantity, buysell, board, seccode).
+    """
+    if isinstance(obj, TradePacket):
+        return [(t.secid, t.id, t.time_millis, t.price, t.quantity, t.buysell, t.board, t.seccode)
+                for t in obj.items]
+    return None
+
+
+def _worker(inbox, outbox, worker_fn, setup):
+    if setup is not None:
+        setup()
+    while True:
+        msg = inbox.get()
+        if msg is None:
+            break
+        try:
+            result = worker_fn(parse(msg.decode('utf8')))
+        except Exception:
+            log.exception(u"Pipeline worker failed")
+            continue
+        if result is not None:
+            outbox.put(result)
+
+
+class Pipeline(object):
+    """
+    Пул процессов разбора с разбиением по secid.
+    """
+
+    def __init__(self, worker_fn=trade_tuples, workers=None, result_handler=None,
+                 local_handler=None, setup=set_compiled_parsers):
+        """
+        :param worker_fn:
+            Функция (на уровне модуля, picklable), вызываемая в процессе для
+            распарсенного пакета; возвращает компактный результат или None.
+        :param workers:
+            Количество процессов, по умолчанию число ядер.
+        :param result_handler:
+            Функция основного процесса для результатов worker_fn.
+        :param local_handler:
+            Функция основного процесса для нерезаемых сообщений (сырые байты).
+        :param setup:
+            Функция инициализации процесса (по умолчанию включает сгенерированные парсеры).
+        """
+        self.workers = workers or multiprocessing.cpu_count()
+        self.worker_fn = worker_fn
+        self.result_handler = result_handler
+        self.local_handler = local_handler
+        self.setup = setup
+        self.sent = [0] * self.workers
+        self.local = 0
+        self._inboxes = []
+        self._processes = []
+        self._outbox = None
+        self._collector = None
+
+    def start(self):
+        self._outbox = multiprocessing.Queue()
+        for i in range(self.workers):
+            inbox = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_worker, name="txml-parse-%d" % i,
+                                              args=(inbox, self._outbox, self.worker_fn, self.setup))
+            process.daemon = True
+            process.start()
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+        self._collector = threading.Thread(target=self._collect, name="txml-pipeline-results")
+        self._collector.daemon = True
+        self._collector.start()
+
+    def stop(self, timeout=5):
+        """
+        Дообработать отправленное и остановить процессы.
+        """
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout)
+        self._outbox.put(None)
+        self._collector.join(timeout)
+        self._inboxes, self._processes = [], []
+
+    def put(self, msg):
+        """
+        Раздать сырое сообщение: режущиеся пакеты - процессам, остальное
+        (и элементы пакета без secid) - local_handler.
+
+        :param msg:
+            Сырые байты сообщения.
+        """
+        parts = split_by_secid(msg, self.workers)
+        if parts is not None:
+            msg = parts.pop(None, None)
+        if msg is not None:
+            self.local += 1
+            if self.local_handler is not None:
+                self.local_handler(msg)
+        if not parts:
+            return
+        for index, part in parts.items():
+            self.sent[index] += 1
+            self._inboxes[index].put(part)
+
+    def _collect(self):
+        while True:
+            result = self._outbox.get()
+            if result is None:
+                break
+            if self.result_handler is not None:
+                try:
+                    self.result_handler(result)
+                except Exception:
+                    log.exception(u"Pipeline result handler failed")
+
+    def stats(self):
+        return {'workers': self.workers, 'sent': list(self.sent), 'local': self.local}
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Цены в фиксированной точке: целое число единиц 10^-decimals инструмента.
+Количество знаков и шаг цены берутся из справочника бумаг (Security.decimals, Security.minstep).
+
+Перевод текст -> целое и обратно точный (без float), что убирает ошибки округления
+в ключах стакана и ускоряет агрегаты (VWAP, объемы) на целых числах.
+Режим включается через structures.set_price_scales(PriceScales()).
+"""
+import logging
+try:
+    from structures import SecurityPacket, SecurityStream, TradePacket, QuotePacket, \
+        ClientTradePacket, ClientOrderPacket, HistoryTickPacket
+except ImportError:
+    from .structures import SecurityPacket, SecurityStream, TradePacket, QuotePacket, \
+        ClientTradePacket, ClientOrderPacket, HistoryTickPacket
+
+log = logging.getLogger("prices")
+
+_pow10 = [10 ** i for i in range(19)]
+
+
+def to_ticks(value, decimals):
+    """
+    Цена в целое число единиц 10^-decimals. Лишние знаки округляются половиной вверх.
+
+    :param value:
+        Цена, строкой ("102.50") или float.
+    :param decimals:
+        Количество десятичных знаков инструмента.
+    :return:
+        Целое число.
+    """
+    text = value if isinstance(value, str) else repr(float(value))
+    text = text.strip()
+    negative = text.startswith('-')
+    if negative or text.startswith('+'):
+        text = text[1:]
+    if 'e' in text or 'E' in text:
+        text = '%.*f' % (decimals + 1, float(text))
+    whole, _, frac = text.partition('.')
+    ticks = int(whole or '0') * _pow10[decimals]
+    if frac:
+        ticks += int((frac + '0' * decimals)[:decimals] or '0')
+        if len(frac) > decimals and frac[decimals] >= '5':
+            ticks += 1
+    return -ticks if negative else ticks
+
+
+def format_ticks(ticks, decimals):
+    """
+    Целое число единиц 10^-decimals обратно в текст ровно с decimals знаками.
+
+    :param ticks:
+        Цена в единицах.
+    :param decimals:
+        Количество десятичных знаков инструмента.
+    :return:
+        Строка цены.
+    """
+    if not decimals:
+        return str(ticks)
+    sign = '-' if ticks < 0 else ''
+    whole, frac = divmod(abs(ticks), _pow10[decimals])
+    return '%s%d.%0*d' % (sign, whole, decimals, frac)
+
+
+class PriceScales(object):
+    """
+    Справочник масштабов цен по secid, наполняется из пакетов securities.
+    """
+
+    def __init__(self):
+        # secid -> количество знаков
+        self.decimals = {}
+        # secid -> шаг цены в единицах
+        self.minsteps = {}
+        # Цены по неизвестным бумагам (оставлены как есть)
+        self.unknown = 0
+        # Неизвестные secid, о которых уже предупредили
+        self.unknown_ids = set()
+
+    def add(self, security):
+        """
+        Запомнить масштаб бумаги.
+
+        :param security:
+            Объект Security.
+        """
+        decimals = security.decimals or 0
+        self.decimals[security.secid] = decimals
+        if security.minstep:
+            self.minsteps[security.secid] = to_ticks(security.minstep, decimals)
+
+    def ticks(self, secid, value):
+        return to_ticks(value, self.decimals[secid])
+
+    def format(self, secid, ticks):
+        return format_ticks(ticks, self.decimals[secid])
+
+    def steps(self, secid, ticks):
+        """
+        Цена в шагах цены инструмента (целочисленное деление).
+        """
+        return ticks // self.minsteps[secid]
+
+    def convert(self, items):
+        """
+        Заменить price у записей на целое число единиц.
+        Записи должны быть сгенерированными (structures.compiled), а не XmlObject.
+        О бумаге без масштаба предупреждает один раз.
+
+        :param items:
+            Записи сделок, котировок или заявок.
+        """
+        decimals = self.decimals
+        for item in items:
+            price = item.price
+            # Пустая цена: None, '' или NaN у FloatField
+            if price is None or price == '' or price != price:
+                continue
+            scale = decimals.get(item.secid)
+            if scale is None:
+                self.unknown += 1
+                if item.secid not in self.unknown_ids:
+                    self.unknown_ids.add(item.secid)
+                    log.warning(u"No decimals for secid %s, prices left as is" % item.secid)
+                continue
+            item.price = to_ticks(price, scale)
+
+    def _register(self, securities):
+        for security in securities:
+            self.add(security)
+            yield security
+
+    def apply(self, msg):
+        """
+        Обработать распарсенное сообщение: бумаги попадают в справочник,
+        у сделок, котировок и заявок цены переводятся в единицы.
+
+        :param msg:
+            Результат structures.parse().
+        :return:
+            То же сообщение.
+        """
+        if isinstance(msg, SecurityStream):
+            msg.items = self._register(msg.items)
+        elif isinstance(msg, SecurityPacket):
+            for security in msg.items:
+                self.add(security)
+        elif isinstance(msg, (TradePacket, QuotePacket, ClientTradePacket, ClientOrderPacket, HistoryTickPacket)):
+            self.convert(msg.items)
+        return msg
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Планировщик команд с приоритетами и ограничением частоты запросов.
+
+Команды выполняются одним потоком из трех очередей по приоритету:
+заявки и снятия, затем подписки, затем запросы истории, новостей и прочего.
+Подписки и запросы отправляются не чаще rqdelay (см. commands.connect),
+заявки паузу не ждут, поэтому поток новостей или истории их не задерживает.
+Одинаковые запросы, еще стоящие в очереди (get_history по той же бумаге и т.п.), склеиваются.
+"""
+import threading, time, logging
+from collections import deque
+from concurrent.futures import Future
+
+log = logging.getLogger("scheduler")
+
+ORDERS, SUBSCRIPTIONS, REQUESTS = 0, 1, 2
+lane_names = ('orders', 'subscriptions', 'requests')
+
+# Распределение команд commands по очередям (по имени функции), остальные - REQUESTS
+_order_commands = frozenset(['new_order', 'new_stoploss', 'new_takeprofit', 'new_condorder', 'move_order',
+                             'cancel_order', 'cancel_stoploss', 'cancel_takeprofit'])
+
+
+def lane_of(func):
+    """
+    Очередь для функции commands.
+    """
+    name = getattr(func, '__name__', '')
+    if name in _order_commands:
+        return ORDERS
+    if name.startswith('subscribe') or name.startswith('unsubscribe'):
+        return SUBSCRIPTIONS
+    return REQUESTS
+
+
+class _LaneStats(object):
+    __slots__ = ('submitted', 'sent', 'coalesced', 'failed', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.submitted = self.sent = self.coalesced = self.failed = 0
+        self.wait_total = self.wait_max = 0.0
+
+
+class CommandScheduler(object):
+    """
+    Поток отправки команд с очередями по приоритету.
+    """
+
+    def __init__(self, min_delay=0.1, paced=(False, True, True)):
+        """
+        :param min_delay:
+            Минимальный интервал между запросами к серверу, секунд (rqdelay).
+        :param paced:
+            Для каждой очереди: соблюдать ли интервал.
+        """
+        self.min_delay = min_delay
+        self.paced = paced
+        self._queues = [deque() for _ in lane_names]
+        self._stats = [_LaneStats() for _ in lane_names]
+        # Ключ склейки -> Future команды, стоящей в очереди
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._next_time = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="txml-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Остановить поток, отправив то, что уже в очереди.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Поставить команду в очередь.
+
+        :param func:
+            Функция commands.
+        :param lane:
+            Очередь (ORDERS, SUBSCRIPTIONS, REQUESTS), по умолчанию по имени функции.
+        :param coalesce:
+            Склеивать с такой же командой в очереди (по умолчанию - для REQUESTS).
+        :return:
+            concurrent.futures.Future с результатом команды.
+        """
+        lane = kwargs.pop('lane', None)
+        if lane is None:
+            lane = lane_of(func)
+        coalesce = kwargs.pop('coalesce', lane == REQUESTS)
+        key = (func, args, tuple(sorted(kwargs.items()))) if coalesce else None
+        try:
+            hash(key)
+        except TypeError:
+            # Списки в параметрах (подписки) не склеиваем
+            key = None
+        with self._cond:
+            stats = self._stats[lane]
+            if key is not None:
+                future = self._pending.get(key)
+                if future is not None:
+                    stats.coalesced += 1
+                    return future
+            future = Future()
+            if key is not None:
+                self._pending[key] = future
+            self._queues[lane].append((future, func, args, kwargs, key, time.time()))
+            stats.submitted += 1
+            self._cond.notify()
+        return future
+
+    def _take(self):
+        # Следующая команда с учетом приоритета и интервала, None - остановка
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = None
+                for lane, queue in enumerate(self._queues):
+                    if not queue:
+                        continue
+                    if self.paced[lane] and now < self._next_time:
+                        # Остальные очереди ниже по приоритету тоже ждут интервал,
+                        # но пришедшая заявка разбудит поток раньше
+                        wait = self._next_time - now
+                        break
+                    item = queue.popleft()
+                    if item[4] is not None:
+                        del self._pending[item[4]]
+                    if self.paced[lane]:
+                        self._next_time = now + self.min_delay
+                    waited = now - item[5]
+                    stats = self._stats[lane]
+                    stats.sent += 1
+                    stats.wait_total += waited
+                    if waited > stats.wait_max:
+                        stats.wait_max = waited
+                    return lane, item
+                if not self._running and wait is None:
+                    return None
+                self._cond.wait(wait)
+
+    def _run(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                break
+            lane, (future, func, args, kwargs, key, queued) = taken
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                self._stats[lane].failed += 1
+                log.warning(u"Command %s%s failed: %s" % (getattr(func, '__name__', func), args, e))
+                future.set_exception(e)
+
+    def stats(self):
+        """
+        Статистика по очередям: глубина, отправлено, склеено, ошибки, ожидание в очереди (мс).
+        """
+        with self._cond:
+            result = {}
+            for lane, name in enumerate(lane_names):
+                stats = self._stats[lane]
+                result[name] = {'depth': len(self._queues[lane]), 'submitted': stats.submitted,
+                                'sent': stats.sent, 'coalesced': stats.coalesced, 'failed': stats.failed,
+                                'wait_avg_ms': stats.wait_total * 1000 / stats.sent if stats.sent else 0.0,
+                                'wait_max_ms': stats.wait_max * 1000}
+            return result
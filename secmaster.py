@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Справочник бумаг с хранением на диске.
+
+Бумаги доступны по secid и по (board, seccode). При запуске справочник читается из файла,
+так что подписки можно отправить сразу после подключения, а пришедший пакет securities
+только сверяется со справочником: update() сообщает, новая ли бумага или изменилась.
+Файл записывается целиком через временный файл и переименование.
+update() вызывается из потока обработки сообщений, save() - из основного, поэтому изменения
+и снимок для записи делаются под блокировкой.
+"""
+import os, json, tempfile, threading, logging
+
+log = logging.getLogger("secmaster")
+
+# Результат сверки
+NEW, CHANGED = 'new', 'changed'
+# Версия формата файла
+_format = 1
+
+
+class SecurityRecord(object):
+    """
+    Сохраняемая часть Security; атрибуты называются так же.
+    """
+    __slots__ = ('secid', 'active', 'seccode', 'sectype', 'board', 'market', 'name', 'decimals',
+                 'minstep', 'lotsize', 'point_cost', 'timezone', 'currency', 'ticker')
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    @property
+    def id(self):
+        return self.secid
+
+    @classmethod
+    def from_security(cls, security):
+        """
+        :param security:
+            Объект Security (или другой объект с теми же атрибутами).
+        """
+        return cls(*[getattr(security, field) for field in cls.__slots__])
+
+    def values(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, SecurityRecord) and self.values() == other.values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "SecurityRecord(%s)" % ', '.join('%s=%r' % (f, getattr(self, f)) for f in self.__slots__)
+
+
+class SecurityMaster(object):
+    """
+    Справочник бумаг.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path:
+            Файл справочника; None - только в памяти.
+        """
+        self.path = path
+        self.by_id = {}
+        # (board, seccode) -> SecurityRecord
+        self.by_code = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+        # Статистика
+        self.counts = {NEW: 0, CHANGED: 0, None: 0}
+        self.loaded = 0
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self.by_id.values()))
+
+    def __contains__(self, secid):
+        return secid in self.by_id
+
+    def get(self, secid):
+        return self.by_id.get(secid)
+
+    def find(self, board, seccode):
+        return self.by_code.get((board, seccode))
+
+    def _put(self, record):
+        # Бумага сменила код или код перешел к другому secid - старые ключи удаляются
+        key = (record.board, record.seccode)
+        old = self.by_id.get(record.secid)
+        if old is not None and (old.board, old.seccode) != key:
+            self.by_code.pop((old.board, old.seccode), None)
+        previous = self.by_code.get(key)
+        if previous is not None and previous.secid != record.secid:
+            self.by_id.pop(previous.secid, None)
+        self.by_id[record.secid] = record
+        self.by_code[key] = record
+
+    def update(self, security):
+        """
+        Сверить бумагу из пакета securities со справочником.
+
+        :return:
+            NEW, CHANGED или None (не изменилась).
+        """
+        record = SecurityRecord.from_security(security)
+        with self._lock:
+            old = self.by_id.get(record.secid)
+            if old is None:
+                status = NEW
+            elif old != record:
+                status = CHANGED
+            else:
+                self.counts[None] += 1
+                return None
+            self._put(record)
+            self.dirty = True
+            self.counts[status] += 1
+            return status
+
+    def load(self):
+        """
+        Прочитать справочник из файла. Отсутствующий или поврежденный файл - пустой справочник.
+
+        :return:
+            Количество загруженных бумаг.
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('format') != _format:
+                raise ValueError("unsupported format %r" % data.get('format'))
+            records = [SecurityRecord(*values) for values in data['securities']]
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning(u"Security master %s ignored: %s" % (self.path, e))
+            return 0
+        with self._lock:
+            for record in records:
+                self._put(record)
+            self.loaded = len(records)
+        return self.loaded
+
+    def save(self, force=False):
+        """
+        Записать справочник, если он изменился.
+        """
+        with self._lock:
+            if self.path is None or not (self.dirty or force):
+                return False
+            data = {'format': _format, 'fields': SecurityRecord.__slots__,
+                    'securities': [r.values() for r in self.by_id.values()]}
+            self.dirty = False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(prefix='.secmaster', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            with self._lock:
+                self.dirty = True
+            raise
+        return True
+
+    def stats(self):
+        return {'securities': len(self.by_id), 'loaded': self.loaded, 'new': self.counts[NEW],
+                'changed': self.counts[CHANGED], 'unchanged': self.counts[None]}
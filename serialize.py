@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Сериализация команд по заранее собранным байтовым шаблонам.
+
+Построение дерева lxml и et.tostring на каждую команду дороже самого вызова dll,
+поэтому каждая форма команды (набор и порядок тегов) один раз разбирается в шаблон,
+а при отправке в него подставляются экранированные значения. Результат побайтно
+совпадает с et.tostring(root, encoding="utf-8") для того же дерева.
+
+Разметка шаблона:
+
+* ``{name}`` - элемент ``<name>значение</name>`` (``<name/>`` для None);
+* ``"{@}"`` - значение атрибута;
+* ``{*}`` - уже сериализованные байты (например, повторяющиеся элементы).
+"""
+import re
+
+_slot_re = re.compile(r'\{[@*]\}|\{([A-Za-z_][\w.-]*)\}')
+# Символы, которые нужно экранировать, и недопустимые в XML 1.0 (как и lxml, ругаемся на них)
+_text_special_re = re.compile(u'[&<>\r\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+_attr_special_re = re.compile(u'[&<>"\n\r\t\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+_invalid_re = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+_text_escapes = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '\r': '&#13;'}
+_attr_escapes = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;',
+                 '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+
+def _escape(value, special_re, escapes):
+    if isinstance(value, bytes):
+        value = value.decode('utf8')
+    if special_re.search(value) is None:
+        return value.encode('utf8')
+    if _invalid_re.search(value) is not None:
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters")
+    return special_re.sub(lambda m: escapes[m.group()], value).encode('utf8')
+
+
+def escape_text(value):
+    """
+    Экранировать текст элемента так же, как lxml.
+
+    :param value:
+        Строка (или байты в utf-8).
+    :return:
+        Байты utf-8.
+    """
+    return _escape(value, _text_special_re, _text_escapes)
+
+
+def escape_attr(value):
+    """
+    Экранировать значение атрибута так же, как lxml.
+    """
+    return _escape(value, _attr_special_re, _attr_escapes)
+
+
+class Template(object):
+    """
+    Скомпилированный шаблон команды одной формы.
+    """
+
+    def __init__(self, skeleton):
+        """
+        :param skeleton:
+            Разметка команды с местами для значений.
+        """
+        self.skeleton = skeleton
+        self._literals = []
+        self._slots = []
+        pos = 0
+        for match in _slot_re.finditer(skeleton):
+            self._literals.append(skeleton[pos:match.start()].encode('utf8'))
+            tag = match.group(1)
+            self._slots.append(match.group() if tag is None else tag.encode('utf8'))
+            pos = match.end()
+        self._literals.append(skeleton[pos:].encode('utf8'))
+
+    def fill(self, *values):
+        """
+        Подставить значения по порядку мест в шаблоне.
+
+        :return:
+            Байты команды.
+        """
+        if len(values) != len(self._slots):
+            raise ValueError("Template %r expects %d values, got %d" % (self.skeleton, len(self._slots), len(values)))
+        literals = self._literals
+        out = [literals[0]]
+        for i, value in enumerate(values):
+            tag = self._slots[i]
+            if tag == '{@}':
+                out.append(escape_attr(value))
+            elif tag == '{*}':
+                out.append(value)
+            elif value is None:
+                out.append(b'<' + tag + b'/>')
+            else:
+                out.append(b'<' + tag + b'>' + escape_text(value) + b'</' + tag + b'>')
+            out.append(literals[i + 1])
+        return b''.join(out)
+
+
+def shaped(builder):
+    """
+    Декоратор функции, строящей разметку по признакам формы команды.
+    Возвращает функцию (признаки) -> Template с кэшем по признакам.
+    """
+    cache = {}
+
+    def get(*shape):
+        template = cache.get(shape)
+        if template is None:
+            template = cache[shape] = Template(builder(*shape))
+        return template
+    get.cache = cache
+    get.__name__ = builder.__name__
+    get.__doc__ = builder.__doc__
+    return get
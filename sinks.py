@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Отправка строк сетевых команд ATSD.
+
+send() только добавляет строку в буфер (backlog) и сразу возвращается. Поток отправки
+забирает строки пачками до batch_size байт, разделенными переводом строки: как только набралась
+полная пачка или раз в flush_interval секунд. Соединение одно на назначение и переиспользуется.
+Размер backlog ограничен, при переполнении отбрасываются самые старые строки.
+
+UdpSink - датаграммы не больше MTU, ошибки отправки не повторяются.
+TcpSink - постоянное соединение, после ошибки переподключение с нарастающей паузой
+и повторная отправка недоставленной пачки.
+"""
+import socket, threading, time, logging
+
+log = logging.getLogger("sinks")
+
+
+class Sink(object):
+    """
+    Базовый буферизованный приемник строк; транспорт задается в _write.
+    """
+    # Повторять ли пачку после ошибки транспорта
+    retry = False
+
+    def __init__(self, address, batch_size, flush_interval=0.05, max_backlog=4 * 1024 * 1024,
+                 retry_delay=0.1, max_retry_delay=30):
+        """
+        :param address:
+            (host, port).
+        :param batch_size:
+            Максимальный размер пачки, байт. Строка длиннее отправляется отдельно.
+        :param flush_interval:
+            Период отправки неполной пачки, секунд; None - только по размеру и flush().
+        :param max_backlog:
+            Максимальный объем неотправленных строк, байт.
+        :param retry_delay, max_retry_delay:
+            Начальная и максимальная пауза перед повтором, секунд.
+        """
+        self.address = tuple(address)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backlog = max_backlog
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._buffer = bytearray()
+        self._cond = threading.Condition()
+        # Байт у потока отправки
+        self._inflight = 0
+        self._flushing = False
+        self._closing = False
+        self._stopped = threading.Event()
+        # Статистика
+        self.lines = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.batches = 0
+        self.sent_bytes = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name="sink-%s:%s" % self.address)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, line):
+        """
+        Поставить строку (str или bytes, без перевода строки) в очередь отправки.
+        """
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        with self._cond:
+            self._buffer += line
+            self._buffer += b'\n'
+            self.lines += 1
+            if len(self._buffer) > self.max_backlog:
+                self._trim()
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify_all()
+
+    def send_many(self, lines):
+        """
+        Поставить в очередь несколько строк в байтах за одно взятие блокировки.
+        """
+        if not lines:
+            return
+        data = b'\n'.join(lines) + b'\n'
+        with self._cond:
+            self._buffer += data
+            self.lines += len(lines)
+            if len(self._buffer) > self.max_backlog:
+                self._trim()
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _trim(self):
+        # Отбросить самые старые строки сверх max_backlog
+        cut = self._buffer.find(b'\n', len(self._buffer) - self.max_backlog - 1) + 1
+        self.dropped += self._buffer.count(b'\n', 0, cut)
+        del self._buffer[:cut]
+
+    def _take(self):
+        # Пачка до batch_size байт по границе строк
+        if len(self._buffer) <= self.batch_size:
+            cut = len(self._buffer)
+        else:
+            cut = self._buffer.rfind(b'\n', 0, self.batch_size) + 1 or self._buffer.find(b'\n') + 1
+        data = bytes(self._buffer[:cut])
+        del self._buffer[:cut]
+        self._inflight = len(data)
+        return data
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._buffer) < self.batch_size and not (self._flushing or self._closing):
+                    self._cond.wait(self.flush_interval)
+                if not self._buffer:
+                    self._flushing = False
+                    self._cond.notify_all()
+                    if self._closing:
+                        break
+                    continue
+                data = self._take()
+            delivered = self._deliver(data)
+            with self._cond:
+                self._inflight = 0
+                if not delivered:
+                    if self._closing:
+                        self.dropped += data.count(b'\n') + self._buffer.count(b'\n')
+                        del self._buffer[:]
+                        self._cond.notify_all()
+                        break
+                    # Вернуть пачку в начало backlog
+                    self._buffer[0:0] = data
+                    if len(self._buffer) > self.max_backlog:
+                        self._trim()
+                self._cond.notify_all()
+        self._close_transport()
+
+    def _deliver(self, data):
+        delay = self.retry_delay
+        while True:
+            try:
+                self._write(data)
+            except OSError as e:
+                self.errors += 1
+                log.warning(u"Send to %s:%s failed: %s" % (self.address[0], self.address[1], e))
+                if not self.retry:
+                    self.dropped += data.count(b'\n')
+                    return True
+                if self._closing or self._stopped.wait(delay):
+                    return False
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            self.batches += 1
+            self.sent_bytes += len(data)
+            self.delivered += data.count(b'\n')
+            return True
+
+    def _write(self, data):
+        raise NotImplementedError
+
+    def _close_transport(self):
+        pass
+
+    def flush(self, timeout=5):
+        """
+        Дождаться отправки накопленных строк.
+
+        :return:
+            True, если все отправлено за timeout секунд.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            while self._buffer or self._inflight:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._thread.is_alive():
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self, timeout=5):
+        """
+        Отправить остаток (не дольше timeout секунд) и освободить транспорт.
+        """
+        self.flush(timeout)
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._stopped.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {'lines': self.lines, 'delivered': self.delivered, 'dropped': self.dropped,
+                    'batches': self.batches, 'bytes': self.sent_bytes, 'errors': self.errors,
+                    'backlog': len(self._buffer) + self._inflight}
+
+
+class UdpSink(Sink):
+    """
+    Отправка датаграммами не больше mtu байт через один сокет.
+    """
+
+    def __init__(self, address, mtu=1400, flush_interval=0.05, **kwargs):
+        """
+        :param mtu:
+            Максимальный размер датаграммы, байт (без заголовков IP/UDP).
+        """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        super(UdpSink, self).__init__(address, mtu, flush_interval, **kwargs)
+
+    def _write(self, data):
+        self._socket.sendto(data, self.address)
+
+    def _close_transport(self):
+        self._socket.close()
+
+
+class TcpSink(Sink):
+    """
+    Отправка через постоянное TCP соединение с переподключением.
+    Пачка, оборвавшаяся на середине, отправляется заново целиком (возможен повтор строк).
+    """
+    retry = True
+
+    def __init__(self, address, batch_size=64 * 1024, flush_interval=0.05, connect_timeout=5, **kwargs):
+        """
+        :param connect_timeout:
+            Таймаут подключения и записи, секунд.
+        """
+        self.connect_timeout = connect_timeout
+        self._socket = None
+        self.connects = 0
+        super(TcpSink, self).__init__(address, batch_size, flush_interval, **kwargs)
+
+    def _write(self, data):
+        if self._socket is None:
+            self._socket = socket.create_connection(self.address, self.connect_timeout)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connects += 1
+            log.info(u"Connected to %s:%s" % self.address)
+        try:
+            self._socket.sendall(data)
+        except OSError:
+            self._close_transport()
+            raise
+
+    def _close_transport(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def stats(self):
+        result = super(TcpSink, self).stats()
+        result['connects'] = self.connects
+        result['connected'] = self._socket is not None
+        return result
@@ -7,16 +7,154 @@
 @author: Roma
 """
 from eulxml.xmlmap import *
-from eulxml.xmlmap.fields import Field, DateTimeMapper
-import sys, inspect, logging
+from eulxml.xmlmap.fields import Field, DateTimeMapper, Mapper, SingleNodeManager
+from lxml import etree
+from datetime import datetime
+import sys, inspect, logging, re, calendar
+try:
+    from codegen import record_class, compact_record_class
+except ImportError:
+    from .codegen import record_class, compact_record_class
 
 log = logging.getLogger("structures")
 
 timeformat = "%d.%m.%Y %H:%M:%S"
 # Формат дат/времени используемый Транзаком
 timeformat_millis = "%d.%m.%Y %H:%M:%S.%f"
-# Список классов, ленивая инициализация при парсинге
-_my_classes = None
+# Реестр классов по корневому тегу, заполняется при импорте (см. конец модуля)
+_registry = {}
+# Разрешители неоднозначных корневых тегов: тег -> функция(элемент) -> класс
+_resolvers = {}
+# Использовать ли сгенерированные парсеры (см. set_compiled_parsers)
+_compiled = False
+# Справочник масштабов цен для режима фиксированной точки (см. set_price_scales)
+_price_scales = None
+# Потоково разбираемые пакеты: корневой тег -> класс (см. set_streaming_securities)
+_streamed = {}
+# Корневой тег в начале текста (после необязательной xml декларации)
+_root_re = re.compile(r'\s*(?:<\?.*?\?>\s*)?<([^\s/>]+)', re.S)
+# Размер порции текста для потокового парсера
+stream_chunk = 64 * 1024
+# Кэш дат: 'dd.mm.yyyy' -> (миллисекунды полуночи UTC, год, месяц, день)
+_date_cache = {}
+_date_cache_size = 64
+
+
+def set_fast_trades(enabled=True):
+    """
+    Включить/выключить быстрый разбор пакетов alltrades в parse().
+    Сделки в пакете будут компактными записями TradeRecord вместо Trade
+    (значения разобраны сразу, без XPath, без __dict__ и lxml дерева).
+
+    :param enabled:
+        True для FastTradePacket, False для обычного TradePacket.
+    """
+    _registry[TradePacket.ROOT_NAME] = FastTradePacket if enabled else TradePacket
+
+
+def set_compiled_parsers(enabled=True):
+    """
+    Включить/выключить сгенерированные парсеры (см. codegen) для всех структур в parse().
+    Объекты остаются экземплярами тех же классов, но поля читаются из слотов, а не XPath.
+
+    :param enabled:
+        True для сгенерированных парсеров.
+    """
+    global _compiled
+    _compiled = enabled
+
+
+def compiled(cls):
+    """
+    Класс со сгенерированным парсером для заданного класса структуры.
+    Классы с собственным from_element (ClientOrderPacket, PositionPacket) возвращаются как есть,
+    ClientOrderPacket сам собирает заявки сгенерированными классами.
+
+    :param cls:
+        Класс структуры.
+    :return:
+        Класс записи.
+    """
+    if cls.from_element.__func__ is not MyXmlObject.from_element.__func__:
+        return cls
+    return record_class(cls)
+
+
+def set_price_scales(scales):
+    """
+    Включить режим цен в фиксированной точке (см. prices.PriceScales).
+    Пакеты securities пополняют справочник, а price у сделок, котировок и заявок
+    становится целым числом единиц 10^-decimals. Включает сгенерированные парсеры.
+
+    :param scales:
+        Экземпляр prices.PriceScales или None для выключения.
+    """
+    global _price_scales
+    _price_scales = scales
+
+
+def set_streaming_securities(enabled=True):
+    """
+    Включить/выключить потоковый разбор пакетов securities в parse().
+    Вместо SecurityPacket возвращается SecurityStream, items которого - итератор,
+    отдающий бумаги по мере разбора без построения всего дерева.
+
+    :param enabled:
+        True для SecurityStream.
+    """
+    if enabled:
+        _streamed[SecurityPacket.ROOT_NAME] = SecurityStream
+    else:
+        _streamed.pop(SecurityPacket.ROOT_NAME, None)
+
+
+def root_tag(xml):
+    """
+    Корневой тег сообщения по началу текста, без построения дерева.
+
+    :param xml:
+        Текст XML (str или bytes).
+    :return:
+        Имя корневого тега или None.
+    """
+    head = xml[:256]
+    if isinstance(head, bytes):
+        head = head.decode('utf8', 'ignore')
+    match = _root_re.match(head)
+    return match.group(1) if match else None
+
+
+def iter_items(xml, tag, item_cls):
+    """
+    Потоковый разбор элементов пакета через lxml XMLPullParser.
+    Каждый элемент превращается в запись сгенерированного парсера (значения читаются сразу)
+    и удаляется из дерева, так что пиковая память не зависит от размера пакета.
+
+    :param xml:
+        Текст XML пакета.
+    :param tag:
+        Тег элементов.
+    :param item_cls:
+        Класс структуры элемента.
+    :return:
+        Генератор записей.
+    """
+    if not isinstance(xml, bytes):
+        xml = xml.encode('utf8')
+    parser = etree.XMLPullParser(events=('end',), tag=tag)
+    from_element = record_class(item_cls).from_element
+    for start in range(0, len(xml), stream_chunk):
+        parser.feed(xml[start:start + stream_chunk])
+        for event, elem in parser.read_events():
+            item = from_element(elem)
+            item.node = None
+            # Освобождаем разобранный элемент и предыдущих соседей
+            elem.clear()
+            parent = elem.getparent()
+            while elem.getprevious() is not None:
+                del parent[0]
+            yield item
+    parser.close()
 
 
 def parse(xml):
@@ -28,23 +166,108 @@ def parse(xml):
     :return:
         Распарсенный объект. None если не распознан.
     """
-    global _my_classes
-    # Корневой тег достанем
-    root = parseString(xml).tag
-    # Пройдемся по всем классам модуля и найдем подходящий
-    if _my_classes is None:
-        classes_filter = lambda o: inspect.isclass(o) and issubclass(o, MyXmlObject)
-        _my_classes = inspect.getmembers(sys.modules[__name__], classes_filter)
-    for cls in _my_classes:
-        if root == cls[1].ROOT_NAME:
-            return cls[1].parse(xml)
-    log.error(u"XML type is not supported, root tag: %s" % root)
+    if _streamed:
+        stream = _streamed.get(root_tag(xml))
+        if stream is not None:
+            return _scaled(stream.stream(xml))
+    # Разбираем текст один раз, дальше работаем с готовым элементом
+    root = parseString(xml)
+    cls = _registry.get(root.tag)
+    if cls is None:
+        resolver = _resolvers.get(root.tag)
+        cls = resolver(root) if resolver else None
+    if cls is not None:
+        if _compiled or _price_scales is not None:
+            cls = compiled(cls)
+        return _scaled(cls.from_element(root))
+    log.error(u"XML type is not supported, root tag: %s" % root.tag)
     return xml
 
 
+def _scaled(obj):
+    # Перевод цен в фиксированную точку, если режим включен
+    return _price_scales.apply(obj) if _price_scales is not None else obj
+
+
 ## Вспомогательные классы
 
-class NullableDateTimeMapper(DateTimeMapper):
+def _date_prefix(text):
+    # Дата из начала строки, почти все сообщения сессии приходят за один день
+    key = text[:10]
+    entry = _date_cache.get(key)
+    if entry is None:
+        date = datetime.strptime(key, "%d.%m.%Y")
+        entry = (calendar.timegm(date.timetuple()) * 1000, date.year, date.month, date.day)
+        if len(_date_cache) >= _date_cache_size:
+            _date_cache.clear()
+        _date_cache[key] = entry
+    return entry
+
+
+def _is_transaq_time(text):
+    # Проверка формы "dd.mm.yyyy HH:MM:SS[.f...]"
+    n = len(text)
+    return (n == 19 or (n > 20 and text[19] == '.')) and text[2] == '.' and text[5] == '.' \
+        and text[10] == ' ' and text[13] == ':' and text[16] == ':'
+
+
+def decode_millis(text):
+    """
+    Время Транзака ("%d.%m.%Y %H:%M:%S[.%f]", UTC) в миллисекунды от эпохи.
+    Дата кэшируется, время считается арифметикой без strptime.
+
+    :param text:
+        Строка времени.
+    :return:
+        Миллисекунды (int).
+    """
+    if not _is_transaq_time(text):
+        raise ValueError("time data %r does not match format %r" % (text, timeformat_millis))
+    millis = _date_prefix(text)[0] + int(text[11:13]) * 3600000 + int(text[14:16]) * 60000 + \
+        int(text[17:19]) * 1000
+    if len(text) > 20:
+        millis += int((text[20:23] + '00')[:3])
+    return millis
+
+
+def decode_datetime(text, format=timeformat_millis):
+    """
+    Время Транзака в datetime с кэшированием даты.
+    Строки другой формы разбираются через strptime (с его исключениями).
+
+    :param text:
+        Строка времени.
+    :param format:
+        timeformat или timeformat_millis.
+    :return:
+        datetime.
+    """
+    if _is_transaq_time(text) and (len(text) > 19) == (format == timeformat_millis) \
+            and format in (timeformat, timeformat_millis):
+        millis, year, month, day = _date_prefix(text)
+        micros = int((text[20:26] + '00000')[:6]) if len(text) > 20 else 0
+        return datetime(year, month, day, int(text[11:13]), int(text[14:16]), int(text[17:19]), micros)
+    return datetime.strptime(text, format)
+
+
+class TransaqDateTimeMapper(DateTimeMapper):
+    """
+    DateTimeMapper с быстрым разбором форматов Транзака (см. decode_datetime).
+    """
+
+    def to_python(self, node):
+        if node is None:
+            return None
+        if isinstance(node, str):
+            rep = node
+        else:
+            rep = self.XPATH(node)
+        if self.format in (timeformat, timeformat_millis) and _is_transaq_time(rep):
+            return decode_datetime(rep, self.format)
+        return super(TransaqDateTimeMapper, self).to_python(rep)
+
+
+class NullableDateTimeMapper(TransaqDateTimeMapper):
     """
     Оберточный класс вокруг DateTimeMapper,
         возвращающий None для заданных значений, а не вываливающий исключение при обработке даты.
@@ -61,7 +284,47 @@ class NullableDateTimeMapper(DateTimeMapper):
         if rep in self.nones:
             return None
         else:
-            return super(NullableDateTimeMapper, self).to_python(node)
+            return super(NullableDateTimeMapper, self).to_python(rep)
+
+
+class MillisMapper(Mapper):
+    """
+    Время Транзака сразу в миллисекунды от эпохи (UTC), None для пустых и нулевых значений.
+    """
+    XPATH = etree.XPath('string()')
+    nones = ['', '0']
+
+    def to_python(self, node):
+        if node is None:
+            return None
+        if isinstance(node, str):
+            rep = node
+        else:
+            rep = self.XPATH(node)
+        if rep in self.nones:
+            return None
+        return decode_millis(rep)
+
+
+class TransaqDateTimeField(DateTimeField):
+    """
+    DateTimeField с быстрым разбором времени Транзака.
+    """
+
+    def __init__(self, xpath, format=None, *args, **kwargs):
+        super(TransaqDateTimeField, self).__init__(xpath, format, *args, **kwargs)
+        self.mapper = TransaqDateTimeMapper(format=format)
+
+
+class MillisField(Field):
+    """
+    Время Транзака в миллисекундах от эпохи (int), без промежуточного datetime.
+    """
+
+    def __init__(self, xpath, *args, **kwargs):
+        super(MillisField, self).__init__(xpath,
+                                          manager=SingleNodeManager(),
+                                          mapper=MillisMapper(), *args, **kwargs)
 
 
 class MyXmlObject(XmlObject):
@@ -71,7 +334,19 @@ class MyXmlObject(XmlObject):
 
     @classmethod
     def parse(cls, xml):
-        return load_xmlobject_from_string(xml, cls)
+        return cls.from_element(parseString(xml))
+
+    @classmethod
+    def from_element(cls, root):
+        """
+        Построить объект из уже разобранного lxml элемента.
+
+        :param root:
+            Корневой элемент структуры.
+        :return:
+            Объект класса.
+        """
+        return cls(root)
 
     def __repr__(self):
         cls = self.__class__
@@ -134,7 +409,7 @@ class HistoryCandle(Entity):
     Свечки OHLCV (open,high,low,close).
     """
     ROOT_NAME = 'candle'
-    date = DateTimeField('@date', timeformat)
+    date = TransaqDateTimeField('@date', timeformat)
     id = hash(date)
     open = FloatField('@open')
     high = FloatField('@high')
@@ -292,6 +567,20 @@ class SecurityPacket(Packet):
     items = NodeListField('security', Security)
 
 
+class SecurityStream(SecurityPacket):
+    """
+    Потоковый пакет ценных бумаг: items - одноразовый итератор Security.
+    Включается через set_streaming_securities().
+    """
+    items = []
+
+    @classmethod
+    def stream(cls, xml):
+        result = cls()
+        result.items = iter_items(xml, Security.ROOT_NAME, Security)
+        return result
+
+
 class SecInfo(Entity):
     """
     Доп. информация по инструменту.
@@ -307,7 +596,7 @@ class SecInfo(Entity):
     # Единицы измерения цены
     pname = StringField('pname')
     # Дата погашения
-    mat_date = DateTimeField('mat_date', timeformat)
+    mat_date = TransaqDateTimeField('mat_date', timeformat)
     # Цена последнего клиринга (только FORTS)
     clearing_price = FloatField('clearing_price')
     # Минимальная цена (только FORTS)
@@ -327,7 +616,7 @@ class SecInfo(Entity):
     # Размер купона, руб
     coupon_value = FloatField('coupon_value')
     # Дата погашения купона
-    coupon_date = DateTimeField('coupon_date', timeformat)
+    coupon_date = TransaqDateTimeField('coupon_date', timeformat)
     # Период выплаты купона, дни
     coupon_period = IntegerField('coupon_period')
     # Номинал облигации или акции, руб
@@ -413,7 +702,7 @@ class Quotation(Entity):
     # Цена последней сделки
     last_price = FloatField('last')
     # Время заключения последней сделки
-    last_time = DateTimeField('time', timeformat)
+    last_time = TransaqDateTimeField('time', timeformat)
     # Объем последней сделки, в лотах
     last_quantity = IntegerField('quantity')
     # Изменение цены последней сделки по отношению к цене последней сделки предыдущего торгового дня
@@ -475,7 +764,8 @@ class Trade(Entity):
     # Биржевой номер сделки
     id = trade_no = IntegerField('tradeno')
     # Время сделки
-    time = DateTimeField('time', timeformat_millis)
+    time = TransaqDateTimeField('time', timeformat_millis)
+    time_millis = MillisField('time')
     # Цена сделки
     price = StringField('price')
     # Объём в лотах
@@ -542,7 +832,8 @@ class BaseOrder(Entity):
     # Цена
     price = FloatField('price')
     # Время регистрации заявки биржей
-    time = DateTimeField('time', timeformat_millis)
+    time = TransaqDateTimeField('time', timeformat_millis)
+    time_millis = MillisField('time')
     # Идентификатор клиента
     client = StringField('client')
     # Cтатус заявки
@@ -550,17 +841,17 @@ class BaseOrder(Entity):
     # Покупка (B) / Продажа (S)
     buysell = StringField('buysell', choices=('B', 'S'))
     # Дата экспирации (только для ФОРТС)
-    exp_date = DateTimeField('expdate', timeformat)
+    exp_date = TransaqDateTimeField('expdate', timeformat)
     # Примечание
     broker_ref = StringField('brokerref')
     # Время регистрации заявки сервером Transaq (только для условных заявок)
-    accept_time = DateTimeField('accepttime', timeformat)
+    accept_time = TransaqDateTimeField('accepttime', timeformat)
     # До какого момента действительно
-    valid_before = DateTimeField('validbefore', timeformat)
+    valid_before = TransaqDateTimeField('validbefore', timeformat)
     # Количество лотов
     quantity = IntegerField('quantity')
     # Время снятия заявки, 0 для активных
-    withdraw_time = DateTimeField('withdrawtime', timeformat_millis)
+    withdraw_time = TransaqDateTimeField('withdrawtime', timeformat_millis)
     withdraw_time.mapper = NullableDateTimeMapper(timeformat_millis)
     # Сообщение биржи в случае отказа выставить заявку
     result = StringField('result')
@@ -587,7 +878,7 @@ class Order(BaseOrder):
     # Цена для условной заявки, либо обеспеченность в процентах
     condition_value = FloatField('conditionvalue')
     # С какого момента времени действительна
-    valid_after = DateTimeField('valid_after', timeformat)
+    valid_after = TransaqDateTimeField('valid_after', timeformat)
     # Максимальная комиссия по сделкам заявки
     max_commission = FloatField('maxcomission')
 
@@ -605,7 +896,7 @@ class StopOrder(BaseOrder):
     # Привязка к стандартной заявке
     linked_order_no = IntegerField('linkedorderno')
     # У стопов почему то нет времени активации
-    time = None
+    time = time_millis = None
 
 
 class StopLoss(StopOrder):
@@ -617,7 +908,7 @@ class StopLoss(StopOrder):
     bymarket = ItemField('bymarket')
     # Защитное время удержания цены
     # (когда цены на рынке лишь кратковременно достигают уровня цены активации, и вскоре возвращаются обратно)
-    guard_time = DateTimeField('stoploss/guardtime', timeformat)
+    guard_time = TransaqDateTimeField('stoploss/guardtime', timeformat)
     # Примечание
     broker_ref = StringField('stoploss/brokerref')
     # Количество лотов
@@ -631,7 +922,7 @@ class TakeProfit(StopOrder):
     activation_price = FloatField('takeprofit/activationprice')
     # Защитное время удержания цены
     # (когда цены на рынке лишь кратковременно достигают уровня цены активации, и вскоре возвращаются обратно)
-    guard_time = DateTimeField('takeprofit/guardtime', timeformat)
+    guard_time = TransaqDateTimeField('takeprofit/guardtime', timeformat)
     # Достигнутый максимум
     extremum = FloatField('takeprofit/extremum')
     # Уровень исполнения?
@@ -656,20 +947,24 @@ class ClientOrderPacket(Packet):
     ROOT_NAME = 'orders'
 
     @classmethod
-    def parse(cls, xml):
+    def from_element(cls, root):
         result = ClientOrderPacket()
         result.items = []
-        root = parseString(xml)
         assert root.tag == ClientOrderPacket.ROOT_NAME
+        # Заявки - записями сгенерированных парсеров, если они включены
+        if _compiled or _price_scales is not None:
+            order, stop_loss, take_profit = compiled(Order), compiled(StopLoss), compiled(TakeProfit)
+        else:
+            order, stop_loss, take_profit = Order, StopLoss, TakeProfit
         for child in root:
             if child.tag == Order.ROOT_NAME:
-                result.items.append(Order(child))
+                result.items.append(order.from_element(child))
             elif child.tag == StopOrder.ROOT_NAME:
                 for subchild in child:
                     if subchild.tag == 'stoploss':
-                        result.items.append(StopLoss(child))
+                        result.items.append(stop_loss.from_element(child))
                     elif subchild.tag == 'takeprofit':
-                        result.items.append(TakeProfit(child))
+                        result.items.append(take_profit.from_element(child))
         return result
 
 
@@ -693,7 +988,8 @@ class ClientTrade(Entity):
     # B - покупка, S - продажа
     buysell = StringField('buysell', choices=('B', 'S'))
     # Время сделки
-    time = DateTimeField('time', timeformat_millis)
+    time = TransaqDateTimeField('time', timeformat_millis)
+    time_millis = MillisField('time')
     # Примечание
     broker_ref = StringField('brokerref')
     # Объем сделки
@@ -800,10 +1096,9 @@ class PositionPacket(Packet):
     ROOT_NAME = 'positions'
 
     @classmethod
-    def parse(cls, xml):
+    def from_element(cls, root):
         result = PositionPacket()
         result.items = []
-        root = parseString(xml)
         assert root.tag == PositionPacket.ROOT_NAME
         for child in root:
             if child.tag == 'money_position':
@@ -1018,7 +1313,8 @@ class HistoryTick(Trade):
     """
     ROOT_NAME = 'tick'
     secid = IntegerField('secid')
-    time = DateTimeField('trade_time', timeformat_millis)
+    time = TransaqDateTimeField('trade_time', timeformat_millis)
+    time_millis = MillisField('trade_time')
 
 
 class HistoryTickPacket(Packet):
@@ -1108,7 +1404,7 @@ class TextMessage(Entity):
     """
     ROOT_NAME = 'message'
     # Дата
-    id = date = DateTimeField('date', timeformat)
+    id = date = TransaqDateTimeField('date', timeformat)
     # Срочность
     urgent = SimpleBooleanField('urgent', 'Y', 'N')
     # Отправитель
@@ -1164,7 +1460,7 @@ class NewsHeader(MyXmlObject):
     """
     ROOT_NAME = 'news_header'
     id = IntegerField('id')
-    time = DateTimeField('timestamp', timeformat)
+    time = TransaqDateTimeField('timestamp', timeformat)
     source = StringField('source')
     title = StringField('title')
 
@@ -1323,3 +1619,52 @@ class UnitedPortfolio(MyXmlObject):
         securities = NodeListField('security', _Security)
 
     assets = NodeListField('asset', _Asset)
+
+
+## Реестр корневых тегов для parse()
+
+def _resolve_trade(root):
+    # Сделка с рынка несет secid атрибутом (alltrades), клиентская - дочерним тегом (trades)
+    return Trade if root.get('secid') is not None else ClientTrade
+
+
+def _resolve_stoporder(root):
+    # Тип стопа определяется вложенным тегом, как в ClientOrderPacket
+    for child in root:
+        if child.tag == 'stoploss':
+            return StopLoss
+        elif child.tag == 'takeprofit':
+            return TakeProfit
+    return StopOrder
+
+
+def _build_registry():
+    classes_filter = lambda o: inspect.isclass(o) and issubclass(o, MyXmlObject)
+    for name, cls in inspect.getmembers(sys.modules[__name__], classes_filter):
+        # Наследники с унаследованным ROOT_NAME (StopLoss, TakeProfit) регистрируем через разрешители
+        tag = cls.__dict__.get('ROOT_NAME')
+        if tag and tag not in _resolvers:
+            _registry[tag] = cls
+
+
+_resolvers['trade'] = _resolve_trade
+_resolvers['stoporder'] = _resolve_stoporder
+_build_registry()
+
+# Сделки с рынка в компактных записях сгенерированного парсера (см. set_fast_trades)
+TradeRecord = compact_record_class(Trade)
+
+
+class FastTradePacket(TradePacket):
+    """
+    Пакет сделок с рынка, разобранный в компактные записи TradeRecord.
+    Включается через set_fast_trades().
+    """
+    items = []
+
+    @classmethod
+    def from_element(cls, root):
+        result = cls(root)
+        parser = TradeRecord._parser
+        result.items = [parser(child) for child in root if child.tag == Trade.ROOT_NAME]
+        return result
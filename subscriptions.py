@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Менеджер подписок: нужные (desired) и действующие на сервере (active) подписки хранятся раздельно.
+
+sync() отправляет только разницу, порциями ограниченного размера, для всех видов подписки
+(alltrades - сделки, quotations - котировки, quotes - стакан). Бумага задается secid
+или парой (board, seccode). После обрыва связи connection_lost() сбрасывает active,
+и следующий sync() восстанавливает подписки по (board, seccode), не дожидаясь повторного разбора
+пакета securities. secid не постоянны между сессиями и серверами, поэтому нужные подписки
+по secid при обрыве забываются и задаются заново по новому пакету securities.
+"""
+import logging
+try:
+    import commands
+except ImportError:
+    from . import commands
+
+log = logging.getLogger("subscriptions")
+
+modes = ('alltrades', 'quotations', 'quotes')
+# Вид подписки -> (подписка, отписка) по secid и по (board, seccodes)
+_by_secid = {
+    'alltrades': (commands.subscribe_ids, commands.unsubscribe_ids),
+    'quotations': (commands.subscribe_quotations_ids, commands.unsubscribe_quotations_ids),
+    'quotes': (commands.subscribe_bidasks_ids, commands.unsubscribe_bidasks_ids),
+}
+_by_board = {
+    'alltrades': (commands.subscribe_ticks, commands.unsubscribe_ticks),
+    'quotations': (commands.subscribe_quotations, commands.unsubscribe_quotations),
+    'quotes': (commands.subscribe_bidasks, commands.unsubscribe_bidasks),
+}
+
+
+class SubscriptionManager(object):
+    """
+    Учет и синхронизация подписок с сервером.
+    """
+
+    def __init__(self, chunk_size=200):
+        """
+        :param chunk_size:
+            Максимум бумаг в одной команде подписки.
+        """
+        self.chunk_size = chunk_size
+        self.desired = dict((mode, set()) for mode in modes)
+        self.active = dict((mode, set()) for mode in modes)
+        # Статистика
+        self.commands = 0
+        self.failed = 0
+
+    def want(self, securities, mode='alltrades'):
+        """
+        Добавить бумаги (secid или (board, seccode)) в нужные подписки.
+        """
+        self.desired[mode].update(securities)
+
+    def unwant(self, securities, mode='alltrades'):
+        self.desired[mode].difference_update(securities)
+
+    def set_desired(self, securities, mode='alltrades'):
+        """
+        Заменить набор нужных подписок вида mode.
+        """
+        self.desired[mode] = set(securities)
+
+    def connection_lost(self):
+        """
+        Соединение разорвано: на сервере подписок больше нет. Нужные подписки
+        по (board, seccode) остаются, по secid - сбрасываются (secid в новой сессии могут измениться).
+        """
+        for mode in modes:
+            self.active[mode].clear()
+            self.desired[mode] = set(s for s in self.desired[mode] if isinstance(s, tuple))
+
+    def sync(self):
+        """
+        Подписаться на недостающее и отписаться от лишнего.
+
+        :return:
+            Количество бумаг (подписано, отписано).
+        """
+        added = removed = 0
+        for mode in modes:
+            desired, active = self.desired[mode], self.active[mode]
+            removed += self._send(mode, sorted(active - desired, key=str), 1, active.difference_update)
+            added += self._send(mode, sorted(desired - active, key=str), 0, active.update)
+        return added, removed
+
+    def _send(self, mode, securities, action, on_success):
+        # Разбить на порции по виду ключа (secid или board) и отправить
+        done = 0
+        secids = [s for s in securities if not isinstance(s, tuple)]
+        for i in range(0, len(secids), self.chunk_size):
+            chunk = secids[i:i + self.chunk_size]
+            if self._call(_by_secid[mode][action], chunk):
+                on_success(chunk)
+                done += len(chunk)
+        boards = {}
+        for security in securities:
+            if isinstance(security, tuple):
+                boards.setdefault(security[0], []).append(security[1])
+        for board, seccodes in sorted(boards.items()):
+            for i in range(0, len(seccodes), self.chunk_size):
+                chunk = seccodes[i:i + self.chunk_size]
+                if self._call(_by_board[mode][action], board, chunk):
+                    on_success((board, seccode) for seccode in chunk)
+                    done += len(chunk)
+        return done
+
+    def _call(self, func, *args):
+        # Через планировщик команд, если он запущен
+        self.commands += 1
+        try:
+            result = commands.schedule(func, *args).result()
+        except Exception as e:
+            self.failed += 1
+            log.error(u"%s failed: %s" % (func.__name__, e))
+            return False
+        if not result.success:
+            self.failed += 1
+            log.error(u"%s failed: %s" % (func.__name__, result.text))
+            return False
+        return True
+
+    def stats(self):
+        return {'desired': dict((m, len(s)) for m, s in self.desired.items()),
+                'active': dict((m, len(s)) for m, s in self.active.items()),
+                'commands': self.commands, 'failed': self.failed}
@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+import unittest as ut
+import tempfile, os, socket, time
+import commands as cmd
+from backend import FakeBackend
+from capture import Recorder, read_capture, capture_files, replay
+from exchange import Exchange
+from serialize import Template, escape_text
+from aio import AsyncClient
+from subscriptions import SubscriptionManager
+from filters import SecurityFilter
+from secmaster import SecurityMaster, NEW, CHANGED
+from sinks import UdpSink, TcpSink
+from lines import TradeFormatter, trade_records
+from journal import TradeJournal, read_journal, export_csv
+from structures import Security
+import fnmatch
+import asyncio
+import lxml.etree as et
+from structures import parse, set_fast_trades
+from structures import ServerStatus, TradePacket, ClientOrderPacket, ClientTradePacket, QuotePacket, StopLoss
+
+
+class TestFakeBackend(ut.TestCase):
+    trades = (b'<alltrades><trade secid="1"><tradeno>1</tradeno><price>1.5</price>'
+              b'<quantity>1</quantity></trade></alltrades>')
+
+    def setUp(self):
+        self.got = []
+        self.fake = cmd.set_backend(FakeBackend([self.trades] * 3, rate=1000))
+        cmd.initialize(tempfile.mkdtemp(), 1, self.got.append)
+
+    def tearDown(self):
+        cmd.uninitialize()
+
+    def test_connect(self):
+        received = cmd.native_stats()['received']
+        result = cmd.connect('login', 'password', 'host:3900')
+        self.assertTrue(result.success)
+        self.fake.wait(5)
+        stats = cmd.native_stats()
+        self.assertEqual(stats['received'] - received, 5)
+        self.assertEqual(stats['outstanding'], 0)
+        self.assertIsInstance(self.got[0], ServerStatus)
+        self.assertEqual(self.got[0].connected, 'true')
+        self.assertEqual([type(m) for m in self.got[1:]], [TradePacket] * 3)
+        self.assertEqual(self.fake.pushed, 4)
+        self.assertTrue(self.fake.commands[0].startswith(b'<command id="connect">'))
+
+    def test_deferred(self):
+        cmd.set_interests([ServerStatus], defer=10)
+        try:
+            cmd.connect('login', 'password', 'host:3900')
+            self.fake.wait(5)
+            self.assertEqual([type(m) for m in self.got], [ServerStatus])
+            self.assertEqual(cmd.drain_deferred(), 3)
+            self.assertEqual([type(m) for m in self.got[1:]], [TradePacket] * 3)
+            self.assertEqual(cmd.drain_deferred(), 0)
+        finally:
+            cmd.set_interests()
+
+    def test_native_counters(self):
+        import threading
+        received = cmd.native_stats()['received']
+        threads = [threading.Thread(target=lambda: [cmd.server_status() for _ in range(200)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cmd.native_stats()
+        self.assertEqual(stats['received'] - received, 800)
+        self.assertEqual(stats['outstanding'], 0)
+
+    def test_commands(self):
+        self.assertEqual(cmd.new_order('TQBR', 'SBER', 'C1', 'b', 1).id, 1)
+        self.assertEqual(cmd.new_order('TQBR', 'SBER', 'C1', 's', 1).id, 2)
+        self.assertTrue(cmd.cancel_order(1).success)
+        self.assertEqual(cmd.get_version(), 'fake')
+        self.fake.results['gethistorydata'] = b'<result success="false"><message>no</message></result>'
+        result = cmd.get_history('TQBR', 'SBER', 1, 10)
+        self.assertFalse(result.success)
+        self.assertEqual(result.text, 'no')
+        self.fake.results['server_status'] = b'<error>Not connected</error>'
+        self.assertRaises(cmd.TransaqException, cmd.server_status)
+
+
+    def test_record_replay(self):
+        directory = tempfile.mkdtemp()
+        cmd.start_recording(directory)
+        cmd.connect('login', 'password', 'host:3900')
+        self.fake.wait(5)
+        cmd.stop_recording()
+        files = capture_files(directory)
+        self.assertEqual(len(files), 1)
+        records = list(read_capture(files[0]))
+        self.assertEqual([m for t, m in records][1:], [self.trades] * 3)
+        self.assertEqual(sorted(t for t, m in records), [t for t, m in records])
+        del self.got[:]
+        self.assertEqual(cmd.replay_capture(files, speed=10.0), 4)
+        self.assertEqual([type(m) for m in self.got], [ServerStatus] + [TradePacket] * 3)
+
+
+class TestCapture(ut.TestCase):
+    def test_chunks(self):
+        directory = tempfile.mkdtemp()
+        rec = Recorder(directory, chunk_size=100)
+        msgs = [('<msg n="%d"/>' % i).encode() for i in range(50)]
+        for i, msg in enumerate(msgs):
+            rec.record(msg, timestamp=i * 1000)
+        rec.close()
+        # Повторное открытие дописывает новую сессию в тот же файл
+        rec = Recorder(directory)
+        rec.record(b'<last/>', timestamp=10 ** 6)
+        rec.close()
+        path = capture_files(directory)[0]
+        self.assertEqual([m for t, m in read_capture(path)], msgs + [b'<last/>'])
+        with open(path, 'ab') as f:
+            f.write(b'C\xff\x00\x00\x00broken')
+        got = []
+        self.assertEqual(replay(path, got.append), 51)
+
+    def test_torn_tail(self):
+        directory = tempfile.mkdtemp()
+        rec = Recorder(directory, chunk_size=10)
+        for i in range(3):
+            rec.record(b'<before n="%d"/>' % i)
+        rec.close()
+        path = capture_files(directory)[0]
+        # Сбой посреди записи куска
+        with open(path, 'ab') as f:
+            f.write(b'C\xff\x00\x00\x00torn')
+        rec = Recorder(directory, chunk_size=10)
+        for i in range(3):
+            rec.record(b'<after n="%d"/>' % i)
+        rec.close()
+        self.assertEqual([m for t, m in read_capture(path)],
+                         [b'<before n="%d"/>' % i for i in range(3)] + [b'<after n="%d"/>' % i for i in range(3)])
+
+    def test_damaged_chunk(self):
+        directory = tempfile.mkdtemp()
+        rec = Recorder(directory)
+        rec.record(b'<first/>')
+        rec.close()
+        path = capture_files(directory)[0]
+        # Кусок записан целиком, но не распаковывается - чтение останавливается на нем
+        with open(path, 'ab') as f:
+            f.write(b'C\x06\x00\x00\x00broken')
+        self.assertEqual([m for t, m in read_capture(path)], [b'<first/>'])
+
+    def test_replay_errors(self):
+        directory = tempfile.mkdtemp()
+        rec = Recorder(directory)
+        for msg in (b'<error>Timeout</error>', b'<ok/>'):
+            rec.record(msg)
+        rec.close()
+        got = []
+
+        def handler(msg):
+            if msg.startswith(b'<error>'):
+                raise cmd.TransaqException(msg)
+            got.append(msg)
+        self.assertEqual(replay(capture_files(directory), handler), 2)
+        self.assertEqual(got, [b'<ok/>'])
+
+
+
+class TestExchange(ut.TestCase):
+    def setUp(self):
+        self.got = []
+        self.exchange = cmd.set_backend(Exchange({('TQBR', 'SBER'): 7}))
+        cmd.initialize(tempfile.mkdtemp(), 1, self.got.append)
+
+    def tearDown(self):
+        cmd.uninitialize()
+
+    def received(self, cls):
+        self.exchange.wait_idle()
+        return [item for msg in self.got if isinstance(msg, cls) for item in msg.items]
+
+    def test_matching(self):
+        first = cmd.new_order('TQBR', 'SBER', 'C1', 's', 5, 100.5, bymarket=False).id
+        second = cmd.new_order('TQBR', 'SBER', 'C1', 's', 5, 100.5, bymarket=False).id
+        cheaper = cmd.new_order('TQBR', 'SBER', 'C1', 's', 5, 100.1, bymarket=False).id
+        buy = cmd.new_order('TQBR', 'SBER', 'C2', 'b', 8, 101, bymarket=False).id
+        trades = self.received(TradePacket)
+        self.assertEqual([(t.secid, t.price, t.quantity, t.buysell) for t in trades],
+                         [(7, '100.1', 5, 'B'), (7, '100.5', 3, 'B')])
+        orders = dict((o.id, o) for o in self.received(ClientOrderPacket))
+        self.assertEqual(orders[cheaper].status, 'matched')
+        self.assertEqual(orders[first].balance, 2)
+        self.assertEqual(orders[second].balance, 5)
+        self.assertEqual(orders[buy].status, 'matched')
+        self.assertEqual(len(self.received(ClientTradePacket)), 4)
+        quotes = self.received(QuotePacket)
+        self.assertEqual((quotes[-1].price, quotes[-1].sell), (100.5, 7))
+
+        self.assertTrue(cmd.cancel_order(first).success)
+        self.assertFalse(cmd.cancel_order(first).success)
+        moved = cmd.move_order(second, 100.7).id
+        orders = dict((o.id, o) for o in self.received(ClientOrderPacket))
+        self.assertEqual(orders[first].status, 'cancelled')
+        self.assertEqual(orders[second].status, 'cancelled')
+        self.assertEqual((orders[moved].price, orders[moved].balance), (100.7, 5))
+
+    def test_stoploss(self):
+        cmd.new_order('TQBR', 'SBER', 'C1', 'b', 10, 99, bymarket=False)
+        stop = cmd.new_stoploss('TQBR', 'SBER', 'C1', 's', 4, 100).id
+        cmd.new_order('TQBR', 'SBER', 'C1', 's', 1, 101, bymarket=False)
+        cmd.new_order('TQBR', 'SBER', 'C2', 'b', 1, bymarket=True)
+        self.assertEqual(len(self.received(TradePacket)), 1)
+        cmd.new_order('TQBR', 'SBER', 'C2', 's', 1, bymarket=True)
+        trades = self.received(TradePacket)
+        self.assertEqual([(t.price, t.quantity, t.buysell) for t in trades[1:]], [('99', 1, 'S'), ('99', 4, 'S')])
+        stops = [o for o in self.received(ClientOrderPacket) if isinstance(o, StopLoss)]
+        self.assertEqual([s.status for s in stops], ['watching', 'sl_executed'])
+        self.assertEqual(stops[-1].id, stop)
+
+    def test_escaping(self):
+        cmd.new_order('TQBR', 'SBER', 'A&B <1>', 's', 5, 100.5, bymarket=False)
+        cmd.new_order('TQBR', 'SBER', 'C2', 'b', 5, 101, bymarket=False)
+        orders = self.received(ClientOrderPacket)
+        self.assertEqual(orders[0].client, 'A&B <1>')
+        self.assertEqual([t.client for t in self.received(ClientTradePacket)], ['C2', 'A&B <1>'])
+        # Время сообщений - UTC, как при utc_time=true
+        self.assertLess(abs(orders[0].time_millis - time.time() * 1000), 60000)
+
+
+
+class TestSerialize(ut.TestCase):
+    def test_escape(self):
+        root = et.Element('command', {'id': 'x', 'client': 'a&<>"\n\r\t\'\xe9'})
+        et.SubElement(root, 'text').text = 'a&<>"\n\r\t\'\xe9]]>'
+        et.SubElement(root, 'empty')
+        et.SubElement(root, 'blank').text = ''
+        template = Template('<command id="x" client="{@}">{text}{empty}{blank}</command>')
+        self.assertEqual(template.fill('a&<>"\n\r\t\'\xe9', 'a&<>"\n\r\t\'\xe9]]>', None, ''),
+                         et.tostring(root, encoding='utf-8'))
+        self.assertRaises(ValueError, escape_text, 'a\x01')
+
+    def test_commands(self):
+        fake = cmd.set_backend(FakeBackend())
+        cmd.new_order('TQBR', 'SBER', 'C1', 'b', 10, 101.5, bymarket=False)
+        cmd.subscribe_ids([])
+        root = et.Element('command', {'id': 'neworder'})
+        security = et.SubElement(root, 'security')
+        for parent, tag, text in ((security, 'board', 'TQBR'), (security, 'seccode', 'SBER'), (root, 'client', 'C1'),
+                                  (root, 'buysell', 'B'), (root, 'quantity', '10'), (root, 'price', '101.5')):
+            et.SubElement(parent, tag).text = text
+        et.SubElement(root, 'usecredit')
+        self.assertEqual(fake.commands, [et.tostring(root, encoding='utf-8'),
+                                         b'<command id="subscribe"><alltrades/></command>'])
+
+
+
+class TestAsyncClient(ut.TestCase):
+    def run_client(self, backend, scenario):
+        cmd.set_backend(backend)
+
+        async def run():
+            client = AsyncClient()
+            client.initialize(tempfile.mkdtemp(), 1)
+            try:
+                return await scenario(client)
+            finally:
+                client.uninitialize()
+        return asyncio.run(run())
+
+    def test_orders(self):
+        async def scenario(client):
+            status = await client.connect('login', 'password', 'host:3900', timeout=5)
+            self.assertEqual(status.connected, 'true')
+            trades = client.stream(TradePacket)
+            sell = await client.new_order('TQBR', 'SBER', 'C1', 's', 5, 100, bymarket=False, timeout=5)
+            self.assertEqual((sell.status, sell.balance), ('active', 5))
+            buy = await client.new_order('TQBR', 'SBER', 'C1', 'b', 2, timeout=5)
+            self.assertEqual(buy.status, 'matched')
+            packet = await asyncio.wait_for(trades.__anext__(), 5)
+            self.assertEqual(packet.items[0].quantity, 2)
+            cancelled = await client.cancel_order(sell.id, timeout=5)
+            self.assertEqual((cancelled.status, cancelled.balance), ('cancelled', 3))
+            trades.close()
+            self.assertEqual([p async for p in trades], [])
+        self.run_client(Exchange(), scenario)
+
+    def test_timeout(self):
+        async def scenario(client):
+            with self.assertRaises(asyncio.TimeoutError):
+                await client.new_order('TQBR', 'SBER', 'C1', 'b', 1, timeout=0.05)
+            self.assertEqual(client._orders, {})
+        self.run_client(FakeBackend(), scenario)
+
+
+
+class TestSubscriptions(ut.TestCase):
+    def test_sync(self):
+        fake = cmd.set_backend(FakeBackend())
+        subs = SubscriptionManager(chunk_size=2)
+        subs.want([1, 2, 3])
+        subs.want([('TQBR', 'SBER')], 'quotes')
+        self.assertEqual(subs.sync(), (4, 0))
+        self.assertEqual(fake.commands, [
+            b'<command id="subscribe"><alltrades><secid>1</secid><secid>2</secid></alltrades></command>',
+            b'<command id="subscribe"><alltrades><secid>3</secid></alltrades></command>',
+            b'<command id="subscribe"><quotes><security><board>TQBR</board><seccode>SBER</seccode>'
+            b'</security></quotes></command>'])
+        del fake.commands[:]
+        subs.set_desired([2, 3, 4])
+        self.assertEqual(subs.sync(), (1, 1))
+        self.assertEqual(fake.commands, [
+            b'<command id="unsubscribe"><alltrades><secid>1</secid></alltrades></command>',
+            b'<command id="subscribe"><alltrades><secid>4</secid></alltrades></command>'])
+        self.assertEqual(subs.sync(), (0, 0))
+        # После обрыва восстанавливаются подписки по коду, secid ждут нового пакета securities
+        subs.want([('TQBR', 'GAZP')])
+        subs.connection_lost()
+        self.assertEqual(subs.desired['alltrades'], set([('TQBR', 'GAZP')]))
+        del fake.commands[:]
+        self.assertEqual(subs.sync(), (2, 0))
+        self.assertEqual(fake.commands, [
+            b'<command id="subscribe"><alltrades><security><board>TQBR</board><seccode>GAZP</seccode>'
+            b'</security></alltrades></command>',
+            b'<command id="subscribe"><quotes><security><board>TQBR</board><seccode>SBER</seccode>'
+            b'</security></quotes></command>'])
+        fake.results['subscribe'] = b'<result success="false"><message>no</message></result>'
+        subs.connection_lost()
+        self.assertEqual(subs.sync(), (0, 0))
+        self.assertEqual(subs.stats()['active'], {'alltrades': 0, 'quotations': 0, 'quotes': 0})
+
+
+
+class TestSecurityFilter(ut.TestCase):
+    patterns = ['MCT:*.XLON', 'MCT:FUT*', 'ZLG:XS*']
+
+    def security(self, secid, board, seccode, name='Name'):
+        return Security.parse('<security secid="%d"><board>%s</board><seccode>%s</seccode><shortname>%s</shortname></security>'
+                              % (secid, board, seccode, name))
+
+    def test_match(self):
+        f = SecurityFilter(self.patterns, ['MCT:RDS.B'], ['MCT:FUTSI'], ['EURUSD'])
+        names = ['MCT:RDS B', 'MCT:VOD.XLON', 'MCT:FUTSI', 'MCT:FUTRTS', 'ZLG:XS1', 'TQBR:SBER', 'MCT:FUTEU']
+        got = [f.match(self.security(i, *n.split(':'), name='EURUSD fut' if n == 'MCT:FUTEU' else 'x'))
+               for i, n in enumerate(names)]
+        self.assertEqual(got, [True, True, False, True, True, False, False])
+        for name in names[1:]:
+            self.assertEqual(f._cache[tuple(name.split(':'))] == 'pattern',
+                             any(fnmatch.fnmatch(name, p) for p in self.patterns)
+                             and name not in ('MCT:FUTSI', 'MCT:FUTEU'))
+        # Уже подписанная по шаблону бумага не подписывается повторно, из include - всегда
+        self.assertFalse(f.match(self.security(3, 'MCT', 'FUTRTS'), {3: 'UTC'}))
+        self.assertTrue(f.match(self.security(0, 'MCT', 'RDS B'), {0: 'UTC'}))
+        stats = f.stats()
+        self.assertEqual((stats['cache_misses'], stats['cache_hits']), (7, 2))
+        self.assertEqual((stats['pattern'], stats['include'], stats['no_match']), (4, 2, 1))
+
+
+class TestSecurityMaster(ut.TestCase):
+    def security(self, secid, seccode, minstep):
+        return Security.parse('<security secid="%d" active="true"><board>TQBR</board><seccode>%s</seccode>'
+                              '<shortname>Имя</shortname><minstep>%s</minstep><decimals>2</decimals></security>'
+                              % (secid, seccode, minstep))
+
+    def test_reconcile_and_load(self):
+        path = os.path.join(tempfile.mkdtemp(), 'securities.json')
+        master = SecurityMaster(path)
+        self.assertEqual(master.load(), 0)
+        self.assertEqual([master.update(self.security(1, 'SBER', 0.01)),
+                          master.update(self.security(2, 'GAZP', 0.01)),
+                          master.update(self.security(1, 'SBER', 0.01))], [NEW, NEW, None])
+        self.assertTrue(master.save())
+        self.assertFalse(master.save())
+        warm = SecurityMaster(path)
+        self.assertEqual(warm.load(), 2)
+        self.assertEqual(warm.get(1), master.get(1))
+        self.assertEqual((warm.find('TQBR', 'GAZP').secid, warm.get(1).name, warm.get(1).active), (2, u'Имя', True))
+        self.assertIsNone(warm.update(self.security(2, 'GAZP', 0.01)))
+        self.assertEqual(warm.update(self.security(2, 'GAZP', 0.1)), CHANGED)
+        self.assertEqual(warm.update(self.security(2, 'GAZP2', 0.1)), CHANGED)
+        self.assertIsNone(warm.find('TQBR', 'GAZP'))
+        self.assertEqual(warm.stats()['changed'], 2)
+        # Код пришел с другим secid (новая сессия) - старый secid удаляется
+        self.assertEqual(warm.update(self.security(9, 'SBER', 0.01)), NEW)
+        self.assertIsNone(warm.get(1))
+        self.assertEqual((warm.find('TQBR', 'SBER').secid, len(warm)), (9, 2))
+
+
+class TestUdpSink(ut.TestCase):
+    def test_batching(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        sink = UdpSink(server.getsockname(), mtu=30, flush_interval=None)
+        for i in range(5):
+            sink.send('line,%d' % i)
+        self.assertEqual(server.recv(100), b'line,0\nline,1\nline,2\nline,3\n')
+        sink.send(b'x' * 40)
+        self.assertEqual(server.recv(100), b'line,4\n')
+        self.assertEqual(server.recv(100), b'x' * 40 + b'\n')
+        sink.close()
+        self.assertEqual(sink.stats(), {'lines': 6, 'delivered': 6, 'dropped': 0, 'batches': 3, 'bytes': 76,
+                                        'errors': 0, 'backlog': 0})
+
+    def test_timer(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        sink = UdpSink(server.getsockname(), flush_interval=0.01)
+        self.addCleanup(sink.close)
+        sink.send('series e:a m:b=1')
+        self.assertEqual(server.recv(100), b'series e:a m:b=1\n')
+
+
+def parsed_trades(fast=False):
+    """
+    Сделки из разобранного пакета alltrades, как их видит main.callback.
+    """
+    xml = (b'<alltrades>'
+           b'<trade secid="7"><tradeno>123</tradeno><board>MCT</board><seccode>RDS B</seccode><price>25.50</price>'
+           b'<quantity>10</quantity><time>01.02.2020 10:00:00.123</time><buysell>B</buysell></trade>'
+           b'<trade secid="8"><tradeno>1152921504606846977</tradeno><board>TQBR</board><seccode>SBER</seccode>'
+           b'<price>250</price><quantity>1</quantity><time>01.02.2020 10:00:00.124</time><buysell>S</buysell></trade>'
+           b'<trade secid="7"><tradeno>5</tradeno><board>MCT</board><seccode>RDS B</seccode><price>0.1</price>'
+           b'<time>01.02.2020 10:00:00.125</time></trade>'
+           b'</alltrades>')
+    set_fast_trades(fast)
+    try:
+        return parse(xml).items
+    finally:
+        set_fast_trades(False)
+
+
+class TestTradeFormatter(ut.TestCase):
+    def test_lines(self):
+        for fast in (False, True):
+            f = TradeFormatter()
+            f.register(7, 'MCT', 'RDS B')
+            trades = trade_records(parsed_trades(fast))
+            self.assertEqual([f.format(t) for t in trades],
+                             [b'123,1580551200123,0,MCT,RDS.B,transaq,B,10,25.50,',
+                              b'%d,1580551200124,0,TQBR,SBER,transaq,S,1,250,' % trades[1][1],
+                              b'5,1580551200125,0,MCT,RDS.B,transaq,None,None,0.1,'])
+            # Прежний формат для номеров, точно представимых во float
+            trade = parsed_trades(fast)[0]
+            self.assertEqual(f.format(trades[0]), ("%.0f,%s,%s,%s,%s,%s,%s,%s,%s,%s" % (
+                trade.id, trade.time_millis, 0, trade.board, 'RDS.B', 'transaq', trade.buysell, trade.quantity,
+                trade.price, '')).encode())
+            # Цена в фиксированной точке - целое, выводится с количеством знаков бумаги
+            self.assertRaises(ValueError, f.format, trades[1][:7] + (25000,))
+            f.register(8, 'TQBR', 'SBER', 2)
+            self.assertEqual(f.format(trades[1][:7] + (25000,)),
+                             b'%d,1580551200124,0,TQBR,SBER,transaq,S,1,250.00,' % trades[1][1])
+            self.assertEqual(f.stats(), {'securities': 2, 'misses': 1, 'slow': 1})
+        # Быстрый разбор (как в main) сохраняет большой номер сделки, строка выводит его точно
+        self.assertEqual(f.format(trades[1]), b'1152921504606846977,1580551200124,0,TQBR,SBER,transaq,S,1,250,')
+
+
+class TestTradeJournal(ut.TestCase):
+    def setUp(self):
+        # Сделки как из main.callback, плюс цена в фиксированной точке
+        self.trades = trade_records(parsed_trades(True))
+        self.trades.append(self.trades[1][:7] + (25000,))
+        self.formatter = TradeFormatter()
+        self.formatter.register(8, 'TQBR', 'SBER', 2)
+
+    def test_binary_export(self):
+        directory = tempfile.mkdtemp()
+        text, binary = os.path.join(directory, 'trades.csv'), os.path.join(directory, 'trades.bin')
+        journals = TradeJournal(text, formatter=self.formatter), TradeJournal(binary, binary=True,
+                                                                               formatter=self.formatter)
+        for journal in journals:
+            journal.write(self.trades[:2])
+            journal.write(self.trades[2:])
+            journal.close()
+        # Целая цена читается строкой с количеством знаков бумаги
+        self.assertEqual(list(read_journal(binary)), self.trades[:3] + [self.trades[1][:7] + ('250.00',)])
+        self.assertEqual(export_csv(binary, os.path.join(directory, 'export.csv')), 4)
+        with open(text, 'rb') as f, open(os.path.join(directory, 'export.csv'), 'rb') as exported:
+            lines = f.read()
+            self.assertEqual(exported.read(), lines)
+        self.assertEqual(lines.splitlines(), [
+            b'123,1580551200123,0,MCT,RDS.B,transaq,B,10,25.50,',
+            b'1152921504606846977,1580551200124,0,TQBR,SBER,transaq,S,1,250,',
+            b'5,1580551200125,0,MCT,RDS.B,transaq,None,None,0.1,',
+            b'1152921504606846977,1580551200124,0,TQBR,SBER,transaq,S,1,250.00,'])
+        # Без количества знаков целая цена не записывается
+        journal = TradeJournal(binary, binary=True)
+        self.addCleanup(journal.close)
+        self.assertRaises(ValueError, journal.write, self.trades[3:])
+        # Недописанная запись в конце пропускается
+        with open(binary, 'ab') as f:
+            f.write(b'D\x07\x00')
+        self.assertEqual(len(list(read_journal(binary))), 4)
+        # После перезапуска хвост отрезается, новые записи идут за последней целой
+        journal = TradeJournal(binary, binary=True)
+        journal.write(self.trades[:1])
+        journal.close()
+        self.assertEqual(list(read_journal(binary))[3:], [self.trades[1][:7] + ('250.00',), self.trades[0]])
+        with open(text, 'ab') as f:
+            f.write(b'77,158055')
+        journal = TradeJournal(text)
+        journal.write(self.trades[:1])
+        journal.close()
+        with open(text, 'rb') as f:
+            self.assertEqual(f.read(), lines + b'123,1580551200123,0,MCT,RDS.B,transaq,B,10,25.50,\n')
+
+    def test_rotation(self):
+        path = os.path.join(tempfile.mkdtemp(), 'trades.csv')
+        with open(path, 'wb') as f:
+            f.write(b'old\n')
+        # Файл от прошлого дня ротируется при первой записи
+        day = time.time() - 86400
+        os.utime(path, (day, day))
+        journal = TradeJournal(path)
+        journal.write(self.trades[:1])
+        journal.close()
+        rotated = path + '.' + time.strftime('%Y-%m-%d', time.localtime(day))
+        with open(rotated, 'rb') as f:
+            self.assertEqual(f.read(), b'old\n')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'123,1580551200123,0,MCT,RDS.B,transaq,B,10,25.50,\n')
+        self.assertEqual(journal.stats()['rotations'], 1)
+
+
+class TestTcpSink(ut.TestCase):
+    def listen(self, port=0):
+        server = socket.socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', port))
+        server.listen(1)
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        return server
+
+    def read_lines(self, server, count):
+        conn = server.accept()[0]
+        self.addCleanup(conn.close)
+        conn.settimeout(5)
+        data = b''
+        while data.count(b'\n') < count:
+            data += conn.recv(65536)
+        return data.splitlines()
+
+    def test_reconnect(self):
+        server = self.listen()
+        address = server.getsockname()
+        server.close()
+        sink = TcpSink(address, batch_size=100, retry_delay=0.01, max_retry_delay=0.05, max_backlog=1000)
+        self.addCleanup(sink.close, 0)
+        for i in range(200):
+            sink.send('%d,trade' % i)
+        # ATSD недоступен: строки копятся в ограниченном backlog
+        while not sink.stats()['errors']:
+            time.sleep(0.01)
+        server = self.listen(address[1])
+        self.assertTrue(sink.flush())
+        stats = sink.stats()
+        self.assertGreater(stats['dropped'], 0)
+        self.assertEqual(stats['delivered'] + stats['dropped'], 200)
+        self.assertEqual((stats['connects'], stats['backlog']), (1, 0))
+        lines = self.read_lines(server, stats['delivered'])
+        self.assertEqual(lines[0], b'%d,trade' % stats['dropped'])
+        self.assertEqual(lines[-1], b'199,trade')
+
+    def test_pipelining(self):
+        server = self.listen()
+        sink = TcpSink(server.getsockname(), flush_interval=None)
+        self.addCleanup(sink.close)
+        for i in range(10000):
+            sink.send('%d,trade' % i)
+        sink.flush()
+        lines = self.read_lines(server, 10000)
+        self.assertEqual(lines, [b'%d,trade' % i for i in range(10000)])
+        stats = sink.stats()
+        self.assertEqual((stats['connects'], stats['delivered'], stats['errors']), (1, 10000, 0))
+        self.assertLess(stats['batches'], 10)
+
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+import unittest as ut
+import threading
+from dispatch import RingBuffer, Dispatcher
+from pipeline import Pipeline, split_by_secid, trade_tuples
+from scheduler import CommandScheduler, ORDERS, SUBSCRIPTIONS, REQUESTS, lane_of
+from output import OutputStage, BLOCK, DROP_OLDEST, SPILL
+import time
+
+
+class TestRingBuffer(ut.TestCase):
+    def test_order(self):
+        buf = RingBuffer(4)
+        for i in range(3):
+            self.assertTrue(buf.put(i))
+        self.assertEqual([buf.get(0), buf.get(0), buf.get(0)], [0, 1, 2])
+        self.assertEqual(buf.get(0), None)
+
+    def test_overflow(self):
+        buf = RingBuffer(2)
+        self.assertTrue(buf.put(b'a'))
+        self.assertTrue(buf.put(b'b'))
+        self.assertFalse(buf.put(b'c'))
+        self.assertEqual(buf.get(0), b'a')
+        self.assertTrue(buf.put(b'd'))
+        stats = buf.stats()
+        self.assertEqual(stats['depth'], 2)
+        self.assertEqual(stats['high_water'], 2)
+        self.assertEqual(stats['received'], 3)
+        self.assertEqual(stats['dropped'], 1)
+
+
+class TestDispatcher(ut.TestCase):
+    def test_dispatch(self):
+        got = []
+        done = threading.Event()
+
+        def handler(msg):
+            if msg == b'bad':
+                raise ValueError(msg)
+            got.append(msg)
+            if len(got) == 100:
+                done.set()
+
+        d = Dispatcher(handler)
+        d.start()
+        d.put(b'bad')
+        for i in range(100):
+            d.put(i)
+        self.assertTrue(done.wait(5))
+        d.stop()
+        self.assertEqual(got, list(range(100)))
+        self.assertEqual(d.stats()['errors'], 1)
+
+
+
+class TestPipeline(ut.TestCase):
+    xml = (b'<alltrades>'
+           b'<trade secid="1"><tradeno>1</tradeno><price>1.5</price><quantity>1</quantity></trade>'
+           b'<trade secid="2"><tradeno>2</tradeno><price>2.5</price><quantity>2</quantity></trade>'
+           b'<trade secid="3"><tradeno>3</tradeno><price>3.5</price><quantity>3</quantity></trade>'
+           b'<trade secid="1"><tradeno>4</tradeno><price>1.6</price><quantity>4</quantity></trade>'
+           b'</alltrades>')
+
+    def test_split(self):
+        parts = split_by_secid(self.xml, 2)
+        self.assertEqual(sorted(parts), [0, 1])
+        self.assertTrue(parts[1].startswith(b'<alltrades><trade secid="1">'))
+        self.assertTrue(parts[1].endswith(b'</trade></alltrades>'))
+        self.assertEqual(parts[1].count(b'<trade '), 3)
+        self.assertEqual(split_by_secid(b'<server_status connected="true"/>', 2), None)
+
+    def test_split_without_secid(self):
+        xml = (b'<alltrades>'
+               b'<trade secid="1"><tradeno>1</tradeno></trade>'
+               b'<trade><tradeno>2</tradeno></trade>'
+               b'</alltrades>')
+        parts = split_by_secid(xml, 2)
+        self.assertEqual(parts[1], b'<alltrades><trade secid="1"><tradeno>1</tradeno></trade></alltrades>')
+        self.assertEqual(parts[None], b'<alltrades><trade><tradeno>2</tradeno></trade></alltrades>')
+
+    def test_pipeline(self):
+        got = []
+        local = []
+        p = Pipeline(trade_tuples, 2, got.append, local.append)
+        p.start()
+        p.put(self.xml)
+        p.put(b'<server_status connected="true"/>')
+        p.stop()
+        trades = sorted(t for part in got for t in part)
+        self.assertEqual([t[:2] for t in trades], [(1, 1), (1, 4), (2, 2), (3, 3)])
+        self.assertEqual(local, [b'<server_status connected="true"/>'])
+        self.assertEqual(p.stats()['sent'], [1, 1])
+
+    def test_default_result_handler(self):
+        import commands
+        got = []
+        commands.global_handler = got.append
+        try:
+            p = commands.start_pipeline(trade_tuples, 2)
+            p.put(self.xml)
+            commands.stop_pipeline()
+        finally:
+            commands.global_handler = None
+        self.assertEqual(sorted(t[:2] for part in got for t in part), [(1, 1), (1, 4), (2, 2), (3, 3)])
+
+
+
+class TestCommandScheduler(ut.TestCase):
+    def test_lanes(self):
+        import commands
+        self.assertEqual(lane_of(commands.cancel_order), ORDERS)
+        self.assertEqual(lane_of(commands.subscribe_ids), SUBSCRIPTIONS)
+        self.assertEqual(lane_of(commands.get_news_text), REQUESTS)
+
+    def test_priority(self):
+        sent = []
+
+        def command(name):
+            sent.append(name)
+            if name == 'subscribe':
+                # Заявка приходит, пока запросы ждут интервал после подписки
+                orders.append(s.submit(command, 'order', lane=ORDERS))
+            return name
+
+        orders = []
+        s = CommandScheduler(min_delay=0.05)
+        news = [s.submit(command, 'news%d' % i, lane=REQUESTS) for i in range(3)]
+        duplicate = s.submit(command, 'news2', lane=REQUESTS)
+        s.submit(command, 'subscribe', lane=SUBSCRIPTIONS)
+        s.start()
+        self.assertEqual(news[2].result(5), 'news2')
+        s.stop()
+        self.assertEqual(orders[0].result(0), 'order')
+        self.assertIs(duplicate, news[2])
+        self.assertEqual(sent, ['subscribe', 'order', 'news0', 'news1', 'news2'])
+        stats = s.stats()
+        self.assertEqual(stats['requests']['coalesced'], 1)
+        self.assertEqual([stats[lane]['sent'] for lane in ('orders', 'subscriptions', 'requests')], [1, 1, 3])
+
+
+class TestOutputStage(ut.TestCase):
+    def stage(self, overflow):
+        self.out = []
+        self.gate = threading.Event()
+
+        def handler(items):
+            self.gate.wait(5)
+            self.out.extend(items)
+
+        stage = OutputStage(handler, maxsize=4, overflow=overflow, batch_size=3)
+        self.addCleanup(stage.stop)
+        # Поток вывода занят первой записью
+        stage.put(0)
+        while not stage._busy:
+            time.sleep(0.001)
+        return stage
+
+    def test_drop_oldest(self):
+        stage = self.stage(DROP_OLDEST)
+        stage.put_many([1, 2, 3])
+        stage.put_many([4, 5])
+        self.gate.set()
+        self.assertTrue(stage.drain())
+        self.assertEqual(self.out, [0, 4, 5])
+        self.assertEqual((stage.stats()['dropped'], stage.stats()['handled']), (3, 3))
+
+    def test_spill(self):
+        stage = self.stage(SPILL)
+        for i in range(1, 8):
+            stage.put((i, 'x'))
+        stats = stage.stats()
+        self.assertEqual((stats['depth'], stats['spilled']), (4, 3))
+        self.assertGreater(stats['spill_bytes'], 0)
+        # Пока файл не вычитан, новые записи идут за ним
+        self.gate.set()
+        stage.put((8, 'x'))
+        self.assertTrue(stage.drain())
+        self.assertEqual(self.out, [0] + [(i, 'x') for i in range(1, 9)])
+        self.assertGreater(stage.stats()['lag_max_ms'], 0)
+
+    def test_block(self):
+        stage = self.stage(BLOCK)
+        stage.put_many([1, 2, 3, 4])
+        threading.Timer(0.05, self.gate.set).start()
+        stage.put(5)
+        self.assertTrue(stage.drain())
+        self.assertEqual(self.out, [0, 1, 2, 3, 4, 5])
+        self.assertGreaterEqual(stage.stats()['blocked_ms'], 20)
+
+    def test_failed(self):
+        def handler(items):
+            if 'bad' in items:
+                raise ValueError('bad item')
+
+        stage = OutputStage(handler, batch_size=2)
+        self.addCleanup(stage.stop)
+        stage.put_many(['bad', 'x'])
+        self.assertTrue(stage.drain())
+        stage.put_many(['y', 'z'])
+        self.assertTrue(stage.drain())
+        stats = stage.stats()
+        self.assertEqual((stats['handled'], stats['failed']), (2, 2))
+
+
+if __name__ == '__main__':
+    ut.main()
@@ -6,8 +6,15 @@ Created on Wed Aug 05 17:09:45 2015
 """
 
 import unittest as ut
+import os
+from lxml.etree import XMLSyntaxError
 from structures import *
 from datetime import datetime as dt
+import prices
+try:
+    import columnar
+except ImportError:
+    columnar = None
 
 
 class TestClientOrders(ut.TestCase):
@@ -58,7 +65,7 @@ class TestClientOrders(ut.TestCase):
         self.assertEqual(o.client, 'test/C282166')
         self.assertEqual(o.status, 'active')
         self.assertEqual(o.buysell, 'S')
-        self.assertEqual(o.time, dt(2015,8,10,16,05,20))
+        self.assertEqual(o.time, dt(2015,8,10,16,5,20))
         self.assertEqual(o.broker_ref, '')
         self.assertEqual(o.accrued_int, 0.0)
         self.assertEqual(o.settle_code, 'Y2')
@@ -349,6 +356,76 @@ class TestDateTimeMapper(ut.TestCase):
         self.assertEqual(self.mapper.to_python('11.08.2015 23:08:00'), dt(2015,8,11,23,8))
 
 
+class TestTimeDecoding(ut.TestCase):
+    def test_datetime(self):
+        self.assertEqual(decode_datetime('08.08.2015 23:06:36.125'), dt(2015,8,8,23,6,36,125000))
+        self.assertEqual(decode_datetime('08.08.2015 23:06:36', timeformat), dt(2015,8,8,23,6,36))
+        self.assertRaises(ValueError, decode_datetime, '08.08.2015 23:06:36')
+
+    def test_millis(self):
+        self.assertEqual(decode_millis('08.08.2015 23:06:36.125'), 1439075196125)
+        self.assertEqual(decode_millis('08.08.2015 23:06:36'), 1439075196000)
+        self.assertEqual(decode_millis('09.08.2015 00:00:00.001'), 1439078400001)
+        self.assertRaises(ValueError, decode_millis, '2015-08-08 23:06:36')
+
+    def test_nullable(self):
+        mapper = NullableDateTimeMapper(timeformat_millis)
+        self.assertEqual(mapper.to_python('0'), None)
+        self.assertEqual(mapper.to_python('10.08.2015 16:11:30.500'), dt(2015,8,10,16,11,30,500000))
+
+    def test_trade_millis(self):
+        xml = '<trade secid="1"><time>08.08.2015 23:06:36.125</time></trade>'
+        self.assertEqual(Trade.parse(xml).time_millis, 1439075196125)
+        self.assertEqual(compiled(Trade).parse(xml).time_millis, 1439075196125)
+
+
+class TestFixedPointPrices(ut.TestCase):
+    def tearDown(self):
+        set_price_scales(None)
+
+    def test_ticks(self):
+        self.assertEqual(prices.to_ticks('102.5', 2), 10250)
+        self.assertEqual(prices.to_ticks('0.1037', 4), 1037)
+        self.assertEqual(prices.to_ticks(1750.29, 2), 175029)
+        self.assertEqual(prices.to_ticks('-3.005', 2), -301)
+        self.assertEqual(prices.to_ticks('15', 0), 15)
+
+    def test_format(self):
+        self.assertEqual(prices.format_ticks(10250, 2), '102.50')
+        self.assertEqual(prices.format_ticks(1037, 4), '0.1037')
+        self.assertEqual(prices.format_ticks(-5, 2), '-0.05')
+        self.assertEqual(prices.format_ticks(15, 0), '15')
+
+    def test_parse(self):
+        scales = prices.PriceScales()
+        set_price_scales(scales)
+        parse(open('tests/securities.xml').read())
+        self.assertEqual(scales.decimals[1], 2)
+        self.assertEqual(scales.minsteps[0], 1)
+        obj = parse(open('tests/quotes.xml').read())
+        self.assertEqual(obj.items[0].price, 16970)
+        self.assertEqual(scales.format(1, obj.items[0].price), '169.70')
+        self.assertEqual(scales.steps(1, obj.items[0].price), 16970)
+        self.assertEqual(obj.items[1].price, 1750.29)
+        self.assertEqual(scales.unknown, 2)
+        self.assertEqual(scales.unknown_ids, set([3]))
+
+    def test_orders(self):
+        scales = prices.PriceScales()
+        set_price_scales(scales)
+        parse(open('tests/securities.xml').read())
+        obj = parse('<orders>'
+                    '<order transactionid="1"><secid>1</secid><price>169.7</price></order>'
+                    '<stoporder transactionid="2"><secid>1</secid>'
+                    '<stoploss><orderprice>170.05</orderprice></stoploss></stoporder>'
+                    '<order transactionid="3"><secid>99</secid><price>1.5</price></order>'
+                    '</orders>')
+        self.assertIsInstance(obj, ClientOrderPacket)
+        self.assertIsInstance(obj.items[0], Order)
+        self.assertEqual([o.price for o in obj.items], [16970, 17005, 1.5])
+        self.assertEqual(scales.unknown_ids, set([99]))
+
+
 class TestGlobalParse(ut.TestCase):
     def test_candles(self):
         xml = open('tests/candles.xml').read()
@@ -370,6 +447,27 @@ class TestGlobalParse(ut.TestCase):
         obj = parse(xml)
         self.assertTrue(obj and isinstance(obj,ClientTradePacket))
 
+    def test_alltrades(self):
+        xml = open('tests/alltrades.xml').read()
+        obj = parse(xml)
+        self.assertTrue(obj and isinstance(obj,TradePacket))
+
+    def test_trade_root(self):
+        obj = parse('<trade secid="14"><tradeno>1</tradeno></trade>')
+        self.assertIsInstance(obj, Trade)
+        obj = parse('<trade><secid>21</secid><tradeno>1</tradeno></trade>')
+        self.assertIsInstance(obj, ClientTrade)
+
+    def test_stoporder_root(self):
+        obj = parse('<stoporder transactionid="1"><stoploss><quantity>3</quantity></stoploss></stoporder>')
+        self.assertIsInstance(obj, StopLoss)
+        obj = parse('<stoporder transactionid="1"><takeprofit><quantity>3</quantity></takeprofit></stoporder>')
+        self.assertIsInstance(obj, TakeProfit)
+
+    def test_unknown(self):
+        xml = '<babe id="1"/>'
+        self.assertEqual(parse(xml), xml)
+
 
 class TestEntity(ut.TestCase):
     def test_some(self):
@@ -454,6 +552,47 @@ class TestSecurity(ut.TestCase):
         self.assertEqual(o.cancelbalance_allowed, True)
 
 
+class TestSecurityStream(ut.TestCase):
+    def tearDown(self):
+        set_streaming_securities(False)
+
+    def test_stream(self):
+        xml = open('tests/securities.xml').read()
+        obj = SecurityStream.stream(xml)
+        self.assertIsInstance(obj, SecurityPacket)
+        items = list(obj.items)
+        self.assertEqual(len(items), 3)
+        o = items[1]
+        self.assertIsInstance(o, Security)
+        self.assertEqual(o.id, 1)
+        self.assertEqual(o.seccode, 'GAZP')
+        self.assertEqual(o.name, u"Газпром ао")
+        self.assertEqual(o.minstep, .01)
+        self.assertEqual(o.timezone.strip(), "Arab Standard Time")
+        self.assertEqual(o.credit_allowed, True)
+
+    def test_small_chunks(self):
+        import structures
+        xml = open('tests/securities.xml').read()
+        chunk, structures.stream_chunk = structures.stream_chunk, 17
+        try:
+            codes = [o.seccode for o in iter_items(xml, 'security', Security)]
+        finally:
+            structures.stream_chunk = chunk
+        self.assertEqual(codes, ['VTBR', 'GAZP', 'GMKN'])
+
+    def test_global_parse(self):
+        xml = open('tests/securities.xml').read()
+        set_streaming_securities()
+        self.assertIsInstance(parse(xml), SecurityStream)
+        set_streaming_securities(False)
+        self.assertNotIsInstance(parse(xml), SecurityStream)
+
+    def test_root_tag(self):
+        self.assertEqual(root_tag('<?xml version="1.0"?>\n<securities>'), 'securities')
+        self.assertEqual(root_tag(b'<server_status connected="true"/>'), 'server_status')
+
+
 class TestQuotations(ut.TestCase):
     pass
 
@@ -482,6 +621,183 @@ class TestSubscribedTicks(ut.TestCase):
         self.assertEqual(o.open_interest, None)
 
 
+class TestFastTrades(ut.TestCase):
+    xml = u"""<alltrades>
+    <trade secid="14">
+        <tradeno>2691161113</tradeno>
+        <board>TQBR</board>
+        <time>08.08.2015 23:06:36.125</time>
+        <price>102.50</price>
+        <quantity>118</quantity>
+        <buysell>B</buysell>
+        <seccode>SBER03</seccode>
+        <period>N</period>
+    </trade>
+</alltrades>"""
+
+    def tearDown(self):
+        set_fast_trades(False)
+
+    def test_trade(self):
+        obj = FastTradePacket.parse(self.xml)
+        self.assertIsInstance(obj, TradePacket)
+        self.assertEqual(len(obj.items), 1)
+        o = obj.items[0]
+        self.assertIsInstance(o, TradeRecord)
+        self.assertEqual(o.id, 2691161113)
+        self.assertEqual(o.trade_no, 2691161113)
+        self.assertEqual(o.secid, 14)
+        self.assertEqual(o.seccode, 'SBER03')
+        self.assertEqual(o.board, 'TQBR')
+        self.assertEqual(o.time, dt(2015,8,8,23,6,36,125000))
+        self.assertEqual(o.price, '102.50')
+        self.assertEqual(o.quantity, 118)
+        self.assertEqual(o.buysell, 'B')
+        self.assertEqual(o.trade_period, 'N')
+        self.assertEqual(o.open_interest, None)
+
+    def test_compact(self):
+        o = FastTradePacket.parse(self.xml).items[0]
+        self.assertFalse(hasattr(o, '__dict__'))
+        self.assertFalse(hasattr(o, 'node'))
+        self.assertEqual(o, FastTradePacket.parse(self.xml).items[0])
+        self.assertIn('seccode=SBER03', repr(o))
+
+    def test_same_as_trade(self):
+        fast = FastTradePacket.parse(self.xml).items[0]
+        slow = TradePacket.parse(self.xml).items[0]
+        for name in Trade._fields:
+            self.assertEqual(getattr(fast, name), getattr(slow, name))
+
+    def test_global_parse(self):
+        set_fast_trades()
+        self.assertIsInstance(parse(self.xml), FastTradePacket)
+        set_fast_trades(False)
+        self.assertNotIsInstance(parse(self.xml), FastTradePacket)
+
+
+class TestCompiledParsers(ut.TestCase):
+    def assertSameFields(self, fast, slow):
+        self.assertIsInstance(fast, type(slow))
+        for name in type(slow)._fields:
+            a, b = getattr(fast, name), getattr(slow, name)
+            if isinstance(b, MyXmlObject):
+                self.assertSameFields(a, b)
+            elif isinstance(b, list) or type(b).__name__ == 'NodeList':
+                self.assertEqual(len(a), len(b))
+                for x, y in zip(a, b):
+                    self.assertSameFields(x, y)
+            elif b != b:
+                # NaN пустого FloatField
+                self.assertNotEqual(a, a, name)
+            else:
+                self.assertEqual(a, b, name)
+
+    def walk(self, obj):
+        # Прочитать все поля (ленивые поля eulxml могут бросать исключения разбора)
+        for name in type(obj)._fields:
+            value = getattr(obj, name)
+            for item in (value if isinstance(value, list) or type(value).__name__ == 'NodeList' else [value]):
+                if isinstance(item, MyXmlObject):
+                    self.walk(item)
+
+    def check(self, cls, filename):
+        xml = open(filename).read()
+        self.assertSameFields(compiled(cls).parse(xml), cls.parse(xml))
+
+    def test_candles(self):
+        self.check(HistoryCandlePacket, 'tests/candles.xml')
+
+    def test_securities(self):
+        self.check(SecurityPacket, 'tests/securities.xml')
+
+    def test_portfolio(self):
+        self.check(ClientPortfolio, 'tests/portfolio.xml')
+
+    def test_quotes(self):
+        self.check(QuotePacket, 'tests/quotes.xml')
+
+    def test_limits(self):
+        self.check(ClientLimitsTPlus, 'tests/limits_t+.xml')
+
+    def test_fixtures(self):
+        # Все образцы: сгенерированный парсер дает те же значения (или ту же ошибку), что и eulxml
+        for name in sorted(os.listdir('tests')):
+            if not name.endswith('.xml'):
+                continue
+            xml = open(os.path.join('tests', name)).read()
+            try:
+                slow = parse(xml)
+            except XMLSyntaxError:
+                # Несколько сообщений в одном файле (server_statuses.xml)
+                continue
+            cls = type(slow)
+            if compiled(cls) is cls:
+                continue
+            try:
+                fast = compiled(cls).parse(xml)
+            except Exception as e:
+                self.assertRaises(type(e), self.walk, slow)
+                continue
+            self.assertSameFields(fast, slow)
+
+    def test_text_semantics(self):
+        xml = ('<security secid="1"><seccode>SB<!-- c -->ER<x>1</x></seccode><seccode>GAZP</seccode>'
+               '<minstep/><decimals>2</decimals><decimals>4</decimals><lotsize></lotsize></security>')
+        fast, slow = compiled(Security).parse(xml), Security.parse(xml)
+        self.assertSameFields(fast, slow)
+        self.assertEqual(fast.seccode, 'SBER1')
+        self.assertEqual(fast.decimals, 2)
+        self.assertNotEqual(fast.minstep, fast.minstep)
+        self.assertEqual(fast.lotsize, None)
+
+    def test_custom_parse(self):
+        self.assertIs(compiled(ClientOrderPacket), ClientOrderPacket)
+
+    def test_global_parse(self):
+        xml = open('tests/boards.xml').read()
+        set_compiled_parsers()
+        try:
+            obj = parse(xml)
+        finally:
+            set_compiled_parsers(False)
+        self.assertIsInstance(obj, compiled(BoardPacket))
+        self.assertEqual(obj.items[1].id, 'TQBR')
+        self.assertEqual(obj.items[1].market, 1)
+
+
+@ut.skipIf(columnar is None, 'numpy is not installed')
+class TestColumnar(ut.TestCase):
+    def test_trades(self):
+        xml = open('tests/alltrades.xml').read()
+        a = columnar.decode_trades(xml)
+        self.assertEqual(len(a), 3)
+        self.assertEqual(list(a['secid']), [14, 14, 21])
+        self.assertEqual(a['tradeno'][1], 2691161113)
+        self.assertEqual(a['time'][1], 1439075196000)
+        self.assertEqual(list(a['price']), [102.5, 102.5, 237.42])
+        self.assertEqual(list(a['quantity']), [6, 118, 1])
+        self.assertEqual(list(a['buysell']), [columnar.BUY, columnar.BUY, columnar.SELL])
+
+    def test_time_millis(self):
+        a = columnar.to_epoch_millis(['08.08.2015 23:06:36.125', '08.08.2015 23:06:36'])
+        self.assertEqual(list(a), [1439075196125, 1439075196000])
+
+    def test_quotes(self):
+        xml = open('tests/quotes.xml').read()
+        a = columnar.decode_quotes(QuotePacket.parse(xml))
+        self.assertEqual(list(a['secid']), [1, 3, 3])
+        self.assertEqual(list(a['buy']), [1, 0, 34])
+        self.assertEqual(list(a['sell']), [0, -1, 0])
+
+    def test_candles(self):
+        xml = open('tests/candles.xml').read()
+        cols = columnar.decode_candles(xml, columns=True)
+        self.assertEqual(list(cols['date']), [1439334420000, 1439334480000, 1439334540000])
+        self.assertEqual(list(cols['volume']), [807402, 257485, 541004])
+        self.assertEqual(cols['low'][2], 0.1037)
+
+
 class TestSubscribedBidAsks(ut.TestCase):
     @classmethod
     def setUpClass(cls):